@@ -0,0 +1,78 @@
+#!/usr/bin/env python2.7
+"""
+Time variables_parsing.CandidateIndex searches, with the entries of a data
+request CSV as the index and each of its rows as a query, against scoring
+every entry that shares any feature with the query (as the index first did).
+
+    python benchmarks/bench_candidate_search.py [request.csv [k]]
+
+Prints the time per query, the mean number of entries scored per query and
+how often the best candidate of the two agree.
+"""
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import variables_parsing
+
+DEFAULT_CSV = os.path.join(os.path.dirname(__file__), os.pardir, 'input',
+                           'CMIP6_data_req_20151126.csv')
+DEFAULT_K = 3
+
+
+class SharedAnyIndex(variables_parsing.CandidateIndex):
+    """The CandidateIndex scoring every entry that shares a feature"""
+
+    def __init__(self, requests, features):
+        super(SharedAnyIndex, self).__init__(requests, features)
+        self._postings = collections.defaultdict(list)
+        for position, entry_features in enumerate(self._features):
+            for feature in entry_features:
+                self._postings[feature].append(position)
+
+    def _seeds(self, features):
+        seeds = set()
+        for feature in features:
+            seeds.update(self._postings.get(feature, ()))
+        return seeds
+
+
+def timed(name, index, queries, k):
+    """Search index for each of queries, print and return the best found"""
+    scored = [0]
+    seeds = index._seeds
+
+    def counted(features):
+        found = seeds(features)
+        scored[0] += len(found)
+        return found
+
+    index._seeds = counted
+    start = time.time()
+    best = [index.search(features, k) for features in queries]
+    elapsed = time.time() - start
+    print '{:<22} {:>7.3f} ms/query {:>8.1f} entries scored/query'.format(
+        name, elapsed / len(queries) * 1e3, scored[0] / float(len(queries)))
+    return [found[0][0] if found else None for found in best]
+
+
+def main(mip_csv, k):
+    requests = list(variables_parsing.iter_cmip6_csv(mip_csv))
+    features = variables_parsing.cmip6_features
+    queries = [features(request) for request in requests]
+    print '{} entries, {} queries, k={}'.format(len(requests), len(queries), k)
+    before = timed('any shared feature', SharedAnyIndex(requests, features),
+                   queries, k)
+    after = timed('seeded', variables_parsing.CandidateIndex(requests,
+                                                             features),
+                  queries, k)
+    print 'same best candidate: {:.1%}'.format(
+        sum(1 for b, a in zip(before, after) if b is a) / float(len(queries)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_K)
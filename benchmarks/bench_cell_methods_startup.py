@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+"""
+Compare the start up and parse time of the cell_methods parsing used by
+process_spreadsheet.time_method: iris.fileformats.netcdf.parse_cell_methods
+against the native cell_methods.parse_cell_methods. The "python" line is
+the interpreter start up and CSV read alone.
+
+Each parser is imported in a fresh interpreter, which then parses every
+cell_methods value in the CMIP6 request CSV 100 times. The best of several
+runs is reported.
+
+    python benchmarks/bench_cell_methods_startup.py [request.csv]
+"""
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+DEFAULT_CSV = os.path.join(REPO_DIR, 'input', 'CMIP6_data_req_20151126.csv')
+REPEATS = 5
+
+_SCRIPT = '''
+import csv
+import sys
+sys.path.insert(0, {repo_dir!r})
+{import_line}
+values = [row['cell_methods'] for row in csv.DictReader(open({csv!r}))]
+for _ in range(100):
+    for value in values:
+        parse_cell_methods(value)
+'''
+
+PARSERS = {'python': 'parse_cell_methods = lambda value: ()',
+           'iris': 'from iris.fileformats.netcdf import parse_cell_methods',
+           'native': 'from cell_methods import parse_cell_methods'}
+
+
+def time_parser(name, csv_file):
+    """Return the best wall clock time to start python and run the parser"""
+    script = _SCRIPT.format(repo_dir=REPO_DIR, csv=csv_file,
+                            import_line=PARSERS[name])
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(REPEATS):
+            start = time.time()
+            if subprocess.call([sys.executable, '-c', script],
+                               stderr=devnull) != 0:
+                return None
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(csv_file):
+    for name in ('python', 'iris', 'native'):
+        elapsed = time_parser(name, csv_file)
+        if elapsed is None:
+            print '{:<8} not available'.format(name)
+        else:
+            print '{:<8} {:>8.3f} s'.format(name, elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_CSV)
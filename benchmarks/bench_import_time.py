@@ -0,0 +1,86 @@
+#!/usr/bin/env python2.7
+"""
+Import time regression benchmark for rose_stash_manipulate.
+
+The module is imported in a fresh interpreter with __import__ wrapped to time
+every module first imported (similar to python3's -X importtime, which
+python2.7 lacks). The slowest imports and the total are reported.
+
+Importing the script must have no side effects: the benchmark fails if any of
+HEAVY_MODULES are imported or a subprocess is started during the import.
+
+    python benchmarks/bench_import_time.py [module]
+"""
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir)
+HEAVY_MODULES = ('rose', 'rose.config', 'rose.macro', 'widget', 'openpyxl',
+                 'iris')
+SHOW = 15
+
+_SCRIPT = '''
+import __builtin__
+import json
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, {repo_dir!r})
+timings = {{}}
+popen_calls = []
+_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kwargs):
+    new = name not in sys.modules
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        if new and name in sys.modules:
+            timings[name] = time.time() - start
+
+
+class RecordedPopen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        popen_calls.append(repr(args))
+        super(RecordedPopen, self).__init__(*args, **kwargs)
+
+
+subprocess.Popen = RecordedPopen
+__builtin__.__import__ = timed_import
+start = time.time()
+import {module}
+total = time.time() - start
+__builtin__.__import__ = _import
+print json.dumps({{'total': total, 'timings': timings,
+                  'popen': popen_calls, 'modules': sorted(sys.modules)}})
+'''
+
+
+def main(module):
+    script = _SCRIPT.format(repo_dir=REPO_DIR, module=module)
+    result = json.loads(subprocess.check_output([sys.executable, '-c',
+                                                 script]))
+    print 'import {}: {:.1f} ms'.format(module, result['total'] * 1000)
+    print '{:>10}  {}'.format('cumul. ms', 'module')
+    for name, elapsed in sorted(result['timings'].items(),
+                                key=lambda item: -item[1])[:SHOW]:
+        print '{:>10.2f}  {}'.format(elapsed * 1000, name)
+
+    failures = ['imported {}'.format(name) for name in HEAVY_MODULES
+                if name in result['modules']]
+    failures.extend('started subprocess {}'.format(call)
+                    for call in result['popen'])
+    for failure in failures:
+        print 'FAIL:', failure
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1
+                  else 'rose_stash_manipulate'))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.7
+"""
+Time variables_parsing.read_mip_dir and read_variables_dir on a synthetic
+directory of CMIP5 style MIP tables and xxx_variables files: serially, with
+worker threads, and through a cold and a warm parse cache.
+
+    python benchmarks/bench_mip_dir_loading.py [tables [workers]]
+
+The directories are written to local disk, so this understates the gain from
+the threads on the shared file systems the tables are usually read from.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import parse_cache
+import variables_parsing
+
+DEFAULT_TABLES = 400
+DEFAULT_WORKERS = 8
+VARIABLES_PER_TABLE = 60
+
+TABLE_HEADER = """table_id: Table {table}
+modeling_realm: atmos
+frequency: mon
+cmor_version: 2.6
+generic_levels: alevel alevhalf
+
+"""
+VARIABLE_ENTRY = """!============
+variable_entry:    {name}
+!============
+modeling_realm:    atmos
+!----------------------------------
+! Variable attributes:
+!----------------------------------
+standard_name:     air_temperature_{index}
+units:             K
+cell_methods:      time: mean
+cell_measures:     area: areacella
+long_name:         Variable {index}
+!----------------------------------
+! Additional variable information:
+!----------------------------------
+dimensions:        longitude latitude time
+out_name:          {name}
+type:              real
+!----------------------------------
+
+"""
+VARIABLES_SECTION = """[{name}]
+miptable = CMIP5_{table}
+lbproc = 128
+lbuser5 = {index}
+outputs_per_file = 10
+
+"""
+
+
+def write_synthetic_dirs(root, tables):
+    """Write tables MIP tables and a variables file for every 4 of them"""
+    table_dir = os.path.join(root, 'tables')
+    variables_dir = os.path.join(root, 'variables')
+    os.mkdir(table_dir)
+    os.mkdir(variables_dir)
+    for table_index in range(tables):
+        table = 'T{:04d}'.format(table_index)
+        names = ['v{}_{}'.format(table_index, index)
+                 for index in range(VARIABLES_PER_TABLE)]
+        with open(os.path.join(table_dir, 'CMIP5_' + table), 'w') as fout:
+            fout.write(TABLE_HEADER.format(table=table))
+            for index, name in enumerate(names):
+                fout.write(VARIABLE_ENTRY.format(name=name, index=index))
+        stream = 'ap{:03d}'.format(table_index // 4)
+        with open(os.path.join(variables_dir, stream + '_variables'),
+                  'a') as fout:
+            for index, name in enumerate(names):
+                fout.write(VARIABLES_SECTION.format(name=name, table=table,
+                                                    index=index))
+    return table_dir, variables_dir
+
+
+def load(table_dir, variables_dir, workers, cache):
+    """Return the time to load both directories, and the entries read"""
+    start = time.time()
+    requests = variables_parsing.read_mip_dir(table_dir, 'CMIP5', workers,
+                                              cache)
+    variables = variables_parsing.read_variables_dir(variables_dir, workers,
+                                                     cache)
+    return time.time() - start, len(requests) + len(variables)
+
+
+def main(tables, workers):
+    root = tempfile.mkdtemp()
+    try:
+        table_dir, variables_dir = write_synthetic_dirs(root, tables)
+        cache = parse_cache.ParseCache(os.path.join(root, 'cache'))
+        runs = [('serial', 1, None),
+                ('threads', workers, None),
+                ('threads, cold cache', workers, cache),
+                ('threads, warm cache', workers, cache),
+                ('serial, warm cache', 1, cache)]
+        print '{} tables, {} variables each, {} worker threads'.format(
+            tables, VARIABLES_PER_TABLE, workers)
+        for name, run_workers, run_cache in runs:
+            elapsed, entries = load(table_dir, variables_dir, run_workers,
+                                    run_cache)
+            print '{:<22} {:>8.2f} s {:>8d} entries'.format(name, elapsed,
+                                                           entries)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_TABLES,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_WORKERS)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python2.7
+"""
+Time variables_parsing.models_known_mappings on synthetic MIP tables, stash
+mapping file and xxx_variables directories of several models: serially, with
+the models in worker threads (as it first did) and in worker processes.
+
+    python benchmarks/bench_models_known_mappings.py [models [tables [workers]]]
+
+Matching a model is CPU bound Python, so the threads are held back by the GIL.
+The processes are capped at the number of CPUs, and each sends its known
+mappings back pickled; the time that takes for one model is printed too.
+"""
+import cPickle
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import variables_parsing
+from bench_mip_dir_loading import (TABLE_HEADER, VARIABLE_ENTRY,
+                                   VARIABLES_PER_TABLE, VARIABLES_SECTION)
+
+DEFAULT_MODELS = 4
+DEFAULT_TABLES = 100
+DEFAULT_WORKERS = 4
+
+MAPPING_HEADER = ('|  published  |  stash mapping  |  um version  |  units  |'
+                  '  positive  |  comment  |  notes  |  owner  |\n')
+
+
+def write_synthetic_dirs(root, tables):
+    """
+    Write tables MIP tables and the xxx_variables files of their variables,
+    named without underscores so that they join on mip_id
+    """
+    table_dir = os.path.join(root, 'tables')
+    variables_dir = os.path.join(root, 'variables')
+    os.mkdir(table_dir)
+    os.mkdir(variables_dir)
+    for table_index in range(tables):
+        table = 'T{:04d}'.format(table_index)
+        names = ['v{}x{}'.format(table_index, index)
+                 for index in range(VARIABLES_PER_TABLE)]
+        with open(os.path.join(table_dir, 'CMIP5_' + table), 'w') as fout:
+            fout.write(TABLE_HEADER.format(table=table))
+            for index, name in enumerate(names):
+                fout.write(VARIABLE_ENTRY.format(name=name, index=index))
+        stream = 'ap{:03d}'.format(table_index // 4)
+        with open(os.path.join(variables_dir, stream + '_variables'),
+                  'a') as fout:
+            for index, name in enumerate(names):
+                fout.write(VARIABLES_SECTION.format(name=name, table=table,
+                                                    index=index))
+    return table_dir, variables_dir
+
+
+def write_mapping_file(fname, variables):
+    """Write a stash mapping file with a mapping for each of variables"""
+    with open(fname, 'w') as fout:
+        fout.write(MAPPING_HEADER)
+        for index, published in enumerate(sorted(set(
+                variable.published for variable in variables))):
+            fout.write('| {} | m01s03i{:03d} | >= 6.6 | K | | | | me |\n'.format(
+                published, index % 1000))
+
+
+def models_known_mappings_threads(models, tdir, mfile, workers):
+    """models_known_mappings with the models in worker threads"""
+    mapping_index = variables_parsing.read_stash_mapping_index(mfile)
+    tables = variables_parsing.read_mip_dir(tdir, 'CMIP5', workers)
+
+    def model_mappings(model):
+        vdir, version = model
+        return variables_parsing._match_known(
+            variables_parsing.read_variables_dir(vdir),
+            variables_parsing.copy_mip_entries(tables),
+            mapping_index.for_version(version))
+
+    return variables_parsing._map_threads(model_mappings, models, workers)
+
+
+def main(models, tables, workers):
+    root = tempfile.mkdtemp()
+    try:
+        table_dir, variables_dir = write_synthetic_dirs(root, tables)
+        model_dirs = []
+        for index in range(models):
+            model_dir = os.path.join(root, 'model{}'.format(index))
+            shutil.copytree(variables_dir, model_dir)
+            model_dirs.append((model_dir, 6.6))
+        mfile = os.path.join(root, 'stash_mappings.txt')
+        write_mapping_file(mfile,
+                           variables_parsing.read_variables_dir(variables_dir))
+
+        print '{} models, {} tables, {} workers, {} CPUs'.format(
+            models, tables, workers, multiprocessing.cpu_count())
+        runs = [('serial', lambda: variables_parsing.models_known_mappings(
+                     model_dirs, table_dir, mfile, 1)),
+                ('threads', lambda: models_known_mappings_threads(
+                     model_dirs, table_dir, mfile, workers)),
+                ('processes', lambda: variables_parsing.models_known_mappings(
+                     model_dirs, table_dir, mfile, workers))]
+        for name, run in runs:
+            start = time.time()
+            known = run()
+            print '{:<10} {:>7.2f} s {:>8d} known mappings'.format(
+                name, time.time() - start, sum(len(k) for k in known))
+        start = time.time()
+        cPickle.loads(cPickle.dumps(known[0], cPickle.HIGHEST_PROTOCOL))
+        print '{:<10} {:>7.2f} s to pickle one model'.format(
+            'transfer', time.time() - start)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MODELS,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_TABLES,
+         int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_WORKERS)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2.7
+"""
+Measure the throughput of to_csv.read_blocks and read_nl on a synthetic rose
+configuration of streq, domain, time and use namelists, against the fixed
+seven line reader to_csv used before (which only reads streq sections with
+their options in sorted order, so it is timed on such a file).
+
+    python benchmarks/bench_namelist_reader.py [blocks]
+"""
+from itertools import ifilter, imap
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import to_csv
+
+DEFAULT_BLOCKS = 100000
+
+STREQ_OPTIONS = (('dom_name', "'DIAG'"), ('isec', '3'), ('item', '236'),
+                 ('package', "'PRIMAVERA'"), ('tim_name', "'TMONM'"),
+                 ('use_name', "'UP5'"))
+
+
+def read_fixed(fi):
+    """The reader to_csv.py had before read_blocks"""
+    def _nl(line):
+        return re.search('streq\((.*)\)', line).group(1)
+
+    def _after_eq(line):
+        return re.search('=(.*)$', line).group(1)
+
+    inp = imap(lambda line: line[:-1],
+               ifilter(lambda line: line not in ('\n', ' \n'), fi))
+    while True:
+        try:
+            namelist = _nl(next(inp))
+        except StopIteration:
+            break
+        dom = _after_eq(next(inp))
+        isec = _after_eq(next(inp))
+        item = _after_eq(next(inp))
+        _after_eq(next(inp))
+        tim = _after_eq(next(inp))
+        use = _after_eq(next(inp))
+        yield (namelist, dom, isec, item, tim, use)
+
+
+def write_sorted_streq(fname, blocks):
+    """Write streq sections with their options in the order rose sorts them"""
+    with open(fname, 'w') as fout:
+        for index in xrange(blocks):
+            fout.write('[namelist:streq({:05d}_{:08x})]\n'.format(
+                index % 100000, index))
+            for key, value in STREQ_OPTIONS:
+                fout.write('{}={}\n'.format(key, value))
+            fout.write('\n')
+
+
+def write_mixed(fname, blocks, seed=0):
+    """
+    Write a mix of streq, domain, time and use sections, with shuffled
+    options, ignored options and continuation lines
+    """
+    rand = random.Random(seed)
+    with open(fname, 'w') as fout:
+        for index in xrange(blocks):
+            kind = index % 4
+            if kind == 0:
+                fout.write('[namelist:streq({:08x})]\n'.format(index))
+                options = list(STREQ_OPTIONS)
+                rand.shuffle(options)
+                for key, value in options:
+                    fout.write('{}={}\n'.format(key, value))
+            elif kind == 1:
+                fout.write('[namelist:domain(d{})]\n'.format(index))
+                fout.write("dom_name='D{}'\niopl=1\n!!imn=1\n".format(index))
+                fout.write('levlst=' + ','.join(str(level) for level in
+                                                range(1, 21)) + ',\n')
+                fout.write('      =' + ','.join(str(level) for level in
+                                                range(21, 41)) + '\n')
+            elif kind == 2:
+                fout.write('[namelist:time(t{})]\n'.format(index))
+                fout.write("ifre=1\nintv=6\nioff=0\nityp=3\n"
+                           "tim_name='T{}'\nunt1='H'\n".format(index))
+            else:
+                fout.write('[namelist:use(u{})]\n'.format(index))
+                fout.write("iuse=1\nlocn=3\nmacrotag=0\n"
+                           "use_name='U{}'\n".format(index))
+            fout.write('\n')
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed(name, fname, reader):
+    """Consume reader on fname and print its throughput"""
+    size_mb = os.path.getsize(fname) / (1024.0 * 1024.0)
+    start = time.time()
+    with open(fname, 'r') as fi:
+        records = sum(1 for _ in reader(fi))
+    elapsed = time.time() - start
+    print ('{:<28} {:>8d} records {:>6.2f} s {:>9.0f} records/s '
+           '{:>6.1f} MB/s'.format(name, records, elapsed, records / elapsed,
+                                  size_mb / elapsed))
+
+
+def main(blocks):
+    root = tempfile.mkdtemp()
+    try:
+        sorted_file = os.path.join(root, 'sorted.conf')
+        mixed_file = os.path.join(root, 'mixed.conf')
+        write_sorted_streq(sorted_file, blocks)
+        write_mixed(mixed_file, blocks)
+        print '{} blocks per file'.format(blocks)
+        timed('fixed 7 line, sorted streq', sorted_file, read_fixed)
+        timed('read_nl, sorted streq', sorted_file, to_csv.read_nl)
+        timed('read_blocks, mixed', mixed_file, to_csv.read_blocks)
+        print 'peak RSS {} kB'.format(_peak_rss_kb())
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BLOCKS)
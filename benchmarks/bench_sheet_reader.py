@@ -0,0 +1,87 @@
+#!/usr/bin/env python2.7
+"""
+Compare reading the data request workbook column by column with ranged reads
+(ws['X2:X<max_row>'], as process_spreadsheet.work used to) against the single
+pass process_spreadsheet.read_workbook_sheets.
+
+Each reader is run in a fresh process so that the peak resident memory can be
+reported for it alone.
+
+    python benchmarks/bench_sheet_reader.py [workbook.xlsx]
+"""
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import openpyxl
+
+import process_spreadsheet
+
+DEFAULT_WORKBOOK = os.path.join(os.path.dirname(__file__), os.pardir,
+                                'PRIMAVERA_MS21_DRQ_0-beta-37.5.xlsx')
+
+
+def _max_occupied_row(ws):
+    for row_number, row in enumerate(ws.iter_rows()):
+        if not any(cell.value for cell in row):
+            break
+    return row_number
+
+
+def read_ranged(loaded_workbook):
+    """Read the sheet columns the way work() did before the streaming reader"""
+    sheets = []
+    section_ws = loaded_workbook.worksheets[1:-1]
+    # process_stash_translation scanned every sheet for four columns...
+    for ws in section_ws:
+        max_row = _max_occupied_row(ws)
+        for key in ('unique', 'stash', 'cmor', 'variable'):
+            name = process_spreadsheet.SHEET_COLUMNS[key]
+            [cell[0].value for cell in ws['%s2:%s%i' % (name, name, max_row)]]
+    # ...then the main loop read every column again
+    for ws in section_ws:
+        max_row = _max_occupied_row(ws)
+        columns = {}
+        for key, name in process_spreadsheet.SHEET_COLUMNS.items():
+            columns[key] = [cell[0].value for cell in
+                            ws['%s2:%s%i' % (name, name, max_row)]]
+        sheets.append((ws.title, columns))
+    return sheets
+
+
+READERS = {'ranged': read_ranged,
+           'streaming': process_spreadsheet.read_workbook_sheets}
+
+
+def run_one(reader_name, workbook):
+    """Run one reader in this process and print its timing and memory use"""
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    start = time.time()
+    try:
+        loaded_workbook = openpyxl.load_workbook(workbook, use_iterators=True)
+        sheets = READERS[reader_name](loaded_workbook)
+    finally:
+        sys.stdout = stdout
+    elapsed = time.time() - start
+    rows = sum(len(columns['stash']) for _, columns in sheets)
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '{:<10} {:>8.2f} s {:>10d} kB peak RSS {:>6d} rows'.format(
+        reader_name, elapsed, peak_kb, rows)
+
+
+def main(workbook):
+    for reader_name in ('ranged', 'streaming'):
+        subprocess.check_call([sys.executable, __file__, '--run', reader_name,
+                               workbook])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run_one(sys.argv[2], sys.argv[3])
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_WORKBOOK)
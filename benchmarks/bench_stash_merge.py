@@ -0,0 +1,82 @@
+#!/usr/bin/env python2.7
+"""
+Time inserting the STASH requests of a synthetic data request into a suite
+config: one merge_configs call per request (as rose_stash_manipulate.work used
+to) against build_stash_sections followed by a single merge_sections.
+
+Needs rose, from the paths rose_stash_manipulate adds to sys.path.
+
+    python benchmarks/bench_stash_merge.py [requests [suite_sections]]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import rose_stash_manipulate
+from bench_streq_insertion import TEMPLATE, stash_codes
+
+DEFAULT_REQUESTS = 5000
+DEFAULT_SUITE_SECTIONS = 3000
+
+
+def suite_config(sections):
+    """Return a config standing in for a suite with sections streq sections"""
+    rose = rose_stash_manipulate.rose
+    config = rose.config.ConfigNode()
+    for index in range(sections):
+        section = 'namelist:streq({:05d}_{:08x})'.format(index, index)
+        for option, value in (('dom_name', "'DIAG'"), ('isec', '0'),
+                              ('item', str(index)), ('package', "'STD'"),
+                              ('tim_name', "'TMONMN'"),
+                              ('use_name', "'UPMEAN'")):
+            config.set(keys=[section, option], value=value)
+    return config
+
+
+def merge_per_request(template, codes, target):
+    index_cache = rose_stash_manipulate.SectionIndexCache()
+    for code in codes:
+        config_tmp = template.clone()
+        rose_stash_manipulate.put_stash_into_config(config_tmp, code,
+                                                    index_cache)
+        rose_stash_manipulate.merge_configs(target, config_tmp)
+
+
+def merge_batch(template, codes, target):
+    sections = rose_stash_manipulate.build_stash_sections(template, codes)
+    rose_stash_manipulate.merge_sections(target, sections)
+
+
+def main(requests, suite_sections):
+    root = tempfile.mkdtemp()
+    try:
+        template_file = os.path.join(root, 'streq_template.conf')
+        with open(template_file, 'w') as fout:
+            fout.write(TEMPLATE)
+        template = rose_stash_manipulate.ConfigPrototype.load(template_file)
+        codes = stash_codes(requests)
+        print '{} requests into {} suite sections'.format(requests,
+                                                           suite_sections)
+        sections = {}
+        for name, merge in (('merge per request', merge_per_request),
+                            ('batch merge', merge_batch)):
+            target = suite_config(suite_sections)
+            start = time.time()
+            merge(template, codes, target)
+            elapsed = time.time() - start
+            sections[name] = sorted(target.value)
+            print '{:<18} {:>7.2f} s {:>8.1f} us/request'.format(
+                name, elapsed, elapsed / requests * 1e6)
+        print 'same sections: {}'.format(len(set(
+            tuple(names) for names in sections.values())) == 1)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REQUESTS,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_SUITE_SECTIONS)
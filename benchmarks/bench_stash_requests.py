@@ -0,0 +1,101 @@
+#!/usr/bin/env python2.7
+"""
+Compare the memory use and construction time of the STASH requests built for
+every sheet of the data request, held as process_spreadsheet.StashRequest
+records or as the 13-key dictionaries process_sheet used to build.
+
+Each variant is run in a fresh process, processing all the sheets a number of
+times and keeping every result, so that the growth of the resident memory can
+be put down to the requests.
+
+    python benchmarks/bench_stash_requests.py [workbook.xlsx [repeats]]
+"""
+import ConfigParser
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import openpyxl
+
+import process_spreadsheet
+
+DEFAULT_WORKBOOK = os.path.join(os.path.dirname(__file__), os.pardir,
+                                'PRIMAVERA_MS21_DRQ_0-beta-37.5.xlsx')
+DEFAULT_REPEATS = 20
+REQUEST_RESULTS = ('stash_dict', 'stash_undef', 'stash_not_wanted')
+
+
+class DictRequest(dict):
+    """The dictionary requests built before StashRequest"""
+
+    def __init__(self, tim_name, use_name, cmip_dim, dom_name, priority, cmor,
+                 package, period, sheet_name, stash, item, section, lbproc):
+        dict.__init__(self, process_spreadsheet.stash_request(
+            tim_name, use_name, cmip_dim, dom_name, priority, cmor, package,
+            period, sheet_name, stash, item, section, lbproc))
+
+    def identity_key(self):
+        return (self['section'] + self['item'] + self['dom_name'] +
+                self['tim_name'] + self['use_name'] + self['package'])
+
+
+RECORDS = {'dict': DictRequest,
+           'slots': process_spreadsheet.StashRequest}
+
+
+def _rss_kb():
+    """return the current resident memory in kB (Linux), else the peak"""
+    try:
+        with open('/proc/self/statm') as fin:
+            pages = int(fin.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_one(record_name, workbook, repeats):
+    """Process every sheet repeats times with one record type"""
+    process_spreadsheet.StashRequest = RECORDS[record_name]
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        loaded_workbook = openpyxl.load_workbook(workbook, use_iterators=True)
+        sheets = process_spreadsheet.read_workbook_sheets(loaded_workbook)
+        config = ConfigParser.ConfigParser()
+        kept = []
+        before_kb = _rss_kb()
+        start = time.time()
+        for _ in range(repeats):
+            for title, columns in sheets:
+                kept.append(process_spreadsheet.process_sheet(
+                    title, columns, {}, config))
+        elapsed = time.time() - start
+        after_kb = _rss_kb()
+    finally:
+        sys.stdout = stdout
+
+    records = [record for results in kept if results is not None
+               for name in REQUEST_RESULTS
+               for record in results[name].itervalues()]
+    record_bytes = sys.getsizeof(records[0])
+    print ('{:<6} {:>8.2f} s {:>8d} kB RSS growth {:>5d} bytes/record '
+           '{:>7d} requests'.format(record_name, elapsed, after_kb - before_kb,
+                                    record_bytes, len(records)))
+
+
+def main(workbook, repeats):
+    for record_name in ('dict', 'slots'):
+        subprocess.check_call([sys.executable, __file__, '--run', record_name,
+                               workbook, str(repeats)])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--run':
+        run_one(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_WORKBOOK,
+             int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REPEATS)
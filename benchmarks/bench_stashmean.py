@@ -0,0 +1,144 @@
+#!/usr/bin/env python2.7
+"""
+Time rose_stash_manipulate.process_config_file_stashmean on a large synthetic
+suite config against the implementation it replaced, and check that both give
+the same streq values.
+
+Needs rose, from the paths rose_stash_manipulate adds to sys.path.
+
+    python benchmarks/bench_stashmean.py [streq_sections]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import rose_stash_manipulate
+from rose_stash_manipulate import STASH_SECTION_BASES
+
+DEFAULT_SECTIONS = 20000
+
+TIM_NAMES = ('TDMPMN', 'T6HDMPM', 'TMPMN03', 'TMPMN24', 'TRADDM', 'T90DAY',
+             'TSTEPGI', 'TDAYM', 'TDAYMIN', 'TMONMN', 'T3HR')
+USE_NAMES = ('UPMEAN', 'UPJ', 'UPA', 'UP5')
+DOM_NAMES = ('DIAG', 'DP36CCM', 'DTILE')
+PACKAGES = ('', 'UKCA', 'EASYAEROSOL', 'STD_GA7')
+
+
+def stashmean_before(config):
+    """
+    process_config_file_stashmean as it was before the rule table, less the
+    tagging of duplicates that find_duplicate_streq now does separately
+    """
+    rsm = rose_stash_manipulate
+    for key, data in config.walk():
+        section = key[0]
+        if len(key) == 1:
+            retxt = re.search(r"namelist:(?P<name>\w+)\((?P<num>[0-9_a-zA-Z]+)", key[0])
+            for section_base in STASH_SECTION_BASES:
+                if (section.startswith(section_base) and
+                            'domain_nml' not in section):
+                    nl = retxt.group('name')
+                    profile = rsm.assign_profile(nl, data)
+                    for profile_key, profile_value in profile.iterate():
+                        if profile_key == 'name':
+                            stashname = profile_value
+
+                    if nl == 'streq':
+                        if 'TDMPMN' in config.value[key[0]].value['tim_name'].value:
+                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
+                                config.value[key[0]].value['tim_name'].value = "'TMONMN'"
+                                if 'UKCA' in config.value[key[0]].value['package'].value or \
+                                'EASYA' in config.value[key[0]].value['package'].value:
+                                    config.value[key[0]].value['use_name'].value = "'UP3'"
+                                else:
+                                    if (config.value[key[0]].value['isec'].value == '30'
+                                            or 'Dust' in stashname):
+                                        config.value[key[0]].value['use_name'].value = "'UP2'"
+                                    else:
+                                        config.value[key[0]].value['use_name'].value = "'UP1'"
+                        if 'T6HDMPM' in config.value[key[0]].value['tim_name'].value:
+                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
+                                config.value[key[0]].value['tim_name'].value = "'T6HMONM'"
+                                if ((config.value[key[0]].value['isec'].value == '30')
+                                        or ('Dust' in stashname)):
+                                    config.value[key[0]].value['use_name'].value = "'UP2'"
+                                else:
+                                    config.value[key[0]].value['use_name'].value = "'UP1'"
+                        if 'TMPMN' in config.value[key[0]].value['tim_name'].value:
+                            config.value[key[0]].value['package'].value = "'DIURNAL'"
+                            period = config.value[key[0]].value['tim_name'].value[-3:-1]
+                            config.value[key[0]].value['tim_name'].value = "'TMONMN" + period + "'"
+                            config.value[key[0]].value['use_name'].value = "'UPK'"
+                        if 'TRADDM' in config.value[key[0]].value['tim_name'].value:
+                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
+                                config.value[key[0]].value['tim_name'].value = "'TRADMONM'"
+                                config.value[key[0]].value['use_name'].value = "'UP1'"
+                        if 'T90DAY' in config.value[key[0]].value['tim_name'].value:
+                            config.value[key[0]].value['tim_name'].value = "'T30DAY'"
+                            config.value[key[0]].value['use_name'].value = "'UPU'"
+                        if 'TSTEPGI' in config.value[key[0]].value['tim_name'].value:
+                            config.value[key[0]].value['use_name'].value = "'UPT'"
+                            config.value[key[0]].value['package'].value = "'TSTEP_STD_GA7'"
+                        if config.value[key[0]].value['package'].value == "''":
+                            config.value[key[0]].value['package'].value = "'STD_GA7'"
+
+
+def suite_config(sections, seed=0):
+    """Return a config of sections random streq namelists, and profiles"""
+    rose = rose_stash_manipulate.rose
+    rand = random.Random(seed)
+    config = rose.config.ConfigNode()
+    for index in range(sections):
+        section = 'namelist:streq({:05d}_{:08x})'.format(index % 100000,
+                                                        index)
+        isec = rand.choice(('0', '2', '3', '30', '34'))
+        for option, value in (
+                ('dom_name', "'{}'".format(rand.choice(DOM_NAMES))),
+                ('isec', isec), ('item', str(rand.randint(1, 999))),
+                ('package', "'{}'".format(rand.choice(PACKAGES))),
+                ('tim_name', "'{}'".format(rand.choice(TIM_NAMES))),
+                ('use_name', "'{}'".format(rand.choice(USE_NAMES)))):
+            config.set(keys=[section, option], value=value)
+    for index in range(sections // 20):
+        for base, option in (('time', 'tim_name'), ('use', 'use_name'),
+                             ('domain', 'dom_name')):
+            config.set(keys=['namelist:{}({})'.format(base, index), option],
+                       value="'P{}'".format(index))
+    return config
+
+
+def streq_values(config):
+    return sorted((section, option, node.value)
+                  for section, section_node in config.value.items()
+                  if section.startswith('namelist:streq(')
+                  for option, node in section_node.value.items())
+
+
+def main(sections):
+    # stands in for the STASHmaster lookup the script builds
+    rose_stash_manipulate.stash_lookup = {
+        '3': dict((str(item), {'name': 'Dust {}'.format(item)})
+                  for item in range(1, 1000, 7))}
+    print '{} streq sections'.format(sections)
+    results = {}
+    for name, process in (
+            ('before', stashmean_before),
+            ('rule table', lambda config: (
+                rose_stash_manipulate.process_config_file_stashmean(
+                    config, rose_stash_manipulate.stash_lookup)))):
+        config = suite_config(sections)
+        start = time.time()
+        process(config)
+        elapsed = time.time() - start
+        results[name] = streq_values(config)
+        print '{:<11} {:>7.2f} s {:>7.1f} us/section'.format(
+            name, elapsed, elapsed / sections * 1e6)
+    print 'same values: {}'.format(results['before'] == results['rule table'])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SECTIONS)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python2.7
+"""
+Time the per request cost of putting a STASH request into a copy of the streq
+template, as rose_stash_manipulate.work does for every requested diagnostic:
+by loading the template file for each request (as work used to) and by
+cloning a rose_stash_manipulate.ConfigPrototype loaded once.
+
+Needs rose, from the paths rose_stash_manipulate adds to sys.path.
+
+    python benchmarks/bench_streq_insertion.py [requests [template.conf]]
+
+Without a template file a streq template like the suite's is written to a
+temporary file.
+"""
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import rose_stash_manipulate
+
+DEFAULT_REQUESTS = 2000
+
+TEMPLATE = """[namelist:streq(00000_00000000)]
+dom_name='DIAG'
+isec=0
+item=0
+package=''
+tim_name='TMONMN'
+use_name='UPMEAN'
+"""
+
+
+def stash_codes(requests):
+    """Return requests distinct STASH requests to insert"""
+    return [{'section': '{:02d}'.format(index % 35),
+             'item': '{:03d}'.format(index % 997),
+             'dom_name': 'DIAG', 'tim_name': 'TMONMN', 'use_name': 'UP5',
+             'package': 'PRIMAVERA', 'cmor': 'var{}'.format(index)}
+            for index in range(requests)]
+
+
+def insert_loading(template_file, codes):
+    """Load the template for each request, as work used to"""
+    rose = rose_stash_manipulate.rose
+    index_cache = rose_stash_manipulate.SectionIndexCache()
+    for code in codes:
+        config_tmp = copy.copy(rose.config.load(template_file))
+        rose_stash_manipulate.put_stash_into_config(config_tmp, code,
+                                                    index_cache)
+
+
+def insert_cloning(template_file, codes):
+    """Load the template once and clone it for each request"""
+    template = rose_stash_manipulate.ConfigPrototype.load(template_file)
+    index_cache = rose_stash_manipulate.SectionIndexCache()
+    for code in codes:
+        rose_stash_manipulate.put_stash_into_config(template.clone(), code,
+                                                    index_cache)
+
+
+def main(requests, template_file=None):
+    root = tempfile.mkdtemp()
+    try:
+        if template_file is None:
+            template_file = os.path.join(root, 'streq_template.conf')
+            with open(template_file, 'w') as fout:
+                fout.write(TEMPLATE)
+        codes = stash_codes(requests)
+        print '{} requests'.format(requests)
+        for name, insert in (('load per request', insert_loading),
+                             ('clone per request', insert_cloning)):
+            start = time.time()
+            insert(template_file, codes)
+            elapsed = time.time() - start
+            print '{:<18} {:>7.2f} s {:>8.1f} us/request'.format(
+                name, elapsed, elapsed / requests * 1e6)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_REQUESTS,
+         sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python2.7
+"""
+Compare the attribute access time and size of the slotted VariableEntry,
+MipTableVariableEntry and MappingExpression records of variables_parsing with
+the dictionary backed classes they replaced.
+
+    python benchmarks/bench_variable_records.py [records [repeats]]
+
+Access times are for reading the attributes the joins use (published, mip_id,
+short_mip_id, stash_mapping and so on) from every record; sizes count the
+object and its attribute dictionaries, not the shared values.
+"""
+import os
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import variables_parsing
+
+DEFAULT_RECORDS = 20000
+DEFAULT_REPEATS = 20
+
+MAPPING_ROW = {'': '', '  published  ': ' CMIP5 (Amon, tas{}) ',
+               '  stash mapping  ': ' m01s03i236 ', '  um version  ': '>= 6.6',
+               '  units  ': ' K ', '  positive  ': '', '  comment  ': ' c ',
+               '  notes  ': '', '  owner  ': ' me '}
+
+
+class _DictAttrs(object):
+    def __getattr__(self, attname):
+        if attname not in self._attdict:
+            raise AttributeError('Attribute not found: {}'.format(attname))
+        return self._attdict[attname]
+
+
+class DictVariableEntry(_DictAttrs):
+    """The VariableEntry before __slots__"""
+
+    def __init__(self, fname, section, attdict):
+        self.stream = fname
+        clean_section = section.split('_')[0]
+        self.mip_id = variables_parsing.mip_id(attdict['miptable'],
+                                               clean_section)
+        self.published = attdict.setdefault(
+            'mapping_id', "{} ({}, {})".format(*self.mip_id.split('_')))
+        self._attdict = attdict
+
+
+class DictMappingExpression(_DictAttrs):
+    """The MappingExpression before __slots__"""
+
+    _TRANS = string.maketrans(' ', '_')
+
+    def __init__(self, adict):
+        adict.pop('')
+        self._attdict = {k[2:-2].translate(self._TRANS).lower(): v.strip()
+                         for k, v in adict.iteritems()}
+        self._predicate = None
+
+
+class DictMipTableVariableEntry(_DictAttrs):
+    """The MipTableVariableEntry before __slots__"""
+
+    def __init__(self, table_name, entry, adict):
+        self.entry = entry
+        self.table = table_name.split('_')[1]
+        self.table_name = table_name
+        self.mip_id = variables_parsing.mip_id(table_name, entry)
+        self.short_mip_id = variables_parsing.mip_id(self.table, self.entry)
+        self.variable = None
+        for attname in ('positive', 'cell_methods'):
+            adict.setdefault(attname, '')
+        self._attdict = adict
+
+
+RECORDS = {
+    'dict': (DictVariableEntry, DictMappingExpression,
+             DictMipTableVariableEntry),
+    'slots': (variables_parsing.VariableEntry,
+              variables_parsing.MappingExpression,
+              variables_parsing.MipTableVariableEntry)}
+
+
+def build(record_name, records):
+    """Return lists of each record type, and the time to build them"""
+    variable_class, expression_class, table_class = RECORDS[record_name]
+    start = time.time()
+    expressions = [expression_class(dict((k, v.format(index))
+                                         for k, v in MAPPING_ROW.items()))
+                   for index in range(records)]
+    variables = []
+    for index in range(records):
+        variable = variable_class('apm', 'tas{}'.format(index),
+                                  {'miptable': 'CMIP5_Amon', 'lbproc': '128'})
+        variable.stash_mapping = 'm01s03i236'
+        variable.units = 'K'
+        variables.append(variable)
+    entries = [table_class('CMIP5_Amon', 'tas{}'.format(index),
+                           {'modeling_realm': 'atmos', 'units': 'K'})
+               for index in range(records)]
+    return (variables, expressions, entries), time.time() - start
+
+
+def access(lists, repeats):
+    """Return the time to read the join attributes of every record"""
+    variables, expressions, entries = lists
+    start = time.time()
+    for _ in range(repeats):
+        for variable in variables:
+            variable.published, variable.mip_id, variable.stash_mapping
+        for expression in expressions:
+            (expression.published, expression.stash_mapping,
+             expression.units, expression.um_version)
+        for entry in entries:
+            entry.mip_id, entry.short_mip_id, entry.table
+    return time.time() - start
+
+
+def record_bytes(record):
+    """Return the size of a record and of its attribute dictionaries"""
+    size = sys.getsizeof(record) + sys.getsizeof(record._attdict)
+    if hasattr(record, '__dict__'):
+        size += sys.getsizeof(record.__dict__)
+    return size
+
+
+def main(records, repeats):
+    print '{} records of each type, {} repeats'.format(records, repeats)
+    for record_name in ('dict', 'slots'):
+        lists, build_time = build(record_name, records)
+        access_time = access(lists, repeats)
+        sizes = ' '.join('{:>4d}'.format(record_bytes(records_of_type[0]))
+                         for records_of_type in lists)
+        print ('{:<6} build {:>6.2f} s  access {:>6.2f} s  bytes/record '
+               '(variable expression table) {}'.format(
+                   record_name, build_time, access_time, sizes))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_RECORDS,
+         int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REPEATS)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python2.7
+"""
+Parse CF cell_methods strings, without needing iris.
+
+The grammar is the one used by iris.fileformats.netcdf.parse_cell_methods:
+one or more "name:" coordinates, a method (which may carry "within", "over"
+or "where" qualifiers) and an optional parenthesised extra part holding
+"interval:" and "comment:" fields.
+
+The data request only has a few dozen distinct cell_methods, so the parsed
+results are memoized on the raw string in a bounded least recently used cache.
+"""
+import collections
+import functools
+import itertools
+import re
+
+# maximum number of distinct cell_methods strings kept by parse_cell_methods
+CACHE_SIZE = 256
+
+CellMethod = collections.namedtuple('CellMethod',
+                                    'method coord_names intervals comments')
+
+_CM_PARSE = re.compile(r'''
+                           (?P<name>([\w_]+\s*?:\s+)+)
+                           (?P<method>[\w_\s]+(?![\w_]*\s*?:))\s*
+                           (?:
+                               \(\s*
+                               (?P<extra>[^\)]+)
+                               \)\s*
+                           )?
+                       ''', re.VERBOSE)
+_CM_EXTRA_FIELD = re.compile(r'(interval|comment):')
+
+
+def lru_memoize(maxsize):
+    """
+    Decorator memoizing a function of one hashable argument, keeping at most
+    maxsize results. The least recently used result is dropped first.
+
+    Example
+    -------
+    >>> @lru_memoize(2)
+    ... def double(value):
+    ...     print 'computing', value
+    ...     return value * 2
+    >>> double(1), double(1)
+    computing 1
+    (2, 2)
+    >>> double(2), double(3), double(1)
+    computing 2
+    computing 3
+    computing 1
+    (4, 6, 2)
+    """
+    def decorator(func):
+        cache = {}
+        # the call count when each key was last used; only scanned to evict,
+        # which keeps cache hits down to a couple of dictionary operations
+        last_used = {}
+        calls = itertools.count()
+
+        @functools.wraps(func)
+        def wrapper(key):
+            try:
+                value = cache[key]
+            except KeyError:
+                value = func(key)
+                if len(cache) >= maxsize:
+                    oldest = min(last_used, key=last_used.get)
+                    del cache[oldest]
+                    del last_used[oldest]
+                cache[key] = value
+            last_used[key] = next(calls)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def _parse_extra(extra):
+    """
+    Split the parenthesised part of a cell method into its intervals and
+    comments. Text that is not in a labelled field is a comment.
+    """
+    intervals = []
+    comments = []
+    fields = _CM_EXTRA_FIELD.split(extra)
+    if len(fields) == 1:
+        comments.append(extra)
+    else:
+        leading = fields[0].strip()
+        if leading:
+            comments.append(leading)
+        for label, text in zip(fields[1::2], fields[2::2]):
+            if label == 'interval':
+                intervals.append(text.strip())
+            else:
+                comments.append(text.strip())
+    return tuple(intervals), tuple(comments)
+
+
+@lru_memoize(CACHE_SIZE)
+def parse_cell_methods(cell_methods):
+    """
+    Return a tuple of CellMethod for a cell_methods string.
+
+    Examples
+    --------
+    >>> parse_cell_methods('time: mean')
+    (CellMethod(method='mean', coord_names=('time',), intervals=(), comments=()),)
+
+    >>> [cm.coord_names for cm in parse_cell_methods('area: time: mean')]
+    [('area', 'time')]
+
+    >>> [cm.method for cm in parse_cell_methods(
+    ...     'time: minimum within days time: mean over days')]
+    ['minimum within days', 'mean over days']
+
+    >>> parse_cell_methods('time: mean where cloud')[0].method
+    'mean where cloud'
+
+    >>> parse_cell_methods('time: mean (interval: 1 hr comment: sampled)')
+    (CellMethod(method='mean', coord_names=('time',), intervals=('1 hr',), comments=('sampled',)),)
+
+    >>> parse_cell_methods('time: point (instantaneous)')[0].comments
+    ('instantaneous',)
+
+    A colon must be followed by white space, so these are not cell methods:
+    >>> parse_cell_methods('longitude:mean')
+    ()
+    >>> parse_cell_methods(None)
+    ()
+    """
+    result = []
+    if cell_methods is None:
+        return ()
+    for match in _CM_PARSE.finditer(cell_methods):
+        name = match.group('name').replace(' ', '').rstrip(':')
+        extra = match.group('extra')
+        if extra is None:
+            intervals, comments = (), ()
+        else:
+            intervals, comments = _parse_extra(extra)
+        result.append(CellMethod(match.group('method').strip(),
+                                 tuple(name.split(':')),
+                                 intervals, comments))
+    return tuple(result)
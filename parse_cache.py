@@ -0,0 +1,162 @@
+#!/usr/bin/env python2.7
+"""
+A persistent on-disk cache for the results of parsing input files.
+
+Entries are keyed on the content of the file they were derived from (see
+file_digest), so a cache entry is reused for as long as the input is
+unchanged, whatever its path or revision. Where hashing the content is too
+slow, file_stat_key keys an entry on the path, size and modification time of
+the file instead. Values are stored with marshal and compressed with zlib,
+so they must be built from the basic types only (None, bool, numbers,
+strings, tuples, lists and dicts).
+
+The cache directory is bounded in size; when it grows past max_bytes the
+least recently used entries are removed.
+
+Example
+-------
+>>> import shutil, tempfile
+>>> cache_dir = tempfile.mkdtemp()
+>>> cache = ParseCache(cache_dir, max_bytes=1024 * 1024)
+>>> cache.get('abc') is None
+True
+>>> cache.put('abc', {'tas': [1, 2, None]})
+>>> cache.get('abc')
+{'tas': [1, 2, None]}
+>>> shutil.rmtree(cache_dir)
+"""
+import errno
+import hashlib
+import marshal
+import os
+import tempfile
+import zlib
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'mip_request')
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# bump this if the on-disk layout changes
+_MAGIC = 'MIPRQC01'
+_SUFFIX = '.cache'
+
+
+def file_digest(filename, blocksize=1024 * 1024):
+    """Return the SHA-1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fin:
+        for block in iter(lambda: fin.read(blocksize), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stat_key(prefix, filename):
+    """
+    Return a cache key for the parsed content of a file from its absolute
+    path, size and modification time, which is cheaper than file_digest on
+    slow file systems.
+    """
+    stat = os.stat(filename)
+    digest = hashlib.sha1('{}\0{}\0{!r}'.format(os.path.abspath(filename),
+                                                 stat.st_size, stat.st_mtime))
+    return '{}-{}'.format(prefix, digest.hexdigest())
+
+
+class ParseCache(object):
+    """
+    Size bounded cache of parsed values, stored as one file per key in
+    cache_dir.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + _SUFFIX)
+
+    def get(self, key):
+        """Return the value stored for key, or None if there isn't one."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fin:
+                data = fin.read()
+        except IOError:
+            return None
+        if not data.startswith(_MAGIC):
+            return None
+        try:
+            value = marshal.loads(zlib.decompress(data[len(_MAGIC):]))
+        except (ValueError, EOFError, TypeError, zlib.error):
+            return None
+        # mark as recently used for the eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value, evict=True):
+        """
+        Store value for key, then evict old entries if the cache has grown
+        too large. Values that cannot be marshalled are not stored.
+
+        When storing many entries pass evict=False and call evict once
+        afterwards.
+        """
+        try:
+            data = _MAGIC + zlib.compress(marshal.dumps(value, 2))
+        except ValueError:
+            return
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        # write to a temporary file then rename, so that a concurrent reader
+        # never sees a partial entry
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            with os.fdopen(handle, 'wb') as fout:
+                fout.write(data)
+            os.rename(tmp_path, self._path(key))
+        except:
+            # don't leave the partial entry behind, evict never sees it
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if evict:
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is no larger
+        than max_bytes. The entry for keep is never removed.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(_SUFFIX):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        keep_path = None if keep is None else self._path(keep)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -24,12 +24,22 @@ Issues and exceptions
     Unique mokey to stash mapping - yes, apart from pressure level
     instantaneous (no heaviside needed) vs time mean (heaviside needed)
 """
+import collections
 import ConfigParser
 import copy
+import hashlib
 import json
+import logging
+import multiprocessing
 import re
 
-import iris
+import cell_methods
+import parse_cache
+import request_logging
+import stash_rules
+
+logger = request_logging.get_logger(__name__)
+diagnostics = request_logging.get_diagnostics(__name__)
 
 POSSIBLE_FREQ = ['mon', 'day', '6hr', '3hr', '1hr', 'subhr']
 
@@ -47,6 +57,25 @@ USAGE = {'amon': 'UP4',
 sheets_to_skip = ['Oclim', 'fx']
 latest_umversion = '10.4'
 
+# columns of the data request worksheets that are used to derive the STASH
+# requests
+SHEET_COLUMNS = {'cmip6_priority': 'A',
+                 'cmor_unit': 'C',
+                 'variable': 'F',
+                 'cell_method': 'H',
+                 'dim_key': 'K',
+                 'cmor': 'L',
+                 'realm': 'M',
+                 'time': 'N',
+                 'unique': 'S',
+                 'mo_priority': 'AG',
+                 'stash': 'AI'}
+
+# dictionaries accumulated over all sheets from the results of process_sheet
+SHEET_RESULTS = ('stash_dict', 'ocean_seaice_dict', 'stash_undef',
+                 'stash_not_wanted', 'key_dict_all', 'cmor_units',
+                 'cmor_stash_mapping')
+
 
 def time_method(cell_method):
     """
@@ -86,8 +115,7 @@ def time_method(cell_method):
         return result
     
     result = ''
-    cell_methods = iris.fileformats.netcdf.parse_cell_methods(cell_method)
-    for cell_meth in cell_methods:
+    for cell_meth in cell_methods.parse_cell_methods(cell_method):
         if _inner_time(cell_meth):
             result = _parse_method(cell_meth.method)
                 
@@ -101,14 +129,12 @@ def clean_dims(dimension_name):
     return tmp
 
 
-def process_range(value_processor, cell_range):
+def process_values(value_processor, values):
     """
-    apply processor to cell_range supplied returning a list of processed values
+    apply processor to the column of cell values supplied returning a list of
+    processed values
     """
-    results = []
-    for cell in cell_range:
-        results.append(value_processor(cell[0].value))
-    return results
+    return [value_processor(value) for value in values]
 
 
 def dimension_processor(value):
@@ -180,70 +206,129 @@ def metoffice_processor(value):
     return str(value)
 
 
-def derive_variable_priority(ws, cmip6_priority_col, mo_priority_col, max_row):
+# priority keys for the Met Office priorities that don't depend on the CMIP6
+# priority, when both priorities are set
+MO_PRIORITY_KEYS = {
+    'UM:1': 'MO_PR1',
+    'UM:2': 'MO_PR2',
+    'NEMO:1': 'MO_NEMO1',
+    'CICE:1': 'MO_CICE1',
+    'JULES:1': 'MO_JULES1',
+    'CICE:1 & JULES:1': 'MO_JULCIC1',
+    'LIMITED': 'PRIM_LTD',
+    'CHECK': 'MO_CHECK',
+    'ANCIL': 'FROM_ANCIL',
+}
+
+
+def unique_values(values):
+    """
+    return the distinct values in the order they first appear
+
+    >>> unique_values(['UM:1', 'None', 'UM:1', 'CHECK'])
+    ['UM:1', 'None', 'CHECK']
+    """
+    seen = set()
+    unique = []
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+    return unique
+
+
+def combine_priority(cmip6_pr, mo_pr):
+    """
+    return the priority key for a CMIP6 and a Met Office priority, and
+    whether they could be combined. If they couldn't, the key is the CMIP6
+    priority.
+
+    >>> combine_priority('None', 'None')
+    ('None', True)
+    >>> combine_priority('None', 'UM:1')
+    ('UM:1', True)
+    >>> combine_priority('2', 'None')
+    ('HRMIP_2', True)
+    >>> combine_priority('2', 'UM:1')
+    ('MO_PR1', True)
+    >>> combine_priority('3', 'False')
+    ('MO_NO_CMIP_3', True)
+    >>> combine_priority('1', 'please check')
+    ('MO_RECHECK', True)
+    >>> combine_priority('1', '2'), combine_priority('2', '1')
+    (('1_CMIP_OVER_MO', True), ('1_MO_OVER_CMIP', True))
+    >>> combine_priority('1', '1'), combine_priority('1', 'maybe')
+    (('1', True), ('1', False))
+    """
+    if cmip6_pr == 'None':
+        return mo_pr, True
+    if mo_pr == 'None':
+        return 'HRMIP_'+cmip6_pr[:1], True
+    try:
+        return MO_PRIORITY_KEYS[mo_pr], True
+    except KeyError:
+        pass
+    if mo_pr == 'False':
+        return 'MO_NO_CMIP_'+cmip6_pr, True
+    if 'check' in mo_pr:
+        return 'MO_RECHECK', True
+    try:
+        if int(cmip6_pr) < int(mo_pr):
+            return '1_CMIP_OVER_MO', True
+        elif int(mo_pr) < int(cmip6_pr):
+            return '1_MO_OVER_CMIP', True
+    except ValueError:
+        return cmip6_pr, False
+    return cmip6_pr, True
+
+
+def derive_variable_priority(cmip6_priority_values, mo_priority_values,
+                             dbg=False):
     """
     derive the priority of variables in sheet by comparing cmip6 and Met Office
     priorities
+
+    cmip6_priority_values - cell values of the CMIP6 priority column
+    mo_priority_values - cell values of the Met Office priority column
+
+    Each distinct pair of priorities is combined once, then the results are
+    mapped over the columns.
+
+    >>> derive_variable_priority([1, 2, None, 3], ['UM:1', None, 'NEMO:1', 2])
+    ['MO_PR1', 'HRMIP_2', 'NEMO:1', '1_MO_OVER_CMIP']
+
+    The dbg argument logs the priority columns at debug level and reports
+    priorities that cannot be compared as diagnostics:
+    >>> import sys
+    >>> request_logging.enable_diagnostics(sys.stdout)
+    >>> derive_variable_priority([1], ['x'], dbg=True)
+    {"cmip6_priority": "1", "event": "priority_not_comparable", "mo_priority": "x", "module": "process_spreadsheet"}
+    ['1']
+    >>> request_logging.disable_diagnostics()
     """
     # CMIP6 priority key
-    cmip6_priority_key = process_range(priority_processor, ws[
-        cmip6_priority_col + "2:" + cmip6_priority_col + "%i" % max_row])
+    cmip6_priority_key = process_values(priority_processor,
+                                        cmip6_priority_values)
     # Met Office producing key
-    mo_priority_key = process_range(metoffice_processor, ws[
-        mo_priority_col + "2:" + mo_priority_col + "%i" % max_row])
-
-    # jseddon: the next lines could be replaced by a set, but this changes some
-    # of the output from the software and so it has been left as it is.
-    mo_unique_key = []
-    [mo_unique_key.append(item) for item in mo_priority_key
-     if item not in mo_unique_key]
-    print 'mo_unique_priorities ', mo_unique_key
-
-    priority_key = copy.copy(cmip6_priority_key)
-
-    for ip, (cmip6_pr, mo_pr) in enumerate(
-            zip(cmip6_priority_key, mo_priority_key)):
-        if cmip6_pr == 'None' and mo_pr == 'None':
-            priority_key[ip] = 'None'
-        elif cmip6_pr == 'None' and mo_pr != 'None':
-            priority_key[ip] = mo_pr
-        elif cmip6_pr != 'None' and mo_pr == 'None':
-            priority_key[ip] = 'HRMIP_'+cmip6_pr[:1]
-        elif mo_pr == 'UM:1':
-            priority_key[ip] = 'MO_PR1'
-        elif mo_pr == 'UM:2':
-            priority_key[ip] = 'MO_PR2'
-        elif mo_pr == 'NEMO:1':
-            priority_key[ip] = 'MO_NEMO1'
-        elif mo_pr == 'CICE:1':
-            priority_key[ip] = 'MO_CICE1'
-        elif mo_pr == 'JULES:1':
-            priority_key[ip] = 'MO_JULES1'
-        elif mo_pr == 'CICE:1 & JULES:1':
-            priority_key[ip] = 'MO_JULCIC1'
-        elif mo_pr == 'LIMITED':
-            priority_key[ip] = 'PRIM_LTD'
-        elif mo_pr == 'False':
-            priority_key[ip] = 'MO_NO_CMIP_'+cmip6_pr
-        elif mo_pr == 'CHECK':
-            priority_key[ip] = 'MO_CHECK'
-        elif 'check' in mo_pr:
-            priority_key[ip] = 'MO_RECHECK'
-        elif mo_pr == 'ANCIL':
-            priority_key[ip] = 'FROM_ANCIL'
-        else:
-            try:
-                if int(cmip6_pr) < int(mo_pr):
-                    priority_key[ip] = '1_CMIP_OVER_MO'
-                elif int(mo_pr) < int(cmip6_pr):
-                    priority_key[ip] = '1_MO_OVER_CMIP'
-            except:
-                print ('value of  cmip6_pr or mo_pr cannot convert to '
-                       'integer  {} {}'.format(cmip6_pr, mo_pr))
-
-    print 'cmip6_priority ', cmip6_priority_key
-    print 'mo_priority ', mo_priority_key
-    print 'priority ', priority_key
+    mo_priority_key = process_values(metoffice_processor, mo_priority_values)
+
+    if dbg and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('mo_unique_priorities %s', unique_values(mo_priority_key))
+
+    pairs = zip(cmip6_priority_key, mo_priority_key)
+    combined = dict((pair, combine_priority(*pair)) for pair in set(pairs))
+    priority_key = []
+    for pair in pairs:
+        key, combines = combined[pair]
+        if not combines and dbg:
+            diagnostics.emit('priority_not_comparable', cmip6_priority=pair[0],
+                             mo_priority=pair[1])
+        priority_key.append(key)
+
+    if dbg:
+        logger.debug('cmip6_priority %s', cmip6_priority_key)
+        logger.debug('mo_priority %s', mo_priority_key)
+        logger.debug('priority %s', priority_key)
     return priority_key
 
 
@@ -283,9 +368,9 @@ def _derive_time(method, period):
 
     if period == 'hr': #Data request inconsistent on hr and 1hr
         period = '1hr'
-    if time_method(method) != '':
+    meth = time_method(method)
+    if meth != '':
         try:
-            meth = time_method(method)
             tfmt, lbproc = time_map[meth]
             tprof = tfmt.format(period.upper())
         except KeyError:
@@ -336,17 +421,20 @@ def derive_time_usage_profile(sheet_period, time_period, cell_method, dbg=True):
     >>> derive_time_usage_profile('mon', ['mon'], ['longitude: mean'], dbg=False)
     [('unknown', 'UP5', 0)]
 
-    The dbg argument turns on extra output:
+    The dbg argument reports unknown profiles as diagnostics:
+    >>> import sys
+    >>> request_logging.enable_diagnostics(sys.stdout)
     >>> derive_time_usage_profile('daily', ['daily'], ['time: point'], dbg=True)
-    DBG: can not infer usage profile "daily" "daily"
+    {"event": "unknown_usage_profile", "module": "process_spreadsheet", "period": "daily", "sheet_period": "daily"}
     [('TDAILY', 'UNKNOWN', 0)]
 
     >>> derive_time_usage_profile('mon', ['mon'], ['longitude: mean'], dbg=True)
-    DBG: can not infer time profile for method "longitude: mean"
+    {"cell_method": "longitude: mean", "event": "unknown_time_profile", "module": "process_spreadsheet"}
     [('unknown', 'UP5', 0)]
 
     >>> derive_time_usage_profile('mon', ['mon'], ['longitude: mean time: mean'], dbg=True)
     [('TMONMN', 'UP5', 128)]
+    >>> request_logging.disable_diagnostics()
 
     >>> derive_time_usage_profile('1hr', ['1hr'], ['time: point'], dbg=False)
     [('T1HR', 'UP9', 0)]
@@ -365,9 +453,10 @@ def derive_time_usage_profile(sheet_period, time_period, cell_method, dbg=True):
         tprof, lbproc = _derive_time(method, period)
         if dbg:
             if tprof.lower() == 'unknown':
-                print 'DBG: can not infer time profile for method "{}"'.format(method)
+                diagnostics.emit('unknown_time_profile', cell_method=method)
             if usage_profile.lower() == 'unknown':
-                print 'DBG: can not infer usage profile "{}" "{}"'.format(period, sheet_period.lower())
+                diagnostics.emit('unknown_usage_profile', period=period,
+                                 sheet_period=sheet_period.lower())
         profile.append((tprof, usage_profile, lbproc))
 
     return profile
@@ -406,10 +495,13 @@ def derive_domain_profile(dims, dbg=False):
     >>> derive_domain_profile(['time'])
     (['UNKNOWN'], [0])
     
-    Turning on the dbg prints an information message:
+    Turning on the dbg reports unknown domains as diagnostics:
+    >>> import sys
+    >>> request_logging.enable_diagnostics(sys.stdout)
     >>> derive_domain_profile(['time'], dbg=True)
-    DBG: cannot infer domain from dimensions "time"
+    {"dims": "time", "event": "unknown_domain_profile", "module": "process_spreadsheet"}
     (['UNKNOWN'], [0])
+    >>> request_logging.disable_diagnostics()
 
     """
     dprof = copy.copy(dims)
@@ -494,7 +586,7 @@ def derive_domain_profile(dims, dbg=False):
             dprof[index] = 'UNKNOWN'
         if dbg:
             if dprof[index].lower() == 'unknown':
-                print 'DBG: cannot infer domain from dimensions "{}"'.format(dims[index])
+                diagnostics.emit('unknown_domain_profile', dims=dims[index])
     
     return dprof, d_lbproc
 
@@ -509,19 +601,26 @@ def write_stash_dictionary(stash_in, filename):
     with open(filename, 'wb') as fout:
         fout.write('def stash requests() \n')
         for stash_profile in stash_in:
-            print stash_profile
-            print stash_in[stash_profile].items()
+            logger.debug('%s %s', stash_profile,
+                         stash_in[stash_profile].items())
             line = str(stash_in[stash_profile].items())
             fout.write(line + '\n')
 
 
+def _json_record(value):
+    """return the JSON form of the records that json doesn't know about"""
+    if isinstance(value, StashRequest):
+        return value.as_dict()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
 def write_stash_json(stash_in, filename):
     """
     write to file each stash request as derived from spreadsheet
     stash_in - list of dictionary stash profiles
     filename - output filename
     """
-    json.dump(stash_in, open(filename, 'w'), indent=2)
+    json.dump(stash_in, open(filename, 'w'), indent=2, default=_json_record)
 
 
 def write_unique_keys_as_dictionary(dim_key_unique, filename):
@@ -612,20 +711,18 @@ def write_cmor_stash_mapping_as_cfg(cmor_stash_map, filename):
                     fout.write('\n')
 
 
-def process_stash_translation(section_ws, mokey_col_name, stash_col_name,
-                              cmor_col_name, variable_col_name):
+def process_stash_translation(sheets):
     """
     return dictionary, with
     mokey_stash = unique_keys as key and stash_list as value
     cmorkey_stash = cmor name as key and stash as item
     Check for duplicate keys, and if found then check items are the same
-    section_ws - input sheets in workbook
+    sheets - list of (sheet title, columns) as returned by read_sheet_columns
     """
     mokey_stash = {}
     cmorkey_stash = {}
-    for ws in section_ws:
-        max_row = calc_max_occupied_rows(ws)
-        sheet_period = ws.title
+    for title, columns in sheets:
+        sheet_period = title
         # skip ocean/sea-ice diagnostics as they come from NEMO or CICE (hence
         # don't need STASH mapping)
         # aero is currently an issue - both before we figure out EasyAerosol,
@@ -635,56 +732,131 @@ def process_stash_translation(section_ws, mokey_col_name, stash_col_name,
         elif 'prim' in sheet_period:
             sheet_period = sheet_period[4:]
 
-        print 'sheet period in ', sheet_period
+        logger.debug('sheet period in %s', sheet_period)
         if sheet_period in sheets_to_skip:
-            print 'skip sheet ', sheet_period
+            logger.debug('skip sheet %s', sheet_period)
             continue
 
-        for cell_id, cell_st, cell_cmor, cell_var in zip(
-                ws[mokey_col_name + '2:' + mokey_col_name + '%i' % max_row],
-                ws[stash_col_name + '2:' + stash_col_name + '%i' % max_row],
-                ws[cmor_col_name + '2:' + cmor_col_name + '%i' % max_row],
-                ws[variable_col_name + '2:' + variable_col_name +
-                '%i' % max_row]):
-            
+        for cell_id, cell_st, cell_cmor, cell_var in zip(columns['unique'],
+                                                         columns['stash'],
+                                                         columns['cmor'],
+                                                         columns['variable']):
+
             # met office key (dimension profile + cmor name)
-            if cell_id[0].value not in mokey_stash.keys():
-                mokey_stash[cell_id[0].value] = cell_st[0].value
-            elif cell_id[0].value in mokey_stash.keys():
-                if mokey_stash[cell_id[0].value] != cell_st[0].value:
-                    print ('duplicate mokey but different item with different '
-                           'stash {} {} {}'.format(cell_id[0].value,
-                                           mokey_stash[cell_id[0].value],
-                                           cell_st[0].value))
+            if cell_id not in mokey_stash:
+                mokey_stash[cell_id] = cell_st
+            elif mokey_stash[cell_id] != cell_st:
+                diagnostics.emit('duplicate_mokey_different_stash',
+                                 mokey=cell_id, stash=mokey_stash[cell_id],
+                                 other_stash=cell_st)
 
             # cmor name key and stash as item
-            if cell_cmor[0].value not in cmorkey_stash.keys():
-                cmorkey_stash[cell_cmor[0].value] = cell_st[0].value
-            elif cell_cmor[0].value in cmorkey_stash.keys():
-                if cmorkey_stash[cell_cmor[0].value] != cell_st[0].value:
-                    print ('duplicate cmor with different stash  {} {} {}'.
-                           format(cell_cmor[0].value,
-                                  cmorkey_stash[cell_cmor[0].value],
-                                  cell_st[0].value))
-                    
-            if cell_var[0].value != cell_cmor[0].value:
-                if cell_var[0].value != None and cell_cmor[0].value != None:
-                    if cell_var[0].value not in cell_cmor[0].value:
+            if cell_cmor not in cmorkey_stash:
+                cmorkey_stash[cell_cmor] = cell_st
+            elif cmorkey_stash[cell_cmor] != cell_st:
+                diagnostics.emit('duplicate_cmor_different_stash',
+                                 cmor=cell_cmor, stash=cmorkey_stash[cell_cmor],
+                                 other_stash=cell_st)
+
+            if cell_var != cell_cmor:
+                if cell_var != None and cell_cmor != None:
+                    if cell_var not in cell_cmor:
                         # may be that cmor name includes levels number
-                        print ('cmor name and variable name disagree  {} {}'.
-                               format(cell_cmor[0].value, cell_var[0].value))
+                        diagnostics.emit('cmor_variable_name_mismatch',
+                                         cmor=cell_cmor, variable=cell_var)
 
     return mokey_stash, cmorkey_stash
 
 
-def calc_max_occupied_rows(ws):
-    """calculate the maximum number of occupied rows"""
-    for row_number, row in enumerate(ws.iter_rows()):
+def column_index(column_name):
+    """
+    Return the zero based index of a spreadsheet column letter.
+
+    Examples
+    --------
+    >>> column_index('A')
+    0
+    >>> column_index('AG')
+    32
+    """
+    index = 0
+    for letter in column_name.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def read_sheet_columns(ws, sheet_columns=None):
+    """
+    Walk the rows of a worksheet once, returning the sheet title and a
+    dictionary of the cell values in each of the columns in sheet_columns.
+
+    The header row is skipped and reading stops at the first completely empty
+    row. As with the ranges previously read with ws['X2:X<max_row>'], when the
+    sheet has no empty row the final row is not included.
+
+    ws - worksheet, possibly from a workbook loaded with use_iterators=True
+    sheet_columns - dictionary of column key to column letter, defaults to
+        SHEET_COLUMNS
+    """
+    if sheet_columns is None:
+        sheet_columns = SHEET_COLUMNS
+    indices = [(key, column_index(name))
+               for key, name in sheet_columns.items()]
+    columns = dict((key, []) for key in sheet_columns)
+
+    rows = ws.iter_rows()
+    next(rows, None)  # header
+    previous = None
+    for row_number, row in enumerate(rows, 1):
         values = [cell.value for cell in row]
+        if previous is not None:
+            for key, index in indices:
+                columns[key].append(previous[index]
+                                    if index < len(previous) else None)
         if not any(values):
-            print 'last row with data is {0}'.format(row_number)
+            logger.debug('last row with data is %d', row_number)
             break
-    return row_number
+        previous = values
+    return ws.title, columns
+
+
+def read_workbook_sheets(loaded_workbook):
+    """
+    Return read_sheet_columns for each data request worksheet of the workbook.
+
+    The first sheet is the Notes page, the last one is the fx page and neither
+    are read.
+    """
+    return [read_sheet_columns(ws) for ws in loaded_workbook.worksheets[1:-1]]
+
+
+def load_workbook_sheets(filename, cache=None, rebuild_cache=False):
+    """
+    Return read_workbook_sheets for the workbook in filename.
+
+    If a parse_cache.ParseCache is given the sheets are looked up there by the
+    content hash of the workbook, and openpyxl is only used if they are not
+    found (or rebuild_cache is set), in which case the cache is updated.
+    """
+    key = None
+    if cache is not None:
+        # the columns read are part of the key, so changing SHEET_COLUMNS
+        # does not pick up stale entries
+        columns = hashlib.sha1(repr(sorted(SHEET_COLUMNS.items())))
+        key = 'sheets-{}-{}'.format(parse_cache.file_digest(filename),
+                                    columns.hexdigest()[:8])
+        if not rebuild_cache:
+            sheets = cache.get(key)
+            if sheets is not None:
+                logger.info('data request sheets read from cache %s', key)
+                return sheets
+
+    import openpyxl
+    loaded_workbook = openpyxl.load_workbook(filename, use_iterators=True)
+    sheets = read_workbook_sheets(loaded_workbook)
+    if cache is not None:
+        cache.put(key, sheets)
+    return sheets
 
 
 def check_stash_dependencies(din, stash_lookup):
@@ -709,176 +881,152 @@ def check_stash_dependencies(din, stash_lookup):
     12. If domain is DALL??, check further - if WIND in name then should be DALLRH
     13. Check for duplicates in terms of subsets of levels with all other processing the same
     14. Stash 1241 and 1223 need DALLTH but CMIP has no indication of levels
+
+    The rules are in stash_rules.STASH_RULES; use
+    stash_rules.apply_stash_rules to check a batch of requests at once.
     """
-    section = din['section']
-    item = din['item']
-    section_lookup = str(int(section))
-    item_lookup = str(int(item))
-    try:
-        stashname = stash_lookup[section_lookup][item_lookup]['name']
-    except:
-        print 'this stashcode does not translate ', section_lookup, item_lookup
-        stashname = ''
-
-    if section == '02':
-        if int(item) in range(320, 391):
-            period = din['period']
-            print ('this is COSP diagnostic, need to mean using hourly data '
-                   'on radiation TS,  {}'.format(period))
-            if 'day' in period.lower():
-                din['tim_name'] = 'TRADDAYM'
-            elif 'mon' in period.lower():
-                din['tim_name'] = 'TRADMONM'
-            elif '6hr' in period.lower():
-                if din['tim_name'][-2:] != 'MN':
-                    din['tim_name'] = 'T6HR'
-                else:
-                    din['tim_name'] = 'TRAD6HRMN'
-            elif '3hr' in period.lower():
-                if din['tim_name'][-2:] != 'MN':
-                    din['tim_name'] = 'T3HR'
-                else:
-                    din['tim_name'] = 'TRAD3HRMN'
-            else:
-                din['tim_name'] = 'UNKNOWN'
-                
-            if 320 <= int(item) <= 327:
-                cosp_type = 'COSP_CAL'
-            elif 330 <= int(item) <= 337:
-                cosp_type = 'COSP_ISC'
-            elif 340 <= int(item) <= 347:
-                cosp_type = 'COSP_CAL'
-            elif int(item) == 348:
-                cosp_type = 'COSP_PAR'
-                din['dom_name'] = 'DCOSP_5'
-            elif 370 <= int(item) <= 371:
-                cosp_type = 'COSP_CAL40'
-            elif 372 <= int(item) <= 390:
-                cosp_type = 'COSP_CAL'
-            din['package'] = din['package'] + '_' + cosp_type
-            
-            if int(item) == 337:
-                print 'this is a histogram, need to do 7x7 domain'
-                din['dom_name'] = 'DCOSP7x7'
-
-    # If STASH diagnostic on TILES, then need to account for this in domain
-    # profile
-    if 'TILE' in stashname:
-        din['dom_name'] = 'DTILE'
-
-    # deal with soil levels
-    if 'SOIL' in stashname and din['dom_name'] == 'DIAG' and '8' in section:
-        din['dom_name'] = 'DSOIL'
-
-# for TEM STASH diagnostics, 30310-30317, can only have 1 set of levels - do not mix them else model
-# will fail. They are already zonal mean, so don't have that in the domain
-    if section == '30':
-        if int(item) in range(310, 317):
-            old_domain = din['dom_name']
-            if old_domain[-1] == 'Z':
-                din['dom_name'] = 'DP39CCM'
-#            if old_domain[-1] == 'Z':
-#                new_domain = 'DP36CCM'
-#            else:
-#                new_domain = 'DP36CCM'
-#            din['dom_name'] = new_domain
-
-#    if section == '02':
-#        if int(item) in range(217, 221):
-#            period = din['period']
-#            print ('this is radiation diagnostic, need to mean using hourly '
-#                   'data on radiation TS,  {}'.format(period))
-#            if 'day' in period.lower():
-#                din['tim_name'] = 'TRADDAYM'
-#            elif 'mon' in period.lower():
-#                din['tim_name'] = 'TRADMONM'
-#            else:
-#                din['tim_name'] = 'UNKNOWN'
-#            din['dom_name'] = 'DALLRHP1'
-
-    if 'LTD' in din['package']:
-        # make the domain Europe - if multi-level then use appropriate
-        domain = copy.copy(din['dom_name'])
-        if domain == 'RLEVEL3':
-            din['dom_name'] = 'DEUROPER3'
-        elif domain == 'RLEVEL2':
-            din['dom_name'] = 'DEUROPER2'
-        elif domain == 'DIAG':
-            din['dom_name'] = 'DEUROPE'
-        else:
-            raise Exception('No not recognise this domain for LTD package'
-                            + domain + str(din))
-
-    if 'PLEV' in din['dom_name'] and section != '30':
-        if (section != '06' and section != '16'):
-            print ('variable on pressure levels but not section 30  {} {}'.
-                   format(stashname, din))
-            din['package'] = 'NO_ALEV_PLEV'
-        elif section == '06:':
-            if 'P LEV' not in stashname:
-                din['package'] = 'NO_ALEV_PLEV'
-        elif section == '16':
-            if not (int(item) in range(202,206) or int(item) == '256'):
-                din['package'] = 'NO_ALEV_PLEV'
-        
-    if section == '30' and (item[0:1] == '2' or item[0:1] == '3'):
-        domain = copy.copy(din['dom_name'])
-        if domain == 'DIAG':
-            # can't have DIAG in pressure level diagnostics
-            # try to assume these are ua850, va850, ta850
+    stash_rules.apply_stash_rules([din], stash_lookup)
+
+
+# CMIP6 pressure level axes (Pa) of the domain profiles from
+# derive_domain_profile; a Z suffix is the zonal mean on the same levels
+PRESSURE_LEVEL_SETS = {
+    'PLEV3': (85000, 50000, 25000),
+    'PLEV4': (92500, 85000, 50000, 25000),
+    'PLEV8': (100000, 85000, 70000, 50000, 25000, 10000, 5000, 1000),
+    'PLEV19': (100000, 92500, 85000, 70000, 60000, 50000, 40000, 30000,
+               25000, 20000, 15000, 10000, 7000, 5000, 3000, 2000, 1000, 500,
+               100),
+    'PLEV23': (100000, 92500, 85000, 70000, 60000, 50000, 40000, 30000,
+               25000, 20000, 15000, 10000, 7000, 5000, 3000, 2000, 1000, 700,
+               500, 300, 200, 100, 40),
+    'PLEV27': (100000, 97500, 95000, 92500, 90000, 87500, 85000, 82500,
+               80000, 77500, 75000, 70000, 65000, 60000, 55000, 50000, 45000,
+               40000, 35000, 30000, 25000, 22500, 20000, 17500, 15000, 12500,
+               10000),
+    'PLEV39': (100000, 92500, 85000, 70000, 60000, 50000, 40000, 30000,
+               25000, 20000, 17000, 15000, 13000, 11500, 10000, 9000, 8000,
+               7000, 5000, 3000, 2000, 1500, 1000, 700, 500, 300, 200, 150,
+               100, 70, 50, 40, 30, 20, 15, 10, 7, 5, 3),
+}
+# single pressure level domains, e.g. DP850 for 850 hPa
+_SINGLE_PRESSURE_LEVEL = re.compile(r'^DP([0-9]+)$')
+
+
+class LevelSetIndex(object):
+    """
+    Index of domain profiles to their pressure levels, held as bitsets so
+    that subsets can be found with a couple of integer operations.
+
+    >>> index = LevelSetIndex()
+    >>> index.levels('PLEV8')[0], index.levels('PLEV39Z')[0]
+    (False, True)
+    >>> index.is_subset('PLEV8', 'PLEV19'), index.is_subset('PLEV19', 'PLEV8')
+    (True, False)
+    >>> index.is_subset('DP850', 'PLEV4'), index.is_subset('DP700', 'PLEV4')
+    (True, False)
+    >>> index.is_subset('PLEV19', 'PLEV39Z'), index.levels('DIAG')
+    (False, None)
+    """
+    def __init__(self, level_sets=None):
+        if level_sets is None:
+            level_sets = PRESSURE_LEVEL_SETS
+        self.level_sets = level_sets
+        self._bits = {}
+        self._levels = {}
+
+    def _mask(self, levels):
+        mask = 0
+        for level in levels:
             try:
-                plevel = din['cmor'][-3:]
-                din['dom_name'] = 'DP'+plevel
-            except:
-                din['dom_name'] = 'UNKNOWN'
-                
-    if 'DALL' in din['dom_name']:
-        if 'WIND' in stashname:
-            print ('variable DALL but wind in name {} {}'.
-               format(stashname, din))
-            din['dom_name'] = 'DALLRH'                
-
-    if section == '01' and (item == '223' or item == '241'):
-        domain = copy.copy(din['dom_name'])
-        if domain == 'DIAG':
-            din['dom_name'] = 'DALLTH'                
-           
-    if section == '02' and (item == '308' or item == '309'):
-        domain = copy.copy(din['dom_name'])
-        if domain == 'DIAG':
-            din['dom_name'] = 'DALLTH'                
-           
-    if section == '00' and (item == '407' or item == '408'):
-        domain = copy.copy(din['dom_name'])
-        if domain == 'DIAG':
-            if item == '407':
-                din['dom_name'] = 'DALLRH'
-            elif item == '408':      
-                din['dom_name'] = 'DALLTH'                
-           
-    if section == '03' and (item == '471' or item == '472'):
-        domain = copy.copy(din['dom_name'])
-        if item == '471':
-            din['dom_name'] = 'D52TH'
-        elif item == '472':      
-            din['dom_name'] = 'D52RH'    
-            
-    if (section == '02' and item == '205') or (section == '03' and item == '332'):
-        domain = copy.copy(din['dom_name'])
-        if domain == 'DALLRH':
-            din['dom_name'] = 'DIAG'
-                        
-           
-def check_subset_of_levels(stash_dict):
+                bit = self._bits[level]
+            except KeyError:
+                bit = self._bits[level] = len(self._bits)
+            mask |= 1 << bit
+        return mask
+
+    def levels(self, dom_name):
+        """
+        return (zonal, bitset of levels) for a domain profile, or None if its
+        levels are not known
+        """
+        try:
+            return self._levels[dom_name]
+        except KeyError:
+            pass
+        result = None
+        match = _SINGLE_PRESSURE_LEVEL.match(dom_name)
+        if match and int(match.group(1)) > 0:
+            result = (False, self._mask([int(match.group(1)) * 100]))
+        elif dom_name in self.level_sets:
+            result = (False, self._mask(self.level_sets[dom_name]))
+        elif dom_name[-1:] == 'Z' and dom_name[:-1] in self.level_sets:
+            result = (True, self._mask(self.level_sets[dom_name[:-1]]))
+        self._levels[dom_name] = result
+        return result
+
+    def is_subset(self, dom_name, other_dom_name):
+        """return whether the levels of dom_name are all in other_dom_name"""
+        levels = self.levels(dom_name)
+        other_levels = self.levels(other_dom_name)
+        if levels is None or other_levels is None:
+            return False
+        return (levels[0] == other_levels[0] and
+                levels[1] & ~other_levels[1] == 0)
+
+
+def check_subset_of_levels(stash_dict, index=None):
     """
-    Would like to remove duplicate levels from same variable, processing, but it is complicated 
-    and need to know level set mapping etc
+    remove requests whose pressure levels are a subset of those of another
+    request for the same STASH code, time and usage profiles and package,
+    e.g. PLEV8 when there is also PLEV19
+
+    stash_dict - dictionary of stash requests, updated in place
+    index - LevelSetIndex to use for the domain profiles
+
+    return the dictionary of removed requests
+
+    >>> requests = {
+    ...     'a': {'section': '30', 'item': '201', 'dom_name': 'PLEV8',
+    ...           'tim_name': 'TDAYM', 'use_name': 'UP6', 'package': 'P1'},
+    ...     'b': {'section': '30', 'item': '201', 'dom_name': 'PLEV19',
+    ...           'tim_name': 'TDAYM', 'use_name': 'UP6', 'package': 'P1'},
+    ...     'c': {'section': '30', 'item': '201', 'dom_name': 'DP850',
+    ...           'tim_name': 'TMONM', 'use_name': 'UP5', 'package': 'P1'}}
+    >>> stash_subset = check_subset_of_levels(requests)
+    >>> sorted(stash_subset), sorted(requests)
+    (['a'], ['b', 'c'])
     """
-    # PLEV8 is a subset of PLEV23
-    # Get duplicated values for daily UP6:
-    # 30201, 30202, 
-    pass
-               
+    if index is None:
+        index = LevelSetIndex()
+
+    # requests that could be subsets of each other
+    groups = collections.defaultdict(list)
+    for order, (key, request) in enumerate(stash_dict.iteritems()):
+        levels = index.levels(request['dom_name'])
+        if levels is None:
+            continue
+        zonal, mask = levels
+        group_key = (request['section'], request['item'],
+                     request['tim_name'], request['use_name'],
+                     request['package'], zonal)
+        groups[group_key].append((-bin(mask).count('1'), order, key, mask))
+
+    stash_subset = {}
+    for group in groups.itervalues():
+        if len(group) < 2:
+            continue
+        # largest level sets first, so any superset has already been kept
+        kept = []
+        for _, _, key, mask in sorted(group):
+            if any(mask & ~kept_mask == 0 for kept_mask in kept):
+                stash_subset[key] = stash_dict.pop(key)
+                diagnostics.emit('subset_of_levels_removed', key=key,
+                                 request=stash_subset[key])
+            else:
+                kept.append(mask)
+    return stash_subset
+
 
 def lookup_cmip6_cmor_stash_translation(cmor_or_var_key, cmip6_file):
     """
@@ -905,31 +1053,418 @@ def work(loaded_workbook, stash_lookup, outdir, cmor_stash_cmip6_file):
     Try to translate the definition of the data request to a corresponding
     dictionary of STASH required variables
     """
-    cmip6_priority_col = 'A'
-    cmor_unit_col_name = 'C'
-    variable_col_name = 'F'
-    cell_method_name = 'H'
-    dim_key_name = 'K'
-    cmor_col_name = 'L'
-    realm_col_name = 'M'
-    time_col_name = 'N'
-    unique_col_name = 'S'
-    mo_priority_col = 'AG'
-    stash_col_name = 'AI'
-    # first sheet is the Notes page, last one is the fx page
-    section_ws = loaded_workbook.worksheets[1:-1]
-
-    unique_key, cmorkey_stash = process_stash_translation(section_ws,
-                                                          unique_col_name,
-                                                          stash_col_name,
-                                                          cmor_col_name,
-                                                          variable_col_name)
-
-    print 'max_row ', loaded_workbook.worksheets[1].max_row
-    print 'max_col ', loaded_workbook.worksheets[1].max_column
+    logger.info('max_row %s', loaded_workbook.worksheets[1].max_row)
+    logger.info('max_col %s', loaded_workbook.worksheets[1].max_column)
+
+    # each worksheet is walked once, reading all of the columns needed
+    sheets = read_workbook_sheets(loaded_workbook)
+    return process_sheets(sheets, stash_lookup, outdir, cmor_stash_cmip6_file)
+
+
+def stash_request(tim_name, use_name, cmip_dim, dom_name, priority, cmor,
+                  package, period, sheet_name, stash, item, section, lbproc):
+    """return the dictionary describing one STASH request"""
+    return {'tim_name': tim_name,
+            'use_name': use_name,
+            'cmip_dim': cmip_dim,
+            'dom_name': dom_name,
+            'priority': priority,
+            'cmor': cmor,
+            'package': package,
+            'period': period,
+            'sheet_name': sheet_name,
+            'stash': stash,
+            'item': item,
+            'section': section,
+            'lbproc': lbproc}
+
+
+_INTERNED = {}
+
+
+def _intern(value):
+    """
+    return the one shared copy of an equal byte or unicode string (openpyxl
+    gives unicode cell values, which intern does not take), leaving other
+    values (int, None) as they are
+    """
+    if isinstance(value, basestring):
+        return _INTERNED.setdefault((type(value), value), value)
+    return value
+
+
+class StashRequest(object):
+    """
+    One STASH request, as a compact record with the read only dictionary
+    methods (keys, items, get, in, iteration) and item assignment.
+
+    The profile names, packages and so on are repeated across thousands of
+    requests, so all string values are interned. The duplicate detection key
+    (see identity_key) is computed once and kept until a field is changed
+    through item assignment.
+
+    The JSON form (see as_dict and write_stash_json) is the dictionary
+    stash_request returns.
+
+    >>> request = StashRequest('TMONM', 'UP5', 'longitude-latitude-time',
+    ...                        'DIAG', 'MO_PR1', 'tas', 'MO_PR1', 'mon', 'Amon',
+    ...                        'm01s03i236', '236', '03', 0)
+    >>> request['dom_name'], request.identity_key()
+    ('DIAG', '03236DIAGTMONMUP5MO_PR1')
+    >>> request['dom_name'] = 'DTILE'
+    >>> request.identity_key()
+    '03236DTILETMONMUP5MO_PR1'
+    >>> request.as_dict() == stash_request(*request.values())
+    True
+    >>> request['name']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'name'
+    >>> 'name' in request, 'stash' in request, request.get('name', '')
+    (False, True, '')
+    >>> dict(request.items()) == request.as_dict() == dict(request)
+    True
+    >>> _intern(u'TMONM') is _intern(u''.join([u'TMON', u'M']))
+    True
+    """
+    FIELDS = ('tim_name', 'use_name', 'cmip_dim', 'dom_name', 'priority',
+              'cmor', 'package', 'period', 'sheet_name', 'stash', 'item',
+              'section', 'lbproc')
+    __slots__ = FIELDS + ('_identity_key',)
+
+    def __init__(self, tim_name, use_name, cmip_dim, dom_name, priority, cmor,
+                 package, period, sheet_name, stash, item, section, lbproc):
+        self.tim_name = _intern(tim_name)
+        self.use_name = _intern(use_name)
+        self.cmip_dim = _intern(cmip_dim)
+        self.dom_name = _intern(dom_name)
+        self.priority = _intern(priority)
+        self.cmor = _intern(cmor)
+        self.package = _intern(package)
+        self.period = _intern(period)
+        self.sheet_name = _intern(sheet_name)
+        self.stash = _intern(stash)
+        self.item = _intern(item)
+        self.section = _intern(section)
+        self.lbproc = lbproc
+        self._identity_key = None
+
+    def __getitem__(self, name):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        setattr(self, name, _intern(value))
+        self._identity_key = None
+
+    def __contains__(self, name):
+        return name in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def keys(self):
+        """return the field names, as FIELDS"""
+        return list(self.FIELDS)
+
+    def items(self):
+        """return the (name, value) pairs of the fields, in FIELDS order"""
+        return zip(self.FIELDS, self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self, name, default=None):
+        """return the value of a field, or default if there is no field"""
+        if name not in self.FIELDS:
+            return default
+        return getattr(self, name)
+
+    def __reduce__(self):
+        return (StashRequest, self.values())
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def values(self):
+        """return the field values, in the order of FIELDS"""
+        return (self.tim_name, self.use_name, self.cmip_dim, self.dom_name,
+                self.priority, self.cmor, self.package, self.period,
+                self.sheet_name, self.stash, self.item, self.section,
+                self.lbproc)
+
+    def as_dict(self):
+        """return the request as the dictionary built by stash_request"""
+        return stash_request(*self.values())
+
+    def identity_key(self):
+        """
+        return the key of the requests with the same STASH code and domain,
+        time and usage profiles and package
+        """
+        if self._identity_key is None:
+            self._identity_key = (self.section + self.item + self.dom_name +
+                                  self.tim_name + self.use_name + self.package)
+        return self._identity_key
+
+
+def ocean_seaice_request(period, sheet_name, cmor, cmip_dim, priority):
+    """return the dictionary describing one NEMO or CICE request"""
+    return {'period': period,
+            'sheet_name': sheet_name,
+            'cmor': cmor,
+            'cmip_dim': cmip_dim,
+            'priority': priority}
+
+
+def cmor_stash_entry(stash, lbproc, units):
+    """return the dictionary describing the STASH for one cmor name"""
+    return {'stash': stash,
+            'lbproc': lbproc,
+            'units': units}
+
+
+# The records built above are sent between processes as tuples of their
+# values, in the order of these keys, and rebuilt with the same function or
+# class. Pickling the dictionaries themselves would build them item by item
+# and can change their key order, and so the order of the JSON output.
+_RESULT_RECORDS = {
+    'stash_dict': (StashRequest, StashRequest.FIELDS),
+    'stash_undef': (StashRequest, StashRequest.FIELDS),
+    'stash_not_wanted': (StashRequest, StashRequest.FIELDS),
+    'ocean_seaice_dict': (ocean_seaice_request,
+                          ('period', 'sheet_name', 'cmor', 'cmip_dim',
+                           'priority')),
+    'cmor_stash_mapping': (cmor_stash_entry, ('stash', 'lbproc', 'units'))}
+
+
+def _pack_sheet_results(results):
+    if results is not None:
+        for name, (_, keys) in _RESULT_RECORDS.items():
+            for key, record in results[name].iteritems():
+                results[name][key] = tuple(record[k] for k in keys)
+    return results
+
+
+def _unpack_sheet_results(results):
+    if results is not None:
+        for name, (builder, _) in _RESULT_RECORDS.items():
+            for key, values in results[name].iteritems():
+                results[name][key] = builder(*values)
+    return results
+
 
+def process_sheet(title, columns, stash_lookup, config):
+    """
+    Derive the STASH requests for one data request sheet, returning a
+    dictionary of its partial results (see SHEET_RESULTS) or None if the
+    sheet is skipped.
+
+    Each partial result is an OrderedDict so that the results of the sheets
+    can be merged into the same dictionaries, with the same insertion order,
+    as if all sheets were processed in one loop.
+
+    title - sheet title
+    columns - dictionary of sheet column values (see read_sheet_columns)
+    stash_lookup - STASHmaster lookup dictionary
+    config - ConfigParser of the cmor to stash conversions
+    """
+    results = dict((name, collections.OrderedDict())
+                   for name in SHEET_RESULTS)
+    stash_dict = results['stash_dict']
+    ocean_seaice_dict = results['ocean_seaice_dict']
+    stash_undef = results['stash_undef']
+    stash_not_wanted = results['stash_not_wanted']
+    key_dict_all = results['key_dict_all']
+    cmor_units = results['cmor_units']
+    cmor_stash_mapping = results['cmor_stash_mapping']
+
+    sheet_name = copy.copy(title)
+    # skip ocean/sea-ice diagnostics as they come from NEMO or CICE (hence
+    # don't need STASH mapping)
+    # aero is currently an issue - both before we figure out EasyAerosol,
+    # and the time period is not defined (assume monthly mean?)
+    sheet_period = sheet_name
+    if sheet_name[0:2] == 'em':
+        sheet_period = sheet_name[2:]
+    elif 'prim' in sheet_name:
+        sheet_period = sheet_name[4:]
+    elif 'aero' in sheet_name:
+        sheet_period = 'aeromon'
+
+    if sheet_name in sheets_to_skip:
+        logger.info('skip sheet %s', sheet_name)
+        return None
+
+    logger.info('process sheet %s %s', sheet_name, sheet_period)
+    # time processing key
+    cell_method_key = process_values(cell_method_processor,
+                                     columns['cell_method'])
+    # dimensions key (e.g. longitude latitude time)
+    dim_key = process_values(dim_processor, columns['dim_key'])
+    logger.debug('len(dim_key) %d', len(dim_key))
+    # derive priority of variable from CMIP6 and Met Office priorities
+    priority_key = derive_variable_priority(columns['cmip6_priority'],
+                                            columns['mo_priority'], dbg=True)
+    # uid from spreadsheet
+    unique_key = process_values(unique_processor, columns['unique'])
+    # modelling realm (atmos, ocean, SeaIce) from spreadsheet
+    realm_key = process_values(unique_processor, columns['realm'])
+    # derive time information for STASH
+    time_period = process_values(time_processor, columns['time'])
+    # derive time information for STASH
+    time_usage_profile = derive_time_usage_profile(sheet_period,
+                                                   time_period,
+                                                   cell_method_key)
+    # read the STASH translation of CMOR name - currently returns m01s??i???
+    stash_key = process_values(check_stash, columns['stash'])
+    # CMOR name
+    cmor_key = process_values(priority_processor, columns['cmor'])
+    # CMOR name
+    varname_key = process_values(priority_processor, columns['variable'])
+    # CMOR units
+    cmor_units_key = process_values(priority_processor,
+                                    columns['cmor_unit'])
+    # try and derive the space domain from the information
+    domain_profile, domain_lbproc = derive_domain_profile(dim_key, dbg=True)
+
+    results['dim_key'] = dim_key
+
+    # organise all the above information into a dictionary, to be used to
+    # derive the rose STASH namelist information
+    logger.debug('len  %d %d %d %d %d %d %d', len(unique_key),
+                 len(time_usage_profile), len(dim_key), len(domain_profile),
+                 len(priority_key), len(cmor_key), len(stash_key))
+    if not (len(unique_key) == len(time_usage_profile) == len(dim_key) ==
+            len(domain_profile) == len(priority_key) == len(cmor_key) ==
+            len(stash_key) == len(domain_lbproc) == len(time_period) ==
+            len(realm_key) == len(varname_key)):
+        raise Exception('Length of the stash key inputs is not the same')
+
+    for index, (ukey, tprof, dimk, dprof, prior, cmork, stkey, dproc, tperiod,
+                units, varn) in enumerate(zip(unique_key,
+                                              time_usage_profile,
+                                              dim_key,
+                                              domain_profile,
+                                              priority_key,
+                                              cmor_key, stash_key,
+                                              domain_lbproc,
+                                              time_period,
+                                              cmor_units_key,
+                                              varname_key)):
+        key = str(ukey)
+        package = prior
+        lbproc = dproc + tprof[2]
+        logger.debug('%s %s %s %s %s %s %s', ukey, tprof, dimk, dprof, prior,
+                     cmork, stkey)
+
+        cmor_or_var_key = cmork
+        if cmork == 'None' and not varn == 'None':
+            cmor_or_var_key = varn
+
+        cmor_stashname = lookup_cmip6_cmor_stash_translation(
+            cmor_or_var_key, config
+        )
+        if str(cmor_stashname) not in str(stkey):
+            diagnostics.emit('cmor_translation_mismatch',
+                             cmor=cmor_or_var_key, cmip6_stash=cmor_stashname,
+                             sheet_stash=stkey)
+
+        if cmor_stashname[0:3] == 'm01' or stkey[0:3] == 'm01':
+            cmor_stash_mapping[cmork] = cmor_stash_entry(stkey, lbproc, units)
+            st_list = [x.strip() for x in stkey.split(',')]
+            for nc, code in enumerate(st_list):
+                logger.debug('code %s', code)
+                # need extra key(s) if there are multiple stash codes
+                if nc > 0:
+                    key = str(ukey) + '_' + str(nc)
+                # if the stash code looks like a real one
+                if len(code) == 10 and code[0] == 'm':
+                    item = str(code[7:])
+                    section = str(code[4:6])
+                    stash_dict[key] = StashRequest(
+                        tprof[0], tprof[1], dimk, dprof, prior, cmork, package,
+                        tperiod, sheet_name, code, item, section, lbproc)
+
+                    check_stash_dependencies(stash_dict[key], stash_lookup)
+
+                    if len(dprof) > 11:
+                        raise Exception('len of dprof ' + dprof + code)
+                    key_dict_all[key] = stash_dict[key].identity_key()
+                else:
+                    item = 'UKNOWN'
+                    section = 'UKNOWN'
+                    if 'MO_NO' in package:
+                        stash_not_wanted[key] = StashRequest(
+                            tprof[0], tprof[1], dimk, dprof, prior, cmork,
+                            package, tperiod, sheet_name, code, item, section,
+                            lbproc)
+                    else:
+                        stash_undef[key] = StashRequest(
+                            tprof[0], tprof[1], dimk, dprof, prior, cmork,
+                            package, tperiod, sheet_name, code, item, section,
+                            lbproc)
+        else:
+            ocean_seaice_dict[key] = ocean_seaice_request(tperiod, sheet_name,
+                                                          cmork, dimk, prior)
+
+    for index, cmor_name in enumerate(cmor_key):
+        cmor_units[cmor_key[index]] = cmor_units_key[index]
+
+    return results
+
+
+# per process state of the process_sheets worker pool
+_WORKER_STATE = {}
+
+
+def _init_sheet_worker(stash_lookup, cmor_stash_cmip6_file):
     config = ConfigParser.ConfigParser()
     config.read(cmor_stash_cmip6_file)
+    _WORKER_STATE['stash_lookup'] = stash_lookup
+    _WORKER_STATE['config'] = config
+
+
+def _sheet_worker(sheet):
+    title, columns = sheet
+    return _pack_sheet_results(
+        process_sheet(title, columns, _WORKER_STATE['stash_lookup'],
+                      _WORKER_STATE['config']))
+
+
+def process_sheets(sheets, stash_lookup, outdir, cmor_stash_cmip6_file,
+                   workers=1):
+    """
+    Translate the columns read from each data request sheet (see
+    read_workbook_sheets) to a dictionary of STASH required variables, writing
+    the supporting output files to outdir
+
+    With workers > 1 the sheets are processed in a pool of that many
+    processes. The partial results are always merged in sheet order, so the
+    output is the same as when processing the sheets one after another.
+    """
+    unique_key, cmorkey_stash = process_stash_translation(sheets)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, _init_sheet_worker,
+                                    (stash_lookup, cmor_stash_cmip6_file))
+        try:
+            sheet_results = [_unpack_sheet_results(results) for results in
+                             pool.map(_sheet_worker, sheets, chunksize=1)]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        config = ConfigParser.ConfigParser()
+        config.read(cmor_stash_cmip6_file)
+        sheet_results = [process_sheet(title, columns, stash_lookup, config)
+                         for title, columns in sheets]
 
     stash_dict = {}
     ocean_seaice_dict = {}
@@ -941,193 +1476,26 @@ def work(loaded_workbook, stash_lookup, outdir, cmor_stash_cmip6_file):
     cmor_units = {}
     cmor_stash_mapping = {}
 
-    # process each worksheet
-    for ws in section_ws:
-        max_row = calc_max_occupied_rows(ws)
-
-        sheet_name = copy.copy(ws.title)
-        # skip ocean/sea-ice diagnostics as they come from NEMO or CICE (hence
-        # don't need STASH mapping)
-        # aero is currently an issue - both before we figure out EasyAerosol,
-        # and the time period is not defined (assume monthly mean?)
-        sheet_period = sheet_name
-        if sheet_name[0:2] == 'em':
-            sheet_period = sheet_name[2:]
-        elif 'prim' in sheet_name:
-            sheet_period = sheet_name[4:]
-        elif 'aero' in sheet_name:
-            sheet_period = 'aeromon'
-
-        if sheet_name in sheets_to_skip:
-            print 'skip sheet ', sheet_name
+    # merge the results of each worksheet, in sheet order
+    merged = {'stash_dict': stash_dict,
+              'ocean_seaice_dict': ocean_seaice_dict,
+              'stash_undef': stash_undef,
+              'stash_not_wanted': stash_not_wanted,
+              'key_dict_all': key_dict_all,
+              'cmor_units': cmor_units,
+              'cmor_stash_mapping': cmor_stash_mapping}
+    for results in sheet_results:
+        if results is None:
             continue
+        # item by item rather than dict.update, which would not follow the
+        # insertion order of the OrderedDict
+        for name in SHEET_RESULTS:
+            target = merged[name]
+            for key, value in results[name].iteritems():
+                target[key] = value
+        dim_key_all.extend(results['dim_key'])
 
-        print 'process sheet ', sheet_name, sheet_period
-        # time processing key
-        cell_method_key = process_range(cell_method_processor,
-                                        ws[cell_method_name+'2:'+cell_method_name+'%i' % max_row])
-        # dimensions key (e.g. longitude latitude time)
-        dim_key = process_range(dim_processor, ws[dim_key_name+'2:'+dim_key_name+'%i' % max_row])
-        print 'len(dim_key)', len(dim_key)
-        # derive priority of variable from CMIP6 and Met Office priorities
-        priority_key = derive_variable_priority(ws, cmip6_priority_col,
-                                                mo_priority_col, max_row)
-        # uid from spreadsheet
-        unique_key = process_range(unique_processor, ws[unique_col_name+'2:'+unique_col_name+'%i' % max_row])
-        # modelling realm (atmos, ocean, SeaIce) from spreadsheet
-        realm_key = process_range(unique_processor, ws[realm_col_name+'2:'+realm_col_name+'%i' % max_row])
-        # derive time information for STASH
-        time_period = process_range(time_processor,
-                                    ws[time_col_name + '2:' + time_col_name +
-                                       '%i' % max_row])
-        # derive time information for STASH
-        time_usage_profile = derive_time_usage_profile(sheet_period,
-                                                       time_period,
-                                                       cell_method_key)
-        # read the STASH translation of CMOR name - currently returns m01s??i???
-        stash_key = process_range(check_stash,
-                                  ws[stash_col_name + '2:' + stash_col_name +
-                                     '%i' % max_row])
-        # CMOR name
-        cmor_key = process_range(priority_processor,
-                                 ws[cmor_col_name + '2:' + cmor_col_name +
-                                    '%i' % max_row])
-        # CMOR name
-        varname_key = process_range(priority_processor,
-                                    ws[variable_col_name + '2:' +
-                                       variable_col_name + '%i' % max_row])
-        # CMOR units
-        cmor_units_key = process_range(priority_processor,
-                                       ws[cmor_unit_col_name+'2:'+cmor_unit_col_name+'%i' % max_row])
-        # try and derive the space domain from the information
-        domain_profile, domain_lbproc = derive_domain_profile(dim_key)
-
-        dim_key_all.extend(dim_key)
-
-        # organise all the above information into a dictionary, to be used to
-        # derive the rose STASH namelist information
-        print ('len  {} {} {} {} {} {} {}'.format(len(unique_key),
-                                                  len(time_usage_profile),
-                                                  len(dim_key),
-                                                  len(domain_profile),
-                                                  len(priority_key),
-                                                  len(cmor_key),
-                                                  len(stash_key)))
-        if not (len(unique_key) == len(time_usage_profile) == len(dim_key) ==
-                len(domain_profile) == len(priority_key) == len(cmor_key) ==
-                len(stash_key) == len(domain_lbproc) == len(time_period) ==
-                len(realm_key) == len(varname_key)):
-            raise Exception('Length of the stash key inputs is not the same')
-
-        for index, (ukey, tprof, dimk, dprof, prior, cmork, stkey, dproc, tperiod,
-                    units, varn) in enumerate(zip(unique_key,
-                                                  time_usage_profile,
-                                                  dim_key,
-                                                  domain_profile,
-                                                  priority_key,
-                                                  cmor_key, stash_key,
-                                                  domain_lbproc,
-                                                  time_period,
-                                                  cmor_units_key,
-                                                  varname_key)):
-            key = str(ukey)
-            package = prior
-            lbproc = dproc + tprof[2]
-            print ukey, tprof, dimk, dprof, prior, cmork, stkey
-
-            cmor_or_var_key = cmork
-            if cmork == 'None' and not varn == 'None':
-                cmor_or_var_key = varn
-
-            cmor_stashname = lookup_cmip6_cmor_stash_translation(
-                cmor_or_var_key, config
-            )
-            if str(cmor_stashname) not in str(stkey):
-                print ('different cmor translation:  {} {} {}'.
-                       format(cmor_or_var_key, str(cmor_stashname),
-                              str(stkey)))
-
-            if cmor_stashname[0:3] == 'm01' or stkey[0:3] == 'm01':
-                cmor_stash_mapping[cmork] = {'stash': stkey,
-                                             'lbproc': lbproc,
-                                             'units': units}
-                st_list = [x.strip() for x in stkey.split(',')]
-                for nc, code in enumerate(st_list):
-                    print 'code ', code
-                    # need extra key(s) if there are multiple stash codes
-                    if nc > 0:
-                        key = str(ukey) + '_' + str(nc)
-                    # if the stash code looks like a real one
-                    if len(code) == 10 and code[0] == 'm':
-                        item = str(code[7:])
-                        section = str(code[4:6])
-                        stash_dict[key] = {'tim_name': tprof[0],
-                                           'use_name': tprof[1],
-                                           'cmip_dim': dimk,
-                                           'dom_name': dprof,
-                                           'priority': prior,
-                                           'cmor': cmork,
-                                           'package': package,
-                                           'period': tperiod,
-                                           'sheet_name': sheet_name,
-                                           'stash': code,
-                                           'item': item,
-                                           'section': section,
-                                           'lbproc': lbproc}
-
-                        check_stash_dependencies(stash_dict[key], stash_lookup)
-
-                        if len(dprof) > 11:
-                            raise Exception('len of dprof ' + dprof + code)
-                        stash_hash_key = (stash_dict[key]['section'] +
-                                          stash_dict[key]['item'] +
-                                          stash_dict[key]['dom_name'] +
-                                          stash_dict[key]['tim_name'] +
-                                          stash_dict[key]['use_name'] +
-                                          stash_dict[key]['package'])
-                        key_dict_all[key] = stash_hash_key
-                    else:
-                        item = 'UKNOWN'
-                        section = 'UKNOWN'
-                        if 'MO_NO' in package:
-                            stash_not_wanted[key] = {'tim_name': tprof[0],
-                                                     'use_name': tprof[1],
-                                                     'cmip_dim': dimk,
-                                                     'dom_name': dprof,
-                                                     'priority': prior,
-                                                     'cmor': cmork,
-                                                     'package': package,
-                                                     'period': tperiod,
-                                                     'sheet_name': sheet_name,
-                                                     'stash': code,
-                                                     'item': item,
-                                                     'section': section,
-                                                     'lbproc': lbproc}
-                        else:
-                            stash_undef[key] = {'tim_name': tprof[0],
-                                                'use_name': tprof[1],
-                                                'cmip_dim': dimk,
-                                                'dom_name': dprof,
-                                                'priority': prior,
-                                                'cmor': cmork,
-                                                'package': package,
-                                                'period': tperiod,
-                                                'sheet_name': sheet_name,
-                                                'stash': code,
-                                                'item': item,
-                                                'section': section,
-                                                'lbproc': lbproc}
-            else:
-                ocean_seaice_dict[key] = {'period': tperiod,
-                                          'sheet_name': sheet_name,
-                                          'cmor': cmork,
-                                          'cmip_dim': dimk,
-                                          'priority': prior}
-
-        for index, cmor_name in enumerate(cmor_key):
-            cmor_units[cmor_key[index]] = cmor_units_key[index]
-
-    print 'finish initial processing'
+    logger.info('finish initial processing')
 
     # use priority value to make a package switch
 
@@ -1143,13 +1511,13 @@ def work(loaded_workbook, stash_lookup, outdir, cmor_stash_cmip6_file):
             flipped[value] = [key]
         else:
             flipped[value].append(key)
-            print 'flipped ', key, value, stash_dict[key]['stash']
-            stash_dup[key] = stash_dict[key]
-            print 'removed duplicate stash-cmor ', stash_dict[key]
-            del stash_dict[key]
+            stash_dup[key] = stash_dict.pop(key)
+            diagnostics.emit('duplicate_removed', key=key, identity=value,
+                             duplicate_of=flipped[value][0],
+                             request=stash_dup[key])
             
-    # some of the level sets are subsets, would like to check but this is complex
-    #check_subset_of_levels(stash_dict)
+    # remove requests for levels that another request already provides
+    stash_subset = check_subset_of_levels(stash_dict)
 
     # These are the unique dimensions in the spreadsheet defined by dimensions
     filename_unique_keys = outdir + '/unique_keys.py'
@@ -1173,6 +1541,9 @@ def work(loaded_workbook, stash_lookup, outdir, cmor_stash_cmip6_file):
     filename_stash_duplicate_json = outdir + '/stash_duplicate.json'
     write_stash_json(stash_dup, filename_stash_duplicate_json)
 
+    filename_stash_subset_json = outdir + '/stash_subset.json'
+    write_stash_json(stash_subset, filename_stash_subset_json)
+
     filename_stash_undefined_json = outdir + '/stash_undefined.json'
     write_stash_json(stash_undef, filename_stash_undefined_json)
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+"""
+Logging for the data request scripts.
+
+Each module logs through its own logger from get_logger, all of them below
+the 'mip_request' logger. Messages use the logging module's %-style
+arguments, so they are only formatted if their level is enabled. Nothing is
+output until configure is called.
+
+Diagnostics about the data request itself (unknown profiles, removed
+duplicates, translation mismatches ...) are events on a separate channel from
+get_diagnostics. Each event is written as one JSON object per line, with the
+event name, the module reporting it and its fields. The channel is off unless
+a destination is given to configure or enable_diagnostics. When it is off,
+reporting an event costs a single level check.
+
+Example
+-------
+>>> import sys
+>>> diagnostics = get_diagnostics('process_spreadsheet')
+>>> diagnostics.emit('unknown_domain_profile', dims='time')
+>>> enable_diagnostics(sys.stdout)
+>>> diagnostics.emit('unknown_domain_profile', dims='time')
+{"dims": "time", "event": "unknown_domain_profile", "module": "process_spreadsheet"}
+>>> disable_diagnostics()
+"""
+import json
+import logging
+
+ROOT_LOGGER = 'mip_request'
+DIAGNOSTICS_LOGGER = ROOT_LOGGER + '.diagnostics'
+LOG_FORMAT = '%(levelname)s %(name)s: %(message)s'
+
+# level of the diagnostics events; the channel is switched off by setting its
+# logger above it
+_EVENT = logging.INFO
+_OFF = logging.CRITICAL + 1
+
+logging.getLogger(ROOT_LOGGER).addHandler(logging.NullHandler())
+_diagnostics_logger = logging.getLogger(DIAGNOSTICS_LOGGER)
+_diagnostics_logger.propagate = False
+_diagnostics_logger.setLevel(_OFF)
+
+
+def get_logger(module_name):
+    """Return the logger of a module, e.g. get_logger(__name__)"""
+    return logging.getLogger(ROOT_LOGGER + '.' + module_name)
+
+
+def _json_value(value):
+    """return the JSON form of values json doesn't know about"""
+    as_dict = getattr(value, 'as_dict', None)
+    if as_dict is not None:
+        return as_dict()
+    return repr(value)
+
+
+class JSONLinesFormatter(logging.Formatter):
+    """Format diagnostics events as single line JSON objects"""
+
+    def format(self, record):
+        event = dict(record.fields)
+        event['event'] = record.msg
+        event['module'] = record.name[len(DIAGNOSTICS_LOGGER) + 1:]
+        return json.dumps(event, sort_keys=True, default=_json_value)
+
+
+class Diagnostics(object):
+    """Diagnostics channel of one module"""
+
+    def __init__(self, module_name):
+        self.module_name = module_name
+        self.logger = logging.getLogger(DIAGNOSTICS_LOGGER + '.' + module_name)
+
+    def enabled(self):
+        """return whether events are being written"""
+        return self.logger.isEnabledFor(_EVENT)
+
+    def emit(self, event, **fields):
+        """Write an event with its fields, if the channel is on"""
+        if self.logger.isEnabledFor(_EVENT):
+            self.logger.log(_EVENT, event, extra={'fields': fields})
+
+
+def get_diagnostics(module_name):
+    """Return the diagnostics channel of a module"""
+    return Diagnostics(module_name)
+
+
+def enable_diagnostics(destination):
+    """
+    Write the diagnostics events to destination, a file name or an open
+    stream, replacing any previous destination.
+    """
+    disable_diagnostics()
+    if isinstance(destination, basestring):
+        handler = logging.FileHandler(destination, mode='w')
+    else:
+        handler = logging.StreamHandler(destination)
+    handler.setFormatter(JSONLinesFormatter())
+    _diagnostics_logger.addHandler(handler)
+    _diagnostics_logger.setLevel(_EVENT)
+
+
+def disable_diagnostics():
+    """Switch the diagnostics channel off"""
+    _diagnostics_logger.setLevel(_OFF)
+    for handler in list(_diagnostics_logger.handlers):
+        _diagnostics_logger.removeHandler(handler)
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+
+
+def configure(level='INFO', log_file=None, diagnostics=None):
+    """
+    Set up the logging of a script.
+
+    level - name of the lowest level of message to log
+    log_file - file to log to, instead of standard error
+    diagnostics - file name or stream to write diagnostics events to; if None
+        the diagnostics channel is off
+    """
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if log_file is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(log_file, mode='w')
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+    logger.setLevel(getattr(logging, level.upper()))
+
+    if diagnostics is None:
+        disable_diagnostics()
+    else:
+        enable_diagnostics(diagnostics)
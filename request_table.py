@@ -0,0 +1,181 @@
+#!/usr/bin/env python2.7
+"""
+A column oriented table of a data request CSV (input/CMIP6_data_req_*.csv),
+for exploring the request from notebooks and scripts.
+
+The CSV is parsed once into a list of values per column. For the INDEXED
+columns a dictionary of the row numbers holding each distinct value is built,
+and for the TOKENISED columns the whitespace separated tokens are counted.
+With a parse_cache.ParseCache all of this is stored on disk, keyed on the
+content of the CSV, so later loads of an unchanged file skip the parsing.
+
+Example
+-------
+>>> import os, shutil, tempfile
+>>> root = tempfile.mkdtemp()
+>>> csv_file = os.path.join(root, 'req.csv')
+>>> with open(csv_file, 'w') as fout:
+...     fout.write('cmor_label,miptable,dimension,cell_methods,realm\\n'
+...                'tas,Amon,longitude latitude time height2m,time: mean,'
+...                'atmos\\n'
+...                'pr,day,longitude latitude time,time: mean,atmos\\n')
+>>> cache = parse_cache.ParseCache(os.path.join(root, 'cache'))
+>>> table = load_request_table(csv_file, cache)
+>>> len(table), table.tokens('dimension')['time']
+(2, 2)
+>>> table.distinct('miptable')
+{'Amon': (0,), 'day': (1,)}
+>>> [row['cmor_label'] for row in table.rows(table.select(
+...     cell_methods='time: mean', miptable='day'))]
+['pr']
+>>> load_request_table(csv_file, cache).column('cmor_label')
+['tas', 'pr']
+>>> shutil.rmtree(root)
+"""
+import collections
+import csv
+
+import parse_cache
+
+INDEXED = ('dimension', 'cell_methods', 'miptable', 'realm')
+TOKENISED = ('dimension', 'realm')
+
+# bump this if the cached form of the table changes
+_CACHE_VERSION = 1
+
+
+class RequestTable(object):
+    """
+    A data request CSV held as columns, with the distinct value dictionaries
+    of the INDEXED columns and the token counts of the TOKENISED columns.
+    """
+
+    def __init__(self, fieldnames, columns, distinct, token_counts):
+        self.fieldnames = list(fieldnames)
+        self._columns = columns
+        self._distinct = distinct
+        self._token_counts = dict((name, collections.Counter(counts))
+                                  for name, counts in token_counts.items())
+
+    @classmethod
+    def from_csv(cls, filename):
+        """Return the table of a data request CSV file."""
+        with open(filename, 'rb') as fin:
+            reader = csv.reader(fin)
+            fieldnames = next(reader)
+            values = [[] for _ in fieldnames]
+            appends = [column.append for column in values]
+            width = len(fieldnames)
+            for row in reader:
+                if len(row) < width:
+                    row.extend([''] * (width - len(row)))
+                for append, value in zip(appends, row):
+                    append(value)
+        columns = dict(zip(fieldnames, values))
+
+        distinct = {}
+        for name in INDEXED:
+            if name not in columns:
+                continue
+            positions = collections.defaultdict(list)
+            for position, value in enumerate(columns[name]):
+                positions[value].append(position)
+            distinct[name] = dict((value, tuple(rows))
+                                  for value, rows in positions.iteritems())
+
+        token_counts = {}
+        for name in TOKENISED:
+            if name not in distinct:
+                continue
+            counts = collections.Counter()
+            for value, rows in distinct[name].iteritems():
+                for token in value.split():
+                    counts[token] += len(rows)
+            token_counts[name] = counts
+        return cls(fieldnames, columns, distinct, token_counts)
+
+    def as_cached(self):
+        """Return the table built from basic types, for parse_cache."""
+        return {'fieldnames': self.fieldnames, 'columns': self._columns,
+                'distinct': self._distinct,
+                'token_counts': dict((name, dict(counts)) for name, counts in
+                                     self._token_counts.iteritems())}
+
+    @classmethod
+    def from_cached(cls, cached):
+        """Return the table from the as_cached form."""
+        return cls(cached['fieldnames'], cached['columns'],
+                   cached['distinct'], cached['token_counts'])
+
+    def __len__(self):
+        if not self.fieldnames:
+            return 0
+        return len(self._columns[self.fieldnames[0]])
+
+    def column(self, name):
+        """Return the list of the values of a column."""
+        return self._columns[name]
+
+    def distinct(self, name):
+        """
+        Return a dictionary of the row numbers, in order, holding each
+        distinct value of an INDEXED column.
+        """
+        return self._distinct[name]
+
+    def tokens(self, name):
+        """Return a Counter of the tokens of a TOKENISED column."""
+        return self._token_counts[name]
+
+    def row(self, position):
+        """Return the dictionary of a row, as csv.DictReader gives it."""
+        return dict((name, self._columns[name][position])
+                    for name in self.fieldnames)
+
+    def rows(self, positions=None):
+        """Generate the dictionaries of the rows at positions, or of all."""
+        if positions is None:
+            positions = xrange(len(self))
+        for position in positions:
+            yield self.row(position)
+
+    def select(self, **criteria):
+        """
+        Return the sorted row numbers whose columns have the values given,
+        using the distinct value dictionaries where they are available.
+        """
+        selected = None
+        for name, value in criteria.iteritems():
+            if name in self._distinct:
+                matches = set(self._distinct[name].get(value, ()))
+            else:
+                matches = set(position for position, row_value in
+                              enumerate(self._columns[name])
+                              if row_value == value)
+            selected = matches if selected is None else selected & matches
+        if selected is None:
+            return range(len(self))
+        return sorted(selected)
+
+
+def load_request_table(filename, cache=None, rebuild_cache=False):
+    """
+    Return the RequestTable of a data request CSV file.
+
+    If a parse_cache.ParseCache is given the table is looked up there by the
+    content hash of the file, and the CSV is only parsed if it is not found
+    (or rebuild_cache is set), in which case the cache is updated.
+    """
+    key = None
+    if cache is not None:
+        key = 'request-table-{}-{}'.format(parse_cache.file_digest(filename),
+                                           _CACHE_VERSION)
+        if not rebuild_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                return RequestTable.from_cached(cached)
+
+    table = RequestTable.from_csv(filename)
+    if cache is not None:
+        cache.put(key, table.as_cached())
+    return table
@@ -52,8 +52,8 @@ Note that the temp_fixes namelist sits between streq and time namelists
 Want to do:
     1. From default stash:
         Add package switch that reference default stash diagnostics - STD_GA7
-        Tag duplicates within reference list and switch off - STD_DUPL - done
-            by hand
+        Tag duplicates within reference list and switch off - DUPLICATE -
+            done by package_duplicates
         Convert to STASH meaning
             Changes time and usage
             Add Time profile for stash meaning and use it appropriately - from
@@ -90,11 +90,11 @@ Want to do:
     rose_stash_manipulate.py --stashmaster /data/users/hadom/branches/\
             vn10.4_merge_SIMIP_EasyAerosol_stashmaster/rose-meta/um-atmos/\
             HEAD/etc/stash/STASHmaster \
-            /home/h06/hadom/roses/u-ag015/app/coupled/rose-app.conf > proc.out
+            /home/h06/hadom/roses/u-ag015/app/coupled/rose-app.conf --log-file proc.out
     /home/h06/hadom/workspace/Rose/rose_stash_manipulate.py --stashmaster /data/users/hadom/branches/\
             vn10.6_easyaerosol_v2/rose-meta/um-atmos/\
             HEAD/etc/stash/STASHmaster \
-            /home/h06/hadom/roses/u-ai098/app/um/rose-app.conf > proc.out
+            /home/h06/hadom/roses/u-ai098/app/um/rose-app.conf --log-file proc.out
 
 Shift timestep diagnostics from uph to upt
     Could switch them off (or remove completely) for now.
@@ -139,52 +139,66 @@ Could check if diagnostics are going into each (updating) stream - and if not
     switch that stream off, so don't produce empty files
 """
 import argparse
-import copy
+import collections
+import importlib
+import json
 import os
-import re
 from shutil import move
 import StringIO
 import sys
 
 import hashlib
-import openpyxl
 import subprocess
 
+import parse_cache
 import process_spreadsheet
+import request_logging
 
 rose_lib = '/home/h03/fcm/rose/lib/python/'
 latest_umversion = '10.6'
 rose_meta_lib = ('/home/h03/fcm/rose-meta/um-atmos/vn' +
                  latest_umversion + '/lib/python/')
-sys.path.append(rose_lib)
-sys.path.append(rose_meta_lib)
-import rose.config
-import rose.macro
-import widget.stash_parse
-
-
-# Create an xml file containing the details of a stash list
-# from a rose-app.conf file.
-# Duplicates from GA7 - currently remove by hand:
-# 24, TDAYM, UPJ
-# 3332, TDAYM, UPJ
-# 3236, TDAYMIN, UPJ
-# 3236, TDAYM, UPJ
-# 3236, TDAYMAX, UPJ
-# 5216, TDAYM, UPJ
-stash1 = {'stash': 24, 'tim_name': 'TDAYM', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-stash2 = {'stash': 3332, 'tim_name': 'TDAYM', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-stash3 = {'stash': 3236, 'tim_name': 'TDAY', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-stash4 = {'stash': 3236, 'tim_name': 'TDAYMIN', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-stash5 = {'stash': 3236, 'tim_name': 'TDAYMAX', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-stash6 = {'stash': 5216, 'tim_name': 'TDAYM', 'use_name': 'UPJ',
-          'dom_name': 'DIAG'}
-duplicates = [stash1, stash2, stash3, stash4, stash5, stash6]
+
+
+class _LazyImport(object):
+    """
+    Stand in for a package that is only imported, along with the submodules
+    listed, when one of its attributes is first used. The paths are added to
+    sys.path just before the import.
+
+    Importing this script is then free of the cost of rose and the rose
+    metadata, which are not needed for e.g. --help.
+    """
+    def __init__(self, name, submodules=(), paths=()):
+        self._name = name
+        self._submodules = submodules
+        self._paths = paths
+        self._module = None
+
+    def __getattr__(self, attname):
+        if self._module is None:
+            for path in self._paths:
+                if path not in sys.path:
+                    sys.path.append(path)
+            for submodule in self._submodules:
+                importlib.import_module(submodule)
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attname)
+
+
+logger = request_logging.get_logger(__name__)
+diagnostics = request_logging.get_diagnostics(__name__)
+
+rose = _LazyImport('rose', ['rose.config'], [rose_lib, rose_meta_lib])
+widget = _LazyImport('widget', ['widget.stash_parse'],
+                     [rose_lib, rose_meta_lib])
+
+
+# The streq options that identify a STASH request: two streq namelists with
+# the same values of these are duplicates (e.g. the GA7 requests of 24, 3332,
+# 3236 and 5216 on DIAG, TDAYM/TDAYMIN/TDAYMAX, UPJ once removed by hand).
+STREQ_DUPLICATE_KEY = ('isec', 'item', 'dom_name', 'tim_name', 'use_name')
+DUPLICATE_PACKAGE = "'DUPLICATE'"
 
 
 #CMIP6_DATA_REQUEST = ('/data/users/jseddon/rose_suite_populate/'
@@ -195,12 +209,6 @@ CMIP6_DATA_REQUEST_URL = 'svn://fcm9/utils_svn/MalcolmRoberts/trunk/python/Rose/
 CMIP6_DATA_REQUEST_REVISION = 16390
 CMIP6_DATA_REQUEST = '/data/users/hadom/cmip6/data_request/PRIMAVERA_MS21_DRQ.xlsx'
 
-cmd = 'fcm export --force '+CMIP6_DATA_REQUEST_URL+'@'+str(CMIP6_DATA_REQUEST_REVISION)+ ' '+CMIP6_DATA_REQUEST
-sts_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-sts_out, sts_err = sts_proc.communicate()
-print cmd
-print sts_out
-
 CMIP6_CMOR_STASH_CONVERSION = '/home/h06/hadom/python/cmip6_mappings.cfg'
 # Reference streq template
 TEMPLATE_FILE = '/home/h06/hadom/roses/reference/streq_template_10p6.conf'
@@ -485,93 +493,198 @@ def assign_profile(name, properties):
     return profile_dict[name](properties)
 
 
-def package_duplicates(config, key):
-    """
-    From the duplicates list of dictionaries above, pick these variables out
-    and give them a package switch
-    """
-    for dup in duplicates:
-        if ((config.value[key[0]].value['use_name'].value ==
-                         "'"+dup['use_name']+"'") and
-                (config.value[key[0]].value['dom_name'].value ==
-                             "'"+dup['dom_name']+"'") and
-                (config.value[key[0]].value['tim_name'].value ==
-                             "'"+dup['tim_name']+"'")):
-            config.value[key[0]].value['package'].value = "'DUPLICATE'"
-
-
-def process_config_file_stashmean(config):
-    """process config file to convert from climate meaning to stash meaning"""
-    for key, data in config.walk():
-        section = key[0]
-        if len(key) == 1:
-            retxt = re.search(r"namelist:(?P<name>\w+)\((?P<num>[0-9_a-zA-Z]+)", key[0])
-            # pick out parts of config that are stash-related
-            print 'section ', section
-            for section_base in STASH_SECTION_BASES:
-                if (section.startswith(section_base) and
-                            'domain_nml' not in section):
-                    nl = retxt.group('name')
-                    print 'nl ', nl
-                    profile = assign_profile(nl, data)
-                    for profile_key, profile_value in profile.iterate():
-                        if profile_key == 'name':
-                            stashname = profile_value
-
-                    if nl == 'streq':
-                        # comment out duplicate requests
-                        package_duplicates(config, key)
-                        # if dump mean profile, change to STASH meaning
-                        if 'TDMPMN' in config.value[key[0]].value['tim_name'].value:
-                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
-                                config.value[key[0]].value['tim_name'].value = "'TMONMN'"
-                                if 'UKCA' in config.value[key[0]].value['package'].value or \
-                                'EASYA' in config.value[key[0]].value['package'].value:
-                                    config.value[key[0]].value['use_name'].value = "'UP3'"
-                                else:
-                                    if (config.value[key[0]].value['isec'].value == '30'
-                                            or 'Dust' in stashname):
-                                        config.value[key[0]].value['use_name'].value = "'UP2'"
-                                    else:
-                                        config.value[key[0]].value['use_name'].value = "'UP1'"
-
-                        # now deal with COSP diagnostics - use hourly data on
-                        # radiation timesteps
-                        if 'T6HDMPM' in config.value[key[0]].value['tim_name'].value:
-                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
-                                config.value[key[0]].value['tim_name'].value = "'T6HMONM'"
-                                if ((config.value[key[0]].value['isec'].value == '30')
-                                        or ('Dust' in stashname)):
-                                    config.value[key[0]].value['use_name'].value = "'UP2'"
-                                else:
-                                    config.value[key[0]].value['use_name'].value = "'UP1'"
-
-                        # now deal with diurnal cycle diagnostics
-                        if 'TMPMN' in config.value[key[0]].value['tim_name'].value:
-                            config.value[key[0]].value['package'].value = "'DIURNAL'"
-                            period = config.value[key[0]].value['tim_name'].value[-3:-1]
-                            config.value[key[0]].value['tim_name'].value = "'TMONMN" + period + "'"
-                            config.value[key[0]].value['use_name'].value = "'UPK'"
-
-                        # now deal with COSP diagnostics - use hourly data on radiation timesteps
-                        if 'TRADDM' in config.value[key[0]].value['tim_name'].value:
-                            if config.value[key[0]].value['use_name'].value == "'UPMEAN'":
-                                config.value[key[0]].value['tim_name'].value = "'TRADMONM'"
-                                config.value[key[0]].value['use_name'].value = "'UP1'"
-
-                        # change 90 day instantaneous to 30 day
-                        if 'T90DAY' in config.value[key[0]].value['tim_name'].value:
-                            config.value[key[0]].value['tim_name'].value = "'T30DAY'"
-                            config.value[key[0]].value['use_name'].value = "'UPU'"
-
-                        # change 90 day instantaneous to 30 day
-                        if 'TSTEPGI' in config.value[key[0]].value['tim_name'].value:
-                            config.value[key[0]].value['use_name'].value = "'UPT'"
-                            config.value[key[0]].value['package'].value = "'TSTEP_STD_GA7'"
-
-                        # set all blank package switches to a standard value
-                        if config.value[key[0]].value['package'].value == "''":
-                            config.value[key[0]].value['package'].value = "'STD_GA7'"
+def export_data_request(filename=CMIP6_DATA_REQUEST,
+                        url=CMIP6_DATA_REQUEST_URL,
+                        revision=CMIP6_DATA_REQUEST_REVISION):
+    """Export the data request workbook at revision from url to filename"""
+    cmd = 'fcm export --force ' + url + '@' + str(revision) + ' ' + filename
+    sts_proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    sts_out, sts_err = sts_proc.communicate()
+    logger.info('%s', cmd)
+    logger.info('%s', sts_out)
+
+
+def find_duplicate_streq(config):
+    """
+    Return the groups of duplicate streq namelists in config, found in one
+    pass by keying each on its STREQ_DUPLICATE_KEY values.
+
+    The groups are an OrderedDict, sorted by key, from a key to the sorted
+    names of its sections, for the keys of more than one section. Ignored
+    sections are left out.
+    """
+    sections = collections.defaultdict(list)
+    for section, section_node in config.value.items():
+        if not section.startswith('namelist:streq(') or section_node.state:
+            continue
+        options = section_node.value
+        try:
+            key = tuple(options[name].value.strip(" '")
+                        for name in STREQ_DUPLICATE_KEY)
+        except KeyError:
+            logger.debug('section %s is missing a streq option', section)
+            continue
+        sections[key].append(section)
+    groups = [(key, sorted(names)) for key, names in sections.iteritems()
+              if len(names) > 1]
+    return collections.OrderedDict(sorted(groups))
+
+
+def package_duplicates(config, groups):
+    """
+    Give all but the first section of each group of duplicate streq namelists
+    (from find_duplicate_streq) the DUPLICATE_PACKAGE switch, so that each
+    request is only output once. A section with no package option is given
+    one.
+    """
+    for names in groups.itervalues():
+        for section in names[1:]:
+            options = config.value[section].value
+            if 'package' not in options:
+                logger.warning('duplicate section %s has no package option, '
+                               'adding one', section)
+                config.set(keys=[section, 'package'], value=DUPLICATE_PACKAGE)
+            else:
+                options['package'].value = DUPLICATE_PACKAGE
+
+
+def write_duplicate_report(groups, filename):
+    """
+    write to file the groups of duplicate streq namelists, each with its
+    STREQ_DUPLICATE_KEY values, the section kept and the sections switched off
+    """
+    report = []
+    for key, names in groups.iteritems():
+        group = dict(zip(STREQ_DUPLICATE_KEY, key))
+        group['kept'] = names[0]
+        group['duplicates'] = names[1:]
+        report.append(group)
+    with open(filename, 'w') as fout:
+        json.dump(report, fout, indent=2, sort_keys=True)
+
+
+def _mean_usage(fields, stash_name):
+    """return the usage of a monthly mean, UP2 for section 30 and dust"""
+    if fields['isec'] == '30' or 'Dust' in stash_name():
+        return "'UP2'"
+    return "'UP1'"
+
+
+def _dump_mean_to_stash_mean(fields, stash_name):
+    fields['tim_name'] = "'TMONMN'"
+    if 'UKCA' in fields['package'] or 'EASYA' in fields['package']:
+        fields['use_name'] = "'UP3'"
+    else:
+        fields['use_name'] = _mean_usage(fields, stash_name)
+
+
+def _cosp_6hr_dump_mean(fields, stash_name):
+    fields['tim_name'] = "'T6HMONM'"
+    fields['use_name'] = _mean_usage(fields, stash_name)
+
+
+def _diurnal_cycle(fields, stash_name):
+    fields['package'] = "'DIURNAL'"
+    period = fields['tim_name'][-3:-1]
+    fields['tim_name'] = "'TMONMN" + period + "'"
+    fields['use_name'] = "'UPK'"
+
+
+def _cosp_radiation_mean(fields, stash_name):
+    fields['tim_name'] = "'TRADMONM'"
+    fields['use_name'] = "'UP1'"
+
+
+def _90day_to_30day(fields, stash_name):
+    fields['tim_name'] = "'T30DAY'"
+    fields['use_name'] = "'UPU'"
+
+
+def _timestep_global(fields, stash_name):
+    fields['use_name'] = "'UPT'"
+    fields['package'] = "'TSTEP_STD_GA7'"
+
+
+def _default_package(fields, stash_name):
+    if fields['package'] == "''":
+        fields['package'] = "'STD_GA7'"
+
+
+# A climate mean to STASH mean conversion of the streq namelists: a rule
+# applies to the requests whose tim_name contains tim_contains (any, if None)
+# and whose use_name is use_name (any, if None). action(fields, stash_name)
+# updates the dictionary of the quoted streq values; stash_name() returns the
+# STASHmaster name of the request.
+StashmeanRule = collections.namedtuple('StashmeanRule',
+                                       'name tim_contains use_name action')
+
+# applied in order, each rule seeing the changes made by those before it
+STASHMEAN_RULES = [
+    StashmeanRule('dump mean to STASH mean', 'TDMPMN', "'UPMEAN'",
+                  _dump_mean_to_stash_mean),
+    StashmeanRule('COSP, hourly data on radiation timesteps', 'T6HDMPM',
+                  "'UPMEAN'", _cosp_6hr_dump_mean),
+    StashmeanRule('diurnal cycle', 'TMPMN', None, _diurnal_cycle),
+    StashmeanRule('COSP, radiation timestep mean', 'TRADDM', "'UPMEAN'",
+                  _cosp_radiation_mean),
+    StashmeanRule('90 day instantaneous to 30 day', 'T90DAY', None,
+                  _90day_to_30day),
+    StashmeanRule('timestep global', 'TSTEPGI', None, _timestep_global),
+    StashmeanRule('blank package switches to standard', None, None,
+                  _default_package),
+]
+
+STASHMEAN_FIELDS = ('tim_name', 'use_name', 'dom_name', 'package', 'isec',
+                    'item')
+
+
+def apply_stashmean_rules(fields, stash_name, rules=STASHMEAN_RULES):
+    """
+    Apply the rules to fields, the dictionary of the quoted STASHMEAN_FIELDS
+    values of a streq namelist, in order.
+    """
+    for rule in rules:
+        if (rule.tim_contains is not None and
+                rule.tim_contains not in fields['tim_name']):
+            continue
+        if rule.use_name is not None and fields['use_name'] != rule.use_name:
+            continue
+        rule.action(fields, stash_name)
+
+
+def process_config_file_stashmean(config, stash_lookup=None):
+    """
+    process config file to convert from climate meaning to stash meaning
+
+    The STASHMEAN_RULES are applied to each streq namelist in turn, with its
+    values read once and only the changed ones written back. stash_lookup
+    gives the STASHmaster names, used by some of the rules.
+    """
+    if stash_lookup is None:
+        stash_lookup = {}
+    for section, section_node in config.value.items():
+        if (not section.startswith('namelist:streq(') or
+                'domain_nml' in section):
+            continue
+        logger.debug('section %s', section)
+        options = section_node.value
+        fields = dict((name, options[name].value)
+                      for name in STASHMEAN_FIELDS)
+        original = fields.copy()
+
+        def stash_name():
+            isec = original['isec'].strip(" '")
+            item = original['item'].strip(" '")
+            try:
+                return stash_lookup[isec][item]['name']
+            except KeyError:
+                return isec + item
+
+        apply_stashmean_rules(fields, stash_name)
+        for name, value in fields.iteritems():
+            if value != original[name]:
+                options[name].value = value
     # TODO: Consider changing the frequency of reinitialisation of the files in automated way
 
 
@@ -593,6 +706,51 @@ def merge_configs(target, donor):
     return messages, target
 
 
+def build_stash_sections(template, stash_codes, index_cache=None):
+    """
+    Return an ordered dictionary of the config sections, by name, of the
+    stash codes, each put into a clone of the template ConfigPrototype
+    (see put_stash_into_config).
+
+    Sections of different stash codes with the same name replace each
+    other, as merging them into a config one at a time would. If their
+    options differ the section index has collided, which is logged and
+    written to the diagnostics.
+    """
+    if index_cache is None:
+        index_cache = SectionIndexCache()
+    sections = collections.OrderedDict()
+    for stash_code in stash_codes:
+        config_tmp = template.clone()
+        put_stash_into_config(config_tmp, stash_code, index_cache)
+        for section, node in config_tmp.value.items():
+            previous = sections.get(section)
+            if (previous is not None and
+                    _section_options(previous) != _section_options(node)):
+                logger.warning('section index collision in %s', section)
+                diagnostics.emit('stash_index_collision', section=section,
+                                 cmor=stash_code['cmor'])
+            sections[section] = node
+    return sections
+
+
+def _section_options(node):
+    if not isinstance(node.value, dict):
+        return node.value
+    return sorted((option, opt_node.value, opt_node.state)
+                  for option, opt_node in node.value.items())
+
+
+def merge_sections(target, sections):
+    """
+    Add the sections, as built by build_stash_sections, to the target config
+    in one update, returning merge_configs style messages.
+    """
+    target.value.update(sections)
+    return [(section, None, None, '{0:s} will be added.'.format(section))
+            for section in sections]
+
+
 def dump_section(config, section, no_include_opts=None):
     """Return some option=value text used for checksums."""
     new_config = rose.config.ConfigNode()
@@ -616,40 +774,123 @@ def get_index_from_section(section):
     return section.rsplit("(", 1)[1].rstrip(")")
 
 
-def get_new_indices(config, section_base_name, no_include_opts=None):
-    """Return a list of errors, if any."""
+class SectionIndexCache(object):
+    """
+    The checksum index of each STASH section of a config, kept between
+    calls to make_unique_index.
+
+    The index is the start of the SHA-1 of the dump_section text of the
+    section. It is only computed for the sections that have not been
+    indexed yet or that have been invalidated since: whatever changes the
+    options of an indexed section must call invalidate for it (as
+    put_stash_into_config does), the other sections are not looked at.
+    """
+    def __init__(self):
+        self._indexes = {}
+        self._invalid = set()
+
+    def invalidate(self, section):
+        """Mark a section as changed, to be indexed again."""
+        self._invalid.add(section)
+
+    def index(self, config, section, no_include_opts):
+        """Return the checksum index of a section of config."""
+        if section in self._indexes and section not in self._invalid:
+            return self._indexes[section]
+        logger.debug('text input %s %s', section, no_include_opts)
+        text = dump_section(config, section, no_include_opts)
+        new_index = hashlib.sha1(text).hexdigest()[:8]
+        self._indexes[section] = new_index
+        self._invalid.discard(section)
+        return new_index
+
+    def rename(self, old_section, new_section):
+        """Keep the index of a section that has been renamed."""
+        if old_section in self._indexes:
+            self._indexes[new_section] = self._indexes.pop(old_section)
+        if old_section in self._invalid:
+            self._invalid.remove(old_section)
+            self._invalid.add(new_section)
+
+
+def get_new_indices(config, section_base_name, no_include_opts=None,
+                    index_cache=None, sections=None):
+    """
+    Generate the (old index, new index) of each section_base_name section
+    whose index is not its checksum, through a SectionIndexCache if given.
+    Only the sections in sections are looked at, if given.
+    """
     if no_include_opts is None:
         no_include_opts = []
-    keys = config.value.keys()
+    if index_cache is None:
+        index_cache = SectionIndexCache()
+    if sections is None:
+        sections = config.value.keys()
+    keys = [section for section in sections
+            if section.startswith(section_base_name + "(")]
     keys.sort(rose.config.sort_settings)
     for section in keys:
-        if not section.startswith(section_base_name + "("):
-            continue
-        print 'text input ', section, no_include_opts
-        text = dump_section(config, section, no_include_opts)
         old_index = get_index_from_section(section)
-        new_index = hashlib.sha1(text).hexdigest()[:8]
+        new_index = index_cache.index(config, section, no_include_opts)
         if old_index != new_index:
             yield (old_index, new_index)
 
 
-def get_section_new_indices(config):
-    """Get newly calculated indices for the config."""
+def get_section_new_indices(config, index_cache=None, sections=None):
+    """
+    Get newly calculated indices for the config, of only the sections in
+    sections if given.
+    """
     for section_base in STASH_SECTION_BASES:
         no_include_opts = STASH_SECTION_BASES_NO_INCLUDE_OPTS_MAP.get(
                                                     section_base, [])
         for old_index, new_index in get_new_indices(config, section_base,
-                                                    no_include_opts):
+                                                    no_include_opts,
+                                                    index_cache, sections):
             yield section_base, old_index, new_index
 
 
-def put_stash_into_config(config, stash_code):
-    """insert a stash code into a config object"""
+class ConfigPrototype(object):
+    """
+    A rose config, such as the streq template, parsed once and then cloned
+    for each use.
+
+    A clone has its own copy of every node of the prototype, so changing a
+    clone, or the config it is merged into, never changes the prototype or
+    the other clones.
+    """
+    def __init__(self, config):
+        self._config = config
+
+    @classmethod
+    def load(cls, filename):
+        """Return the prototype of the rose config in filename."""
+        return cls(rose.config.load(filename))
+
+    @classmethod
+    def _copy_node(cls, node):
+        value = node.value
+        if isinstance(value, dict):
+            value = dict((key, cls._copy_node(child))
+                         for key, child in value.items())
+        return rose.config.ConfigNode(value, node.state, list(node.comments))
+
+    def clone(self):
+        """Return a new config with the content of the prototype."""
+        return self._copy_node(self._config)
+
+
+def put_stash_into_config(config, stash_code, index_cache=None):
+    """
+    insert a stash code into a config object, re-indexing its sections
+    through index_cache if given (see make_unique_index)
+    """
     key = config.value.keys()
     # set the values from the stash_list dictionary into this config node
-    print stash_code
-    print stash_code['dom_name'], stash_code['tim_name'], stash_code['use_name'], stash_code['section'],\
-        stash_code['item'], stash_code['cmor']
+    logger.debug('%s', stash_code)
+    logger.debug('%s %s %s %s %s %s', stash_code['dom_name'],
+                 stash_code['tim_name'], stash_code['use_name'],
+                 stash_code['section'], stash_code['item'], stash_code['cmor'])
     for profile in ['tim_name', 'use_name', 'dom_name', 'package']:
         config.value[key[0]].value[profile].value = str("'" +
                                                         stash_code[profile] +
@@ -657,19 +898,29 @@ def put_stash_into_config(config, stash_code):
     config.value[key[0]].value['item'].value = str(int(stash_code['item']))
     config.value[key[0]].value['isec'].value = str(int(stash_code['section']))
 
-    make_unique_index(config, stash_code)
+    if index_cache is not None:
+        index_cache.invalidate(key[0])
+    make_unique_index(config, stash_code, index_cache, [key[0]])
 
 
-def make_unique_index(config, stash_code):
-    """creates a new key value for this node"""
-    for data in get_section_new_indices(config):
+def make_unique_index(config, stash_code, index_cache=None, sections=None):
+    """
+    creates a new key value for this node
+
+    Only the sections in sections are re-indexed, if given. A
+    SectionIndexCache kept between calls means only the sections that are
+    new or invalidated since the last call are dumped and hashed.
+    """
+    if index_cache is None:
+        index_cache = SectionIndexCache()
+    for data in get_section_new_indices(config, index_cache, sections):
         section_base, old_index, new_index = data
         key = config.value.keys()
         isec_item = stash_code['section']+stash_code['item']
         old_index_sections = old_index.split('_')
         old_section = SECTION_FORMAT.format(section_base, old_index_sections[0], old_index_sections[1])
         new_section = SECTION_FORMAT.format(section_base, isec_item, new_index)
-        print 'old_section, new', old_section, new_section
+        logger.debug('old_section, new %s %s', old_section, new_section)
 
         old_node = config.unset([old_section])
         old_id_opt_values = []
@@ -678,6 +929,7 @@ def make_unique_index(config, stash_code):
             old_id_opt_values.append((old_id, opt, node.value))
         # update key value
         config.value.update({new_section: old_node})
+        index_cache.rename(old_section, new_section)
 
 
 def work(args, stash_lookup):
@@ -692,7 +944,16 @@ def work(args, stash_lookup):
     rose.config.dump(config, args.input + '.default')
 
     # process config file to convert from climate meaning to stash meaning
-    process_config_file_stashmean(config)
+    process_config_file_stashmean(config, stash_lookup)
+
+    # switch off all but one of each group of duplicate requests
+    outdir = os.path.dirname(args.input)
+    duplicate_groups = find_duplicate_streq(config)
+    logger.info('%d groups of duplicate streq namelists',
+                len(duplicate_groups))
+    package_duplicates(config, duplicate_groups)
+    write_duplicate_report(duplicate_groups,
+                           os.path.join(outdir, 'streq_duplicate.json'))
 
     conf_out = args.input + '.process_config'
     rose.config.dump(config, conf_out)
@@ -707,24 +968,28 @@ def work(args, stash_lookup):
 
     # read in new diagnostics
     infile = args.datarequest
-    outdir = os.path.dirname(args.input)
     cmor_stash_file = (args.cmorstashfile)
-    print 'cmor stash file ', cmor_stash_file
-    hrmip = openpyxl.load_workbook(infile, use_iterators=True)
-    stash_dictionary = process_spreadsheet.work(hrmip, stash_lookup,
-                                                  outdir, cmor_stash_file)
-
+    logger.info('cmor stash file %s', cmor_stash_file)
+    if args.no_cache:
+        cache = None
+    else:
+        cache = parse_cache.ParseCache(args.cache_dir,
+                                       args.cache_size * 1024 * 1024)
+    sheets = process_spreadsheet.load_workbook_sheets(infile, cache,
+                                                      args.rebuild_cache)
+    stash_dictionary = process_spreadsheet.process_sheets(
+        sheets, stash_lookup, outdir, cmor_stash_file, workers=args.workers)
+
+    # read in config template namelist, once for all the diagnostics
+    template = ConfigPrototype.load(TEMPLATE_FILE)
+    stash_codes = []
     for stash_item in stash_dictionary:
-        print 'dictionary ', stash_item
-        # read in config template namelist
-        config_template = rose.config.load(TEMPLATE_FILE)
-        config_tmp = copy.copy(config_template)
-        print 'config_tmp old \n', config_tmp
+        logger.debug('dictionary %s', stash_item)
 
         section_lookup = str(int(stash_dictionary[stash_item]['section']))
         item_lookup = str(int(stash_dictionary[stash_item]['item']))
         section_item = section_lookup + item_lookup
-        print 'stashcode ', section_item
+        logger.debug('stashcode %s', section_item)
         if (section_item == '' or
                     stash_dictionary[stash_item]['stash'][0] != 'm'):
             raise Exception('Not a stash code ' +
@@ -732,17 +997,19 @@ def work(args, stash_lookup):
         try:
             stashname = stash_lookup[section_lookup][item_lookup]['name']
         except:
-            print ('this stashcode does not translate in '
-                   'rose_stash {}'.format(section_item))
+            diagnostics.emit('stash_not_in_stashmaster', section=section_lookup,
+                             item=item_lookup)
             continue
 
-        print 'section_lookup ', section_lookup, section_item,\
-            stash_dictionary[stash_item]['stash']
+        logger.debug('section_lookup %s %s %s', section_lookup, section_item,
+                     stash_dictionary[stash_item]['stash'])
 
-        put_stash_into_config(config_tmp, stash_dictionary[stash_item])
+        stash_codes.append(stash_dictionary[stash_item])
 
-        # merge this new node into the full confignode object
-        messages, upd_config = merge_configs(upd_config, config_tmp)
+    # build all the new nodes, then merge them into the full confignode
+    # object at once
+    sections = build_stash_sections(template, stash_codes)
+    messages = merge_sections(upd_config, sections)
 
     rose.config.dump(upd_config, conf_out + 'added_stash')
     move(conf_out + 'added_stash', args.input)
@@ -772,8 +1039,40 @@ if __name__ == '__main__':
     parser.add_argument('--cmorstashfile', '-c', type=str,
                         default=CMIP6_CMOR_STASH_CONVERSION,
                         help='json file containing cmor-stash conversion')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help=('Number of processes used to process the data '
+                              'request sheets'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help=('Always read the data request with openpyxl, '
+                              'without using or updating the parse cache'))
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help=('Read the data request with openpyxl and replace '
+                              'its entry in the parse cache'))
+    parser.add_argument('--cache-dir', type=str,
+                        default=parse_cache.DEFAULT_CACHE_DIR,
+                        help='Directory holding the parse cache')
+    parser.add_argument('--cache-size', type=int,
+                        default=parse_cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help=('Maximum size of the parse cache in MB, older '
+                              'entries are removed beyond this'))
+
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Lowest level of message to log')
+    parser.add_argument('--log-file', type=str,
+                        help='File to log to, instead of standard error')
+    parser.add_argument('--diagnostics', type=str,
+                        help=('File to write diagnostics about the data '
+                              'request to, as JSON lines (unknown profiles, '
+                              'removed duplicates, translation mismatches). '
+                              'Not written if not given'))
 
     args = parser.parse_args()
+    request_logging.configure(args.log_level, args.log_file, args.diagnostics)
+
+    # only fetch the data request from the repository if it is being used
+    if args.datarequest == CMIP6_DATA_REQUEST:
+        export_data_request()
 
     # if a STASHmaster_A file exists for this suite, then it may be overriding
     #  the default
@@ -788,10 +1087,10 @@ if __name__ == '__main__':
     if args.um_version:
         umversion = args.um_version
     else:
-        print ('Unable to determine UM version. This can be set with the '
-               '--um-version argument, or by UMVERSION environment '
-               'variable. Assuming the latest version {}'.
-               format(latest_umversion))
+        logger.warning('Unable to determine UM version. This can be set with '
+                       'the --um-version argument, or by UMVERSION '
+                       'environment variable. Assuming the latest version %s',
+                       latest_umversion)
         umversion = latest_umversion
 
     # Here we add the path to the Metadata library. This is released at each
@@ -801,22 +1100,22 @@ if __name__ == '__main__':
     rose_meta_lib_path = os.path.expanduser(rose_meta_lib.
                                             format(umver=umversion))
     if not os.path.isdir(rose_meta_lib_path):
-        print ('The rose metadata library is not available at UM version %s'.
-               format(umversion))
+        logger.warning('The rose metadata library is not available at UM '
+                       'version %s', umversion)
         rose_meta_lib_path = os.path.expanduser('~fcm/rose-meta/um-atmos/HEAD/'
                                                 'lib/python')
-        print 'Using the HEAD version: %s'.format(rose_meta_lib_path)
+        logger.warning('Using the HEAD version: %s', rose_meta_lib_path)
     sys.path.append(rose_meta_lib_path)
 
     if args.stashmaster:
         stashmaster_path = args.stashmaster
-        print 'use input stashmaster ', args.stashmaster
+        logger.info('use input stashmaster %s', args.stashmaster)
     else:
         stashmaster_path = os.path.expanduser(stashmaster_default_path.
                                               format(umver=umversion))
     stash_parser = widget.stash_parse.StashMasterParserv1(stashmaster_path)
     stash_lookup = stash_parser.get_lookup_dict()
 
-    print args
+    logger.info('%s', args)
 
     work(args, stash_lookup)
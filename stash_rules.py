@@ -0,0 +1,309 @@
+#!/usr/bin/env python2.7
+"""
+Rules adjusting the profiles of STASH requests derived from the data request,
+used by process_spreadsheet.check_stash_dependencies.
+
+Each rule in STASH_RULES names the STASH sections and item ranges it can apply
+to, and an action that is passed the request dictionary and the STASHmaster
+name. The actions make any remaining checks (on the domain, package, name
+...) themselves. Rules are applied in table order, each one seeing the changes
+made by those before it.
+
+RuleIndex compiles the table into a dispatch index keyed on section and item
+range, so that only the rules that can apply to a request are run.
+"""
+import bisect
+import copy
+
+import request_logging
+
+logger = request_logging.get_logger(__name__)
+diagnostics = request_logging.get_diagnostics(__name__)
+
+ANY = None
+
+
+class Rule(object):
+    """
+    A STASH dependency rule.
+
+    name - short description of the rule
+    action - function(din, stashname) updating the request dictionary din
+    scopes - list of (sections, first item, last item), with sections either
+        ANY or a function of the section string returning True if the rule
+        applies, and either item ANY for no item limit
+    """
+    def __init__(self, name, action, scopes=((ANY, ANY, ANY),)):
+        self.name = name
+        self.action = action
+        self.scopes = scopes
+
+    def __repr__(self):
+        return 'Rule({!r})'.format(self.name)
+
+
+def sections(*names):
+    """Return a scope test for a list of section strings"""
+    return frozenset(names).__contains__
+
+
+def _cosp(din, stashname):
+    item = int(din['item'])
+    period = din['period']
+    logger.debug('this is COSP diagnostic, need to mean using hourly data '
+                 'on radiation TS,  %s', period)
+    if 'day' in period.lower():
+        din['tim_name'] = 'TRADDAYM'
+    elif 'mon' in period.lower():
+        din['tim_name'] = 'TRADMONM'
+    elif '6hr' in period.lower():
+        if din['tim_name'][-2:] != 'MN':
+            din['tim_name'] = 'T6HR'
+        else:
+            din['tim_name'] = 'TRAD6HRMN'
+    elif '3hr' in period.lower():
+        if din['tim_name'][-2:] != 'MN':
+            din['tim_name'] = 'T3HR'
+        else:
+            din['tim_name'] = 'TRAD3HRMN'
+    else:
+        din['tim_name'] = 'UNKNOWN'
+
+    if 320 <= item <= 327:
+        cosp_type = 'COSP_CAL'
+    elif 330 <= item <= 337:
+        cosp_type = 'COSP_ISC'
+    elif 340 <= item <= 347:
+        cosp_type = 'COSP_CAL'
+    elif item == 348:
+        cosp_type = 'COSP_PAR'
+        din['dom_name'] = 'DCOSP_5'
+    elif 370 <= item <= 371:
+        cosp_type = 'COSP_CAL40'
+    elif 372 <= item <= 390:
+        cosp_type = 'COSP_CAL'
+    din['package'] = din['package'] + '_' + cosp_type
+
+    if item == 337:
+        logger.debug('this is a histogram, need to do 7x7 domain')
+        din['dom_name'] = 'DCOSP7x7'
+
+
+def _tile(din, stashname):
+    if 'TILE' in stashname:
+        din['dom_name'] = 'DTILE'
+
+
+def _soil(din, stashname):
+    if 'SOIL' in stashname and din['dom_name'] == 'DIAG':
+        din['dom_name'] = 'DSOIL'
+
+
+def _tem(din, stashname):
+    # TEM STASH diagnostics can only have 1 set of levels - do not mix them
+    # else model will fail. They are already zonal mean, so don't have that
+    # in the domain
+    if din['dom_name'][-1] == 'Z':
+        din['dom_name'] = 'DP39CCM'
+
+
+def _limited(din, stashname):
+    if 'LTD' in din['package']:
+        # make the domain Europe - if multi-level then use appropriate
+        domain = copy.copy(din['dom_name'])
+        if domain == 'RLEVEL3':
+            din['dom_name'] = 'DEUROPER3'
+        elif domain == 'RLEVEL2':
+            din['dom_name'] = 'DEUROPER2'
+        elif domain == 'DIAG':
+            din['dom_name'] = 'DEUROPE'
+        else:
+            raise Exception('No not recognise this domain for LTD package'
+                            + domain + str(din))
+
+
+def _plev_not_section_30(din, stashname):
+    section = din['section']
+    if 'PLEV' in din['dom_name']:
+        if (section != '06' and section != '16'):
+            diagnostics.emit('pressure_levels_not_section_30',
+                             stashname=stashname, request=din)
+            din['package'] = 'NO_ALEV_PLEV'
+        elif section == '06:':
+            if 'P LEV' not in stashname:
+                din['package'] = 'NO_ALEV_PLEV'
+        elif section == '16':
+            item = int(din['item'])
+            if not (item in range(202, 206) or item == '256'):
+                din['package'] = 'NO_ALEV_PLEV'
+
+
+def _pressure_level_diag(din, stashname):
+    item = din['item']
+    if item[0:1] == '2' or item[0:1] == '3':
+        if din['dom_name'] == 'DIAG':
+            # can't have DIAG in pressure level diagnostics
+            # try to assume these are ua850, va850, ta850
+            try:
+                plevel = din['cmor'][-3:]
+                din['dom_name'] = 'DP'+plevel
+            except:
+                din['dom_name'] = 'UNKNOWN'
+
+
+def _dall_wind(din, stashname):
+    if 'DALL' in din['dom_name']:
+        if 'WIND' in stashname:
+            diagnostics.emit('dall_domain_wind', stashname=stashname,
+                             request=din)
+            din['dom_name'] = 'DALLRH'
+
+
+def _diag_to_dallth(din, stashname):
+    if din['dom_name'] == 'DIAG':
+        din['dom_name'] = 'DALLTH'
+
+
+def _diag_to_dall_407_408(din, stashname):
+    if din['dom_name'] == 'DIAG':
+        if din['item'] == '407':
+            din['dom_name'] = 'DALLRH'
+        elif din['item'] == '408':
+            din['dom_name'] = 'DALLTH'
+
+
+def _d52_471_472(din, stashname):
+    if din['item'] == '471':
+        din['dom_name'] = 'D52TH'
+    elif din['item'] == '472':
+        din['dom_name'] = 'D52RH'
+
+
+def _dallrh_to_diag(din, stashname):
+    if din['dom_name'] == 'DALLRH':
+        din['dom_name'] = 'DIAG'
+
+
+def _item_rule(name, action, codes):
+    """Rule for a list of individual (section, item) strings"""
+    codes = frozenset(codes)
+
+    def _action(din, stashname):
+        if (din['section'], din['item']) in codes:
+            action(din, stashname)
+    return Rule(name, _action, [(sections(section), int(item), int(item))
+                                for section, item in sorted(codes)])
+
+
+STASH_RULES = [
+    Rule('COSP: hourly means on radiation timesteps and COSP packages',
+         _cosp, [(sections('02'), 320, 390)]),
+    Rule('TILE in STASH name: DTILE domain', _tile),
+    Rule('SOIL in STASH name in a section with an 8: DSOIL domain', _soil,
+         [(lambda section: '8' in section, ANY, ANY)]),
+    Rule('TEM: zonal mean domains to DP39CCM', _tem,
+         [(sections('30'), 310, 316)]),
+    Rule('LTD package: European domains', _limited),
+    Rule('pressure levels outside section 30: NO_ALEV_PLEV package',
+         _plev_not_section_30, [(lambda section: section != '30', ANY, ANY)]),
+    Rule('section 30 2xx/3xx: DIAG to single pressure level',
+         _pressure_level_diag, [(sections('30'), ANY, ANY)]),
+    Rule('DALL domain with WIND in STASH name: DALLRH', _dall_wind),
+    _item_rule('01223, 01241: DIAG to DALLTH', _diag_to_dallth,
+               [('01', '223'), ('01', '241')]),
+    _item_rule('02308, 02309: DIAG to DALLTH', _diag_to_dallth,
+               [('02', '308'), ('02', '309')]),
+    _item_rule('00407, 00408: DIAG to DALLRH, DALLTH', _diag_to_dall_407_408,
+               [('00', '407'), ('00', '408')]),
+    _item_rule('03471, 03472: D52TH, D52RH', _d52_471_472,
+               [('03', '471'), ('03', '472')]),
+    _item_rule('02205, 03332: DALLRH to DIAG', _dallrh_to_diag,
+               [('02', '205'), ('03', '332')]),
+]
+
+
+class RuleIndex(object):
+    """
+    Dispatch index of a rule table, keyed on the section and item range.
+
+    For each section seen the rules that can apply to it are split into
+    elementary item intervals; finding the rules for a request is then a
+    dictionary lookup and a bisection.
+
+    Example
+    -------
+    >>> index = RuleIndex(STASH_RULES)
+    >>> [rule.name[:4] for rule in index.rules_for('02', 330)]
+    ['COSP', 'TILE', 'LTD ', 'pres', 'DALL']
+    >>> [rule.name[:5] for rule in index.rules_for('30', 312)]
+    ['TILE ', 'TEM: ', 'LTD p', 'secti', 'DALL ']
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._sections = {}
+
+    def _compile_section(self, section):
+        # rule positions with their item limits for this section
+        scoped = []
+        for position, rule in enumerate(self.rules):
+            for section_test, first, last in rule.scopes:
+                if section_test is ANY or section_test(section):
+                    scoped.append((position, first, last))
+
+        # boundaries between intervals of items with the same rules
+        bounds = set()
+        for _, first, last in scoped:
+            if first is not ANY:
+                bounds.add(first)
+            if last is not ANY:
+                bounds.add(last + 1)
+        bounds = sorted(bounds)
+
+        # the rules for item < bounds[0], bounds[0] <= item < bounds[1], ...
+        starts = [None] + bounds
+        interval_rules = []
+        for start in starts:
+            item = bounds[0] - 1 if start is None and bounds else start
+            positions = sorted(set(
+                position for position, first, last in scoped
+                if item is None or
+                ((first is ANY or first <= item) and
+                 (last is ANY or item <= last))))
+            interval_rules.append([self.rules[pos] for pos in positions])
+        compiled = (bounds, interval_rules)
+        self._sections[section] = compiled
+        return compiled
+
+    def rules_for(self, section, item):
+        """Return the rules, in table order, that can apply to section/item"""
+        try:
+            bounds, interval_rules = self._sections[section]
+        except KeyError:
+            bounds, interval_rules = self._compile_section(section)
+        return interval_rules[bisect.bisect_right(bounds, item)]
+
+
+_INDEX = RuleIndex(STASH_RULES)
+
+
+def stash_name(din, stash_lookup):
+    """Return the STASHmaster name of the request, or '' if it has none"""
+    section_lookup = str(int(din['section']))
+    item_lookup = str(int(din['item']))
+    try:
+        return stash_lookup[section_lookup][item_lookup]['name']
+    except:
+        diagnostics.emit('stash_not_in_stashmaster', section=section_lookup,
+                         item=item_lookup)
+        return ''
+
+
+def apply_stash_rules(requests, stash_lookup, index=_INDEX):
+    """
+    Apply the rules of the index (by default STASH_RULES) to each of a batch
+    of request dictionaries, updating them in place.
+    """
+    for din in requests:
+        stashname = stash_name(din, stash_lookup)
+        for rule in index.rules_for(din['section'], int(din['item'])):
+            rule.action(din, stashname)
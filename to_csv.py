@@ -1,43 +1,185 @@
-#!/usr/bin/env pythoh
+#!/usr/bin/env python2.7
+"""
+Write the namelist sections of rose app configurations (rose-app.conf, or an
+extract of it such as tim.out) to CSV.
 
-from itertools import ifilter, imap, count
+Sections are read a line at a time, so any number of files of any size can be
+converted in one invocation. Options may be in any order, values may carry on
+over continuation lines (rose writes these as indented lines starting with
+"="), and comments, ignored ("!" or "!!") sections and options, and sections
+that are not namelists are skipped.
+
+Two output formats are available:
+
+    streq   one row per STASH request: namelist,dom,isec,item,tim,use,package
+    long    one row per option of every namelist section:
+            file,group,index,key,value
+
+    python to_csv.py [--format streq|long] [--group GROUP ...]
+                     [--output tim.csv] [tim.out ...]
+"""
+import argparse
+import collections
+import csv
 import re
+import sys
+
+_NAMELIST = re.compile(r'namelist:(\w+)(?:\((.*)\))?$')
 
-def _has_content(line):
-    return line not in ('\n', ' \n')
+# the streq output columns, and the namelist options they are taken from
+STREQ_COLUMNS = (('namelist', None), ('dom', 'dom_name'), ('isec', 'isec'),
+                 ('item', 'item'), ('tim', 'tim_name'), ('use', 'use_name'),
+                 ('package', 'package'))
+LONG_COLUMNS = ('file', 'group', 'index', 'key', 'value')
+STASH_GROUPS = ('streq', 'time', 'domain', 'use')
 
-def _strip_eol(line):
-    return line[:-1]
+Block = collections.namedtuple('Block', 'group index options')
 
-def _nl(line):
-    match = re.search('streq\((.*)\)', line)
-    return match.group(1)
 
-def _after_eq(line):
-    match = re.search('=(.*)$', line)
-    return match.group(1)
+def read_blocks(fi, groups=None):
+    """
+    Generate a Block for each namelist section of a rose configuration, in
+    file order, with its options as a list of (key, value) in file order.
+    Only the sections of the namelist groups in groups are generated, if it
+    is given.
+
+    Example
+    -------
+    >>> import StringIO
+    >>> conf = StringIO.StringIO('''
+    ... [env]
+    ... A=1
+    ...
+    ... [namelist:streq(03236_abc)]
+    ... use_name='UP5'
+    ... !ignored=1
+    ... dom_name='DIAG'
+    ...
+    ... [!namelist:streq(00024_def)]
+    ... dom_name='DIAG'
+    ...
+    ... [namelist:domain(diag)]
+    ... # comment
+    ... iopl=1
+    ... levlst=1,2,3,
+    ...       =4,5
+    ... ''')
+    >>> for block in read_blocks(conf):
+    ...     print block.group, block.index, block.options
+    streq 03236_abc [('use_name', "'UP5'"), ('dom_name', "'DIAG'")]
+    domain diag [('iopl', '1'), ('levlst', '1,2,3,\\n4,5')]
+    """
+    block = None
+    options = None
+    # whether the last option read is kept, for its continuation lines
+    keeping = False
+    for line in fi:
+        first = line[:1]
+        if first in ' \t':
+            content = line.strip()
+            if not content or content[0] == '#':
+                continue
+            # a continuation line
+            if keeping:
+                if content[0] == '=':
+                    content = content[1:]
+                key, value = options[-1]
+                options[-1] = (key, value + '\n' + content)
+        elif first == '[':
+            if block is not None:
+                yield block
+                block = None
+            keeping = False
+            name = line.strip()[1:-1]
+            namelist = _NAMELIST.match(name)
+            if (namelist is not None and
+                    (groups is None or namelist.group(1) in groups)):
+                options = []
+                block = Block(namelist.group(1), namelist.group(2) or '',
+                              options)
+        elif first in '#\r\n':
+            continue
+        else:
+            key, equals, value = line.rstrip('\r\n').partition('=')
+            if not equals:
+                raise ValueError(
+                    'Not a rose configuration line: {!r}'.format(line))
+            keeping = block is not None and first != '!'
+            if keeping:
+                options.append((key.strip(), value))
+    if block is not None:
+        yield block
+
 
 def read_nl(fi):
-    inp = imap(_strip_eol, ifilter(_has_content, fi))
-    while True:
-        try:
-            namelist = _nl(next(inp))
-        except StopIteration:
-            break
-        dom = _after_eq(next(inp))
-        isec = _after_eq(next(inp))
-        item = _after_eq(next(inp))
-        package = _after_eq(next(inp))
-        tim = _after_eq(next(inp))
-        use = _after_eq(next(inp))
-        yield (namelist, dom, isec, item, tim, use)
+    """
+    Generate a tuple of the STREQ_COLUMNS for each streq namelist in a rose
+    configuration. Missing options are empty.
+    """
+    names = [option for _, option in STREQ_COLUMNS[1:]]
+    for block in read_blocks(fi, ('streq',)):
+        options = dict(block.options)
+        yield (block.index,) + tuple([options.get(name, '') for name in names])
+
 
 def write_records(fo, records):
-    fo.write('namelist,dom,isec,item,tim,use\n')
-    for record in records:
-        fo.write(','.join(record) + '\n')
-
-with open('tim.out', 'r') as fi:
-    with open('tim.csv', 'w') as fo:
-        records = read_nl(fi)
-        write_records(fo, records)
+    """Write the read_nl records to fo as CSV."""
+    writer = csv.writer(fo)
+    writer.writerow([column for column, _ in STREQ_COLUMNS])
+    writer.writerows(records)
+
+
+def read_files(fnames):
+    """Generate the read_nl records of each file in fnames in turn."""
+    for fname in fnames:
+        with open(fname, 'r') as fi:
+            for record in read_nl(fi):
+                yield record
+
+
+def write_long(fo, fnames, groups=None):
+    """
+    Write a row of LONG_COLUMNS to fo for each option of the namelist
+    sections of each file in fnames.
+    """
+    writer = csv.writer(fo)
+    writer.writerow(LONG_COLUMNS)
+    for fname in fnames:
+        with open(fname, 'r') as fi:
+            for block in read_blocks(fi, groups):
+                for key, value in block.options:
+                    writer.writerow((fname, block.group, block.index, key,
+                                     value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=('Write the namelist sections of rose app configurations '
+                     'to CSV'))
+    parser.add_argument('inputs', nargs='*', default=['tim.out'],
+                        help='rose configuration files (default tim.out)')
+    parser.add_argument('--output', '-o', default='tim.csv',
+                        help='CSV file to write, "-" for standard output')
+    parser.add_argument('--format', '-f', choices=('streq', 'long'),
+                        default='streq',
+                        help=('streq: one row per STASH request; long: one '
+                              'row per option of each namelist'))
+    parser.add_argument('--group', '-g', action='append', dest='groups',
+                        help=('namelist group to write in the long format, '
+                              'may be repeated (default {})'.format(
+                                  ' '.join(STASH_GROUPS))))
+    args = parser.parse_args(argv)
+
+    fo = sys.stdout if args.output == '-' else open(args.output, 'wb')
+    try:
+        if args.format == 'long':
+            write_long(fo, args.inputs, args.groups or STASH_GROUPS)
+        else:
+            write_records(fo, read_files(args.inputs))
+    finally:
+        if fo is not sys.stdout:
+            fo.close()
+
+
+if __name__ == '__main__':
+    main()
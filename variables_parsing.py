@@ -23,12 +23,25 @@ Output is written to csv file, that is similar in format to the CMIP6
 request csv but 
 """
 
+import argparse
+import bisect
+import collections
 import ConfigParser
+import gzip
+import heapq
+import multiprocessing
 import os
 import csv
+from multiprocessing.pool import ThreadPool
+import operator
+import re
 import string
 from mip_parser import parseMipTable as mip_table_read
 
+import cell_methods
+import parse_cache
+import request_table
+
 _SEP='_'
 def mip_id(table, section):
     """
@@ -48,12 +61,34 @@ class _AttrFromDict(object):
     """
     Base class for classes that derive their attributes from a
     dictionary.
+
+    Subclasses keep the attributes they use often in __slots__; the
+    dictionary is only looked in for the others.
     """
+    __slots__ = ()
+
     def __getattr__(self, attname):
         if attname not in self._attdict:
             raise AttributeError('Attribute not found: {}'.format(attname))
         else:
             return self._attdict[attname]
+
+    # pickle the slots of every class, so that entries can be sent between
+    # processes (see models_known_mappings)
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                descriptor = cls.__dict__[name]
+                try:
+                    state[name] = descriptor.__get__(self, cls)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
     
 class VariableEntry(_AttrFromDict):
     """
@@ -76,8 +111,16 @@ class VariableEntry(_AttrFromDict):
     >>> entry = VariableEntry('apm', 'pr', dict(miptable = 'CMIP5_Amon', valid_min='0', tol_min='-1.0e-7'))
     >>> entry.min_handling
     'valid_min: 0, tol_min: -1.0e-7'
+
+    The expression fields are set by add_expression_to_variables:
+    >>> entry.stash_mapping
+    Traceback (most recent call last):
+    ...
+    AttributeError: Attribute not found: stash_mapping
     """
     
+    __slots__ = ('stream', 'mip_id', 'published', '_attdict',
+                 'stash_mapping', 'units', 'positive', 'comment', 'notes')
     _SELECTORS = ('lbproc', 'lbuser5', 'blev')
     _MIN_HANDLING = ('valid_min', 'tol_min')
     
@@ -103,51 +146,330 @@ class VariableEntry(_AttrFromDict):
         return self._gather_atts(self._MIN_HANDLING)
         
 
-def read_variables_file(fname):
-    """Read the xxx_variables file returning a list of entries."""
-    
+def _cached_parse(parse, prefix, fname, cache):
+    """
+    Return parse(fname), from the cache if it is there (see
+    parse_cache.file_stat_key) and storing it in the cache if not.
+    """
+    if cache is None:
+        return parse(fname)
+    key = parse_cache.file_stat_key(prefix, fname)
+    parsed = cache.get(key)
+    if parsed is None:
+        parsed = parse(fname)
+        # evicted once the whole directory is loaded
+        cache.put(key, parsed, evict=False)
+    return parsed
+
+def _map_threads(function, items, workers):
+    """Return [function(item) for item in items], using worker threads."""
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def _map_processes(function, items, workers, initializer=None,
+                   initargs=()):
+    """
+    Return [function(item) for item in items], using worker processes.
+
+    function must be a module level function; the items and results are
+    pickled. initializer(*initargs) is called in each worker (or once,
+    without workers) before any items, to set up the state they share.
+    There are no more workers than CPUs, which they would only slow down.
+    """
+    workers = min(workers, len(items), multiprocessing.cpu_count())
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [function(item) for item in items]
+    pool = multiprocessing.Pool(workers, initializer, initargs)
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _parse_variables_file(fname):
+    """Return the (section, attributes) of a xxx_variables file."""
     with open(fname, 'r') as fi:
         parser = ConfigParser.SafeConfigParser()
         parser.readfp(fi)
+    return [(section, dict(parser.items(section)))
+            for section in parser.sections()]
+
+def read_variables_file(fname, cache=None):
+    """Read the xxx_variables file returning a list of entries."""
+    
+    sections = _cached_parse(_parse_variables_file, 'variables', fname, cache)
     stream = os.path.basename(fname).split(_SEP)[0]
-    return [VariableEntry(stream, section, dict(parser.items(section))) for section in parser.sections()]
+    return [VariableEntry(stream, section, attdict) for section, attdict in sections]
+
+def read_variables_dir(dname, workers=1, cache=None):
+    """
+    Read a directory of xxx_variables files returning all entries.
 
-def read_variables_dir(dname):
-    """Read a directory of xxx_variables files returning all entries."""
+    The files are read by up to workers threads, and through the
+    parse_cache.ParseCache cache if one is given.
+    """
     
-    fnames = [fname for fname in os.listdir(dname) if 'variables' in fname]
+    fnames = [os.path.join(dname, fname)
+              for fname in os.listdir(dname) if 'variables' in fname]
     variables = list()
-    for fname in fnames:
-        variables.extend(read_variables_file(os.path.join(dname, fname)))
+    for entries in _map_threads(lambda fname: read_variables_file(fname, cache),
+                                fnames, workers):
+        variables.extend(entries)
+    if cache is not None:
+        cache.evict()
     return variables  
 
 
+_COMPARISONS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+                '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+_CONSTRAINT = re.compile(r'\s*(<=|>=|==|!=|<|>)\s*([0-9]+(?:\.[0-9]*)?)\s*')
+_MEMBERSHIP = re.compile(r'\s*(not\s+in|in)\s*[([]([0-9.,\s]*)[)\]]\s*$')
+
+class VersionPredicate(object):
+    """
+    A um_version constraint from the stash mapping table, parsed once.
+
+    The constraint is the right hand side of a comparison with the version,
+    e.g. '>= 6.6'. As in python, in a chained comparison like '>= 6.6 < 7.3'
+    only the first comparison is with the version, the rest compare the
+    constants. An empty constraint holds for every (non zero) version. The
+    only other constraints are lists of versions, 'in (6.6, 7.3)' or
+    'not in (...)'; anything else raises a ValueError.
+
+    Examples
+    --------
+    >>> p = VersionPredicate('>= 6.6')
+    >>> p(6.6), p(6.0), p.bounds
+    (True, False, [6.6])
+    >>> VersionPredicate('')(10.6), VersionPredicate('== 6.6').comparisons
+    (True, [(<built-in function eq>, 6.6)])
+    >>> VersionPredicate('>= 6.6 > 7.3')(10.6)
+    False
+    >>> p = VersionPredicate('in (6.6, 7.3)')
+    >>> p(7.3), p(7.0), p.comparisons is None
+    (True, False, True)
+    >>> VersionPredicate('not in [6.6]')(6.6)
+    False
+    >>> VersionPredicate('>= 6.6 or __import__("os")')
+    Traceback (most recent call last):
+    ...
+    ValueError: unsupported um_version constraint: '>= 6.6 or __import__("os")'
+    """
+
+    def __init__(self, constraint):
+        self.constraint = constraint
+        self.comparisons = self._parse(constraint)
+        # whether the comparisons between the constants of a chain hold
+        self._chain_holds = True
+        if self.comparisons is not None and len(self.comparisons) > 1:
+            self._chain_holds = all(
+                compare(left, right) for (_, left), (compare, right) in
+                zip(self.comparisons, self.comparisons[1:]))
+            self.comparisons = self.comparisons[:1]
+        if self.comparisons is None:
+            self._members, self._in = self._parse_membership(constraint)
+
+    @staticmethod
+    def _parse(constraint):
+        comparisons = []
+        position = 0
+        while position < len(constraint):
+            match = _CONSTRAINT.match(constraint, position)
+            if match is None:
+                if constraint[position:].strip():
+                    return None
+                break
+            comparisons.append((_COMPARISONS[match.group(1)],
+                                float(match.group(2))))
+            position = match.end()
+        return comparisons
+
+    @staticmethod
+    def _parse_membership(constraint):
+        match = _MEMBERSHIP.match(constraint)
+        try:
+            if match is None:
+                raise ValueError
+            return (frozenset(float(value) for value in
+                              match.group(2).split(',') if value.strip()),
+                    match.group(1) == 'in')
+        except ValueError:
+            raise ValueError(
+                'unsupported um_version constraint: {!r}'.format(constraint))
+
+    @property
+    def bounds(self):
+        """Return the versions at which the predicate can change."""
+        if self.comparisons is None:
+            return None
+        if not self.comparisons:
+            # only a zero version is false
+            return [0]
+        return [self.comparisons[0][1]]
+
+    def __call__(self, version):
+        if self.comparisons is None:
+            return (version in self._members) == self._in
+        if not self.comparisons:
+            return bool(version)
+        compare, value = self.comparisons[0]
+        return self._chain_holds and compare(version, value)
+
 class MappingExpression(_AttrFromDict):
-    """Class representing the entries in the stash mapping table."""
+    """
+    Class representing the entries in the stash mapping table.
+
+    Example
+    -------
+    >>> e = MappingExpression({'': '', '  published  ': ' CMIP5 (Amon, tas) ',
+    ...                        '  um version  ': '>= 6.6', '  owner  ': 'me'})
+    >>> e.published, e.um_version, e.owner, e.for_version(6.6)
+    ('CMIP5 (Amon, tas)', '>= 6.6', 'me', True)
+    """
     
+    _FIELDS = ('published', 'stash_mapping', 'units', 'positive', 'comment',
+               'notes', 'um_version')
+    __slots__ = _FIELDS + ('_attdict', '_predicate')
     _TRANS = string.maketrans(' ', _SEP)
+    # column heading -> attribute name, as every row has the same headings
+    _NAMES = {}
     
     def __init__(self, adict):
         adict.pop('') # remove leading null column
-        self._attdict = self._strip(adict)
+        self._attdict = {}
+        for name, value in self._strip(adict):
+            if name in self._FIELDS:
+                setattr(self, name, value)
+            else:
+                self._attdict[name] = value
+        self._predicate = None
         
     def _strip(self, adict):
-        return {k[2:-2].translate(self._TRANS).lower(): v.strip() for k,v in adict.iteritems()}
+        names = self._NAMES
+        for k, v in adict.iteritems():
+            name = names.get(k)
+            if name is None:
+                name = names[k] = k[2:-2].translate(self._TRANS).lower()
+            yield name, v.strip()
+
+    @property
+    def version_predicate(self):
+        """Return the compiled um_version constraint."""
+        if self._predicate is None:
+            self._predicate = VersionPredicate(self.um_version)
+        return self._predicate
         
     def for_version(self, version):
         """Return True if this expression is appropriate for version."""
-        return eval('{} {}'.format(version, self.um_version))
+        return self.version_predicate(version)
 
-def read_stash_mapping(ifile, version):
+class MappingIndex(object):
     """
-    Return the mappings from the stash mapping file at a model code version.
+    Index of the stash mapping expressions by the model versions they apply
+    to.
+
+    The bounds of all the version constraints split the versions into
+    intervals (and the bounds themselves) within which the same expressions
+    apply, so the expressions for a version are found by bisection.
+    Constraints that are lists of versions are evaluated for each version.
+
+    Example
+    -------
+    >>> class Expression(object):
+    ...     def __init__(self, name, um_version):
+    ...         self.name = name
+    ...         self.version_predicate = VersionPredicate(um_version)
+    >>> index = MappingIndex([Expression('a', '< 7.3'),
+    ...                       Expression('b', '>= 7.3'),
+    ...                       Expression('c', '< 10.6'),
+    ...                       Expression('d', '>= 6.6')])
+    >>> [e.name for e in index.for_version(6.6)]
+    ['a', 'c', 'd']
+    >>> sorted((v, [e.name for e in es])
+    ...        for v, es in index.for_versions([6.0, 7.3, 10.6]).items())
+    [(6.0, ['a', 'c']), (7.3, ['b', 'c', 'd']), (10.6, ['b', 'd'])]
+    """
+
+    def __init__(self, expressions):
+        self.expressions = list(expressions)
+        static = []
+        self._dynamic = []
+        bounds = set()
+        for position, expression in enumerate(self.expressions):
+            predicate = expression.version_predicate
+            if predicate.comparisons is None:
+                self._dynamic.append(position)
+            else:
+                static.append(position)
+                bounds.update(predicate.bounds)
+        self._bounds = sorted(bounds)
+
+        # segment 2i is below bounds[i] (and above bounds[i-1]), segment
+        # 2i+1 is bounds[i] itself; the predicates are constant on each
+        self._segments = []
+        for segment in range(2 * len(self._bounds) + 1):
+            version = self._representative(segment)
+            self._segments.append(
+                [position for position in static
+                 if self.expressions[position].version_predicate(version)])
+
+    def _representative(self, segment):
+        bounds = self._bounds
+        index, at_bound = divmod(segment, 2)
+        if at_bound:
+            return bounds[index]
+        if not bounds:
+            return 1
+        if index == 0:
+            return bounds[0] - 1
+        if index == len(bounds):
+            return bounds[-1] + 1
+        return (bounds[index - 1] + bounds[index]) / 2.0
+
+    def for_version(self, version):
+        """Return the expressions for version, in table order."""
+        index = bisect.bisect_left(self._bounds, version)
+        if index < len(self._bounds) and self._bounds[index] == version:
+            positions = self._segments[2 * index + 1]
+        else:
+            positions = self._segments[2 * index]
+        if self._dynamic:
+            positions = sorted(positions + [
+                position for position in self._dynamic
+                if self.expressions[position].version_predicate(version)])
+        return [self.expressions[position] for position in positions]
+
+    def for_versions(self, versions):
+        """Return a dictionary of the expressions for each version."""
+        return dict((version, self.for_version(version))
+                    for version in versions)
+
+def read_stash_mapping_index(ifile):
+    """
+    Return a MappingIndex of all the mappings in the stash mapping file.
     """
     with open(ifile, 'r') as mi:
         mapping_reader = csv.DictReader(mi, delimiter = '|')
-        expressions = (MappingExpression(entry) for entry in mapping_reader)
-        expressions = filter(lambda e: e.for_version(version), expressions)
-        
-    return expressions
+        return MappingIndex(MappingExpression(entry)
+                            for entry in mapping_reader)
+
+def read_stash_mapping(ifile, version, index=None):
+    """
+    Return the mappings from the stash mapping file at a model code version.
+
+    If a MappingIndex of the file is given, the file is not read again.
+    """
+    if index is None:
+        index = read_stash_mapping_index(ifile)
+    return index.for_version(version)
 
 
 class _NoExpression(object):
@@ -175,6 +497,8 @@ class MipTableVariableEntry(_AttrFromDict):
     >>> v.has_mapping
     False
     """
+    __slots__ = ('entry', 'table', 'table_name', 'mip_id', 'short_mip_id',
+                 'variable', '_attdict')
     _SEP = '_'
     
     def __init__(self, table_name, entry, adict):
@@ -248,50 +572,117 @@ class MipCsvVariableEntry(object):
         for attname in _TO_ADD:
             self.attdict[attname] = ''
         
-def read_mip_dir(dname, project):
-    """Read all the mip tables in a directory."""
+def read_mip_dir(dname, project, workers=1, cache=None):
+    """
+    Read all the mip tables in a directory.
+
+    The tables are read by up to workers threads, and through the
+    parse_cache.ParseCache cache if one is given.
+    """
     files = [os.path.join(dname, fname) 
              for fname in os.listdir(dname) 
              if fname.startswith(project)]
     requests = list()
-    for fname in files:
-        requests.extend(read_mip_table(fname))
+    for table_requests in _map_threads(lambda fname: read_mip_table(fname, cache),
+                                       files, workers):
+        requests.extend(table_requests)
+    if cache is not None:
+        cache.evict()
     return requests
 
-def read_mip_table(fname):
+def read_mip_table(fname, cache=None):
     """Return a list of MIP requested variables for a miptable."""
     
-    table = mip_table_read(fname)
+    table = _cached_parse(mip_table_read, 'miptable', fname, cache)
     tname = os.path.basename(fname)
     requests = (MipTableVariableEntry(tname, entryname, entry)
                   for entryname, entry in table['vars'].iteritems())
     return filter(lambda r: r.is_variable, requests)
 
-def read_cmip6_csv(mip_csv):
-    """Return a list of entries from the CMIP6 request spreadsheet."""
+def copy_mip_entries(requests):
+    """
+    Return new entries for the MIP table entries, without their
+    variables, so the tables read once can be matched to several models.
+    """
+    return [MipTableVariableEntry(r.table_name, r.entry, r._attdict)
+            for r in requests]
+
+def iter_cmip6_csv(mip_csv):
+    """Generate the entries from the CMIP6 request spreadsheet, in order."""
     with open(mip_csv, 'r') as mi:
-        reader = csv.DictReader(mi)
-        return [MipCsvVariableEntry(record) for record in reader]
+        for record in csv.DictReader(mi):
+            yield MipCsvVariableEntry(record)
+
+def read_cmip6_csv(mip_csv, cache=None):
+    """
+    Return a list of entries from the CMIP6 request spreadsheet.
+
+    If a parse_cache.ParseCache is given the rows are taken from the
+    cached request_table of the file.
+    """
+    if cache is None:
+        return list(iter_cmip6_csv(mip_csv))
+    table = request_table.load_request_table(mip_csv, cache)
+    return [MipCsvVariableEntry(record) for record in table.rows()]
+
+def _key_getter(keys):
+    """Return a function getting the attribute, or tuple of attributes, keys."""
+    if isinstance(keys, basestring):
+        return operator.attrgetter(keys)
+    return operator.attrgetter(*keys)
+
+def hash_index(records, keys):
+    """
+    Return a dictionary of the records by their keys (an attribute name,
+    or a tuple of names), keeping the last record for repeated keys.
+    """
+    key = _key_getter(keys)
+    return dict((key(record), record) for record in records)
+
+def hash_join(left, right, keys, right_keys=None):
+    """
+    Generate the (left, right) pairs of records whose keys match.
+
+    The keys are an attribute name, or a tuple of names for a multi-key
+    join, of the left records; right_keys are those of the right records
+    if they are named differently. The right records are indexed once, so
+    the join is linear. Left records are taken in order and are paired with
+    the last matching right record, if any.
+
+    Example
+    -------
+    >>> import collections
+    >>> Rec = collections.namedtuple('Rec', 'table entry value')
+    >>> left = [Rec('Amon', 'tas', 1), Rec('Lmon', 'tas', 2)]
+    >>> right = [Rec('Amon', 'tas', 'a'), Rec('Amon', 'tas', 'b')]
+    >>> [(l.value, r.value) for l, r in hash_join(left, right, 'entry')]
+    [(1, 'b'), (2, 'b')]
+    >>> [(l.value, r.value) for l, r in hash_join(left, right,
+    ...                                           ('table', 'entry'))]
+    [(1, 'b')]
+    """
+    left_key = _key_getter(keys)
+    index = hash_index(right, keys if right_keys is None else right_keys)
+    for record in left:
+        match = index.get(left_key(record))
+        if match is not None:
+            yield record, match
 
 def add_expression_to_variables(variables, expressions):
     """Matches an expression to a variable using the published attribute."""
-        
-    for variable in variables:
-        for expression in expressions:
-            if variable.published == expression.published:
-                variable.stash_mapping = expression.stash_mapping
-                variable.units = expression.units
-                variable.positive = expression.positive
-                variable.comment = expression.comment
-                variable.notes = expression.notes
+
+    for variable, expression in hash_join(variables, expressions, 'published'):
+        variable.stash_mapping = expression.stash_mapping
+        variable.units = expression.units
+        variable.positive = expression.positive
+        variable.comment = expression.comment
+        variable.notes = expression.notes
                 
 def variable_for_request(requests, variables):
     """Matches variables against MIP requested variables."""
-    
-    for request in requests:
-        for variable in variables:
-            if variable.mip_id == request.mip_id:
-                request.variable = variable
+
+    for request, variable in hash_join(requests, variables, 'mip_id'):
+        request.variable = variable
 
 def known_for_required(recs1, requests):
     """
@@ -300,64 +691,528 @@ def known_for_required(recs1, requests):
     Matches a previous MIP diagnostics  with a new MIP diagnostic
     using the short_mip_id like Amon_tas.
     """
-    
+
+    for cmip6, cmip5 in hash_join(recs1, requests, 'short_mip_id'):
+        _add_known_mapping(cmip6.attdict, cmip5)
+
+def enrich_with_known(recs1, requests, candidates=0):
+    """
+    Generate the new requests with the previously known expression
+    information added, as known_for_required, one at a time.
+
+    Requests without a known expression are given up to candidates of
+    the previous MIP diagnostics that are most like them (see
+    CandidateIndex and candidate_fields).
+
+    Only the indexes of the previous MIP diagnostics are held, so recs1
+    can be a stream of any length.
+    """
+    requests = list(requests)
+    index = hash_index(requests, 'short_mip_id')
+    candidate_index = CandidateIndex(requests) if candidates else None
     for cmip6 in recs1:
-        for cmip5 in requests:
-            if cmip6.short_mip_id == cmip5.short_mip_id:
-                cmip6.attdict['Variable_mapping'] = cmip5.variable.stash_mapping
-                cmip6.attdict['PP_constraint'] = cmip5.variable.selection
-                cmip6.attdict['Comment'] = cmip5.variable.comment
-                cmip6.attdict['Notes'] = cmip5.variable.notes
-                cmip6.attdict['Model_positive'] = cmip5.variable.positive
-                cmip6.attdict['Model_units'] = cmip5.variable.units
-                cmip6.attdict['Min_handling'] = cmip5.variable.min_handling
+        _add_known_or_candidates(cmip6.attdict, cmip6, index,
+                                 candidate_index, candidates)
+        yield cmip6
+
+def _add_known_or_candidates(attdict, cmip6, index, candidate_index,
+                             candidates):
+    cmip5 = index.get(cmip6.short_mip_id)
+    if cmip5 is not None:
+        _add_known_mapping(attdict, cmip5)
+    elif candidate_index is not None:
+        found = candidate_index.search(cmip6_features(cmip6), candidates)
+        _add_candidates(attdict, found)
+
+_FREQUENCIES = (('subhr', 'subhr'), ('sites', 'subhr'), ('1hr', '1hr'),
+                ('3hr', '3hr'), ('6hr', '6hr'), ('day', 'day'),
+                ('mon', 'mon'), ('aero', 'mon'), ('yr', 'yr'),
+                ('clim', 'monClim'), ('fx', 'fx'))
+
+def table_frequency(table):
+    """
+    Return the frequency of a MIP table from its name, or None.
+
+    Examples
+    --------
+    >>> table_frequency('Amon'), table_frequency('6hrPlev')
+    ('mon', '6hr')
+    >>> table_frequency('cfSites'), table_frequency('cfOff')
+    ('subhr', None)
+    """
+    lower = table.lower()
+    for token, frequency in _FREQUENCIES:
+        if token in lower:
+            return frequency
+    return None
+
+def request_features(standard_name, cell_methods_string, dimensions, table):
+    """
+    Return the features of a MIP variable used to find candidate mappings.
+
+    The features are (kind, value) pairs: the standard name, each
+    "coordinate: method" of the cell methods, each dimension (without
+    any trailing number, so plev8 matches plevs) and the frequency of
+    the table.
+
+    Example
+    -------
+    >>> sorted(request_features('air_temperature', 'area: time: mean',
+    ...                         'longitude latitude plev8 time', 'Amon'))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('cell_methods', 'area: mean'), ('cell_methods', 'time: mean'),
+     ('dimension', 'latitude'), ('dimension', 'longitude'),
+     ('dimension', 'plev'), ('dimension', 'time'),
+     ('frequency', 'mon'), ('standard_name', 'air_temperature')]
+    """
+    features = set()
+    if standard_name:
+        features.add(('standard_name', standard_name))
+    for method in cell_methods.parse_cell_methods(cell_methods_string):
+        for coord_name in method.coord_names:
+            features.add(('cell_methods',
+                          '{}: {}'.format(coord_name, method.method)))
+    for dimension in dimensions.split():
+        features.add(('dimension', dimension.rstrip(string.digits)))
+    frequency = table_frequency(table)
+    if frequency is not None:
+        features.add(('frequency', frequency))
+    return frozenset(features)
+
+def cmip5_features(request):
+    """Return the request_features of a MipTableVariableEntry."""
+    atts = request._attdict
+    return request_features(atts.get('standard_name', ''),
+                            atts.get('cell_methods', ''),
+                            atts.get('dimensions', ''), request.table)
+
+def cmip6_features(request):
+    """Return the request_features of a MipCsvVariableEntry."""
+    atts = request.attdict
+    return request_features(atts.get('cf_std_name', ''),
+                            atts.get('cell_methods', ''),
+                            atts.get('dimension', ''), request.table)
+
+class CandidateIndex(object):
+    """
+    Inverted index of MIP table entries by their request_features, to rank
+    them as candidate mappings for a request with no exact match.
+
+    A candidate is scored by the weighted Jaccard similarity of its
+    features with those searched for: the weight of the features they
+    share over the weight of all the features of either. Only the
+    entries sharing the standard name, or a cell method held by no more
+    than max_seed_fraction of the entries, are scored: the dimensions,
+    the frequency and the common cell methods (such as "time: mean")
+    are shared by most entries, so they only add to the score.
+
+    Example
+    -------
+    >>> class Entry(object):
+    ...     def __init__(self, short_mip_id, features):
+    ...         self.short_mip_id, self.features = short_mip_id, features
+    >>> tas = request_features('air_temperature', 'time: mean',
+    ...                        'longitude latitude time height2m', 'Amon')
+    >>> ts = request_features('surface_temperature', 'time: mean',
+    ...                       'longitude latitude time', 'Amon')
+    >>> index = CandidateIndex([Entry('Amon_tas', tas), Entry('Amon_ts', ts)],
+    ...                        features=lambda entry: entry.features)
+    >>> wanted = request_features('air_temperature', 'time: mean',
+    ...                           'longitude latitude time height2m', 'day')
+    >>> [(e.short_mip_id, round(score, 2))
+    ...  for e, score in index.search(wanted, 2)]
+    [('Amon_tas', 0.64)]
+    """
+
+    WEIGHTS = {'standard_name': 4.0, 'frequency': 2.0, 'cell_methods': 1.0,
+               'dimension': 0.5}
+
+    def __init__(self, requests, features=cmip5_features,
+                 max_seed_fraction=0.05):
+        self.requests = list(requests)
+        self._features = [features(request) for request in self.requests]
+        self._totals = [self._weight(entry_features)
+                        for entry_features in self._features]
+        self._postings = collections.defaultdict(list)
+        for position, entry_features in enumerate(self._features):
+            for feature in entry_features:
+                if feature[0] in ('standard_name', 'cell_methods'):
+                    self._postings[feature].append(position)
+        self._max_seeds = max(1, int(max_seed_fraction * len(self.requests)))
+
+    def _weight(self, features):
+        return sum(self.WEIGHTS[kind] for kind, _ in features)
+
+    def _seeds(self, features):
+        """Return the positions of the entries to score for features."""
+        seeds = set()
+        for feature in features:
+            postings = self._postings.get(feature, ())
+            if (feature[0] == 'standard_name' or
+                    len(postings) <= self._max_seeds):
+                seeds.update(postings)
+        return seeds
+
+    def search(self, features, k):
+        """
+        Return the best k (request, score) candidates for features, best
+        first, with ties in the order of the requests.
+        """
+        features = frozenset(features)
+        total = self._weight(features)
+        scores = []
+        for position in self._seeds(features):
+            shared = self._weight(features & self._features[position])
+            scores.append((shared / (total + self._totals[position] - shared),
+                           position))
+        best = heapq.nsmallest(k, scores,
+                               key=lambda (score, position): (-score, position))
+        return [(self.requests[position], score) for score, position in best]
+
+def candidate_fields(candidates):
+    """
+    Return the names of the output columns for the candidate mappings.
+
+    Example
+    -------
+    >>> candidate_fields(1)
+    ['Candidate_1', 'Candidate_1_mapping', 'Candidate_1_score']
+    """
+    fields = []
+    for rank in range(1, candidates + 1):
+        fields.extend(['Candidate_{}'.format(rank),
+                       'Candidate_{}_mapping'.format(rank),
+                       'Candidate_{}_score'.format(rank)])
+    return fields
+
+def _add_candidates(attdict, found):
+    for rank, (cmip5, score) in enumerate(found, 1):
+        attdict['Candidate_{}'.format(rank)] = cmip5.short_mip_id
+        attdict['Candidate_{}_mapping'.format(rank)] = \
+            cmip5.variable.stash_mapping
+        attdict['Candidate_{}_score'.format(rank)] = '{:.2f}'.format(score)
+
+_MAPPING_FIELDS = ('Variable_mapping', 'PP_constraint', 'Model_units',
+                   'Model_positive', 'Comment', 'Notes', 'Min_handling')
+
+def _add_known_mapping(attdict, cmip5):
+    attdict['Variable_mapping'] = cmip5.variable.stash_mapping
+    attdict['PP_constraint'] = cmip5.variable.selection
+    attdict['Comment'] = cmip5.variable.comment
+    attdict['Notes'] = cmip5.variable.notes
+    attdict['Model_positive'] = cmip5.variable.positive
+    attdict['Model_units'] = cmip5.variable.units
+    attdict['Min_handling'] = cmip5.variable.min_handling
                 
-def known_mappings(vdir, tdir, mfile, version):
+def known_mappings(vdir, tdir, mfile, version, mapping_index=None,
+                   workers=1, cache=None):
     """
     Return a list of known mappings for a model version.
 
     The mappings are inferred from the XXX_variables files,
-    the MIP tables, the stash mapping file. 
+    the MIP tables, the stash mapping file. A MappingIndex of the
+    stash mapping file can be given to avoid reading it again
+    for each version. The directories are read with workers
+    threads and the parse cache (see read_mip_dir).
     """
     
-    expressions = read_stash_mapping(mfile, version)
-    variables = read_variables_dir(vdir)
+    expressions = read_stash_mapping(mfile, version, mapping_index)
+    variables = read_variables_dir(vdir, workers, cache)
+    requests = read_mip_dir(tdir, 'CMIP5', workers, cache) # TODO improve this CMIP5 hard coded
+    return _match_known(variables, requests, expressions)
+
+def _match_known(variables, requests, expressions):
     add_expression_to_variables(variables, expressions)
-    
-    requests = read_mip_dir(tdir, 'CMIP5') # TODO improve this CMIP5 hard coded
     variable_for_request(requests, variables)
-
     return filter(lambda r: r.has_mapping, requests) # only CMIP5 with requests
 
-def write_csv(ofile, recs1):
+def model_label(vdir, version):
     """
-    Write the records to a csv file.
+    Return the label of a model in the batch outputs.
+
+    Example
+    -------
+    >>> model_label('/project/cfmip/trunk/HadGEM2-ES/', 6.6)
+    'HadGEM2-ES_6.6'
+    """
+    return mip_id(os.path.basename(os.path.normpath(vdir)), str(version))
+
+# the MIP tables, MappingIndex and parse cache shared by the models in a
+# models_known_mappings worker (see _init_model_worker)
+_model_inputs = None
+
+def _init_model_worker(tables, mapping_index, cache):
+    global _model_inputs
+    _model_inputs = (tables, mapping_index, cache)
+
+def _model_known_mappings(model):
+    vdir, version = model
+    tables, mapping_index, cache = _model_inputs
+    return _match_known(read_variables_dir(vdir, cache=cache),
+                        copy_mip_entries(tables),
+                        mapping_index.for_version(version))
+
+def models_known_mappings(models, tdir, mfile, workers=1, cache=None):
+    """
+    Return the list of known mappings for each (vdir, version) in models,
+    as known_mappings.
+
+    The MIP tables and the stash mapping file are read once and shared by
+    all the models. Matching a model is CPU bound, so the models are
+    processed by up to workers processes, which are forked with the tables
+    and send back their known mappings.
+    """
+    global _model_inputs
+    mapping_index = read_stash_mapping_index(mfile)
+    tables = read_mip_dir(tdir, 'CMIP5', workers, cache)
+    try:
+        return _map_processes(_model_known_mappings, list(models), workers,
+                              _init_model_worker,
+                              (tables, mapping_index, cache))
+    finally:
+        _model_inputs = None
+
+_CSV_FIELDS = "cmor_label,title,miptable,cf_std_name,description,cell_methods,dimension,units,positive,realm,priority,requesting_mips,UKESM_component,Owner,Variable_mapping,PP_constraint,Model_units,Model_positive,Stream,Plan,Ticket,Comment,Notes,Min_handling".split(',')
+
+class CsvOutput(object):
+    """
+    A csv file of records written through a buffer.
+
+    Each attdict written is projected into a row in the order of
+    fieldnames (missing fields are empty, any others are ignored) and
+    the rows are written to the file, and flushed from it, in chunks
+    of chunk_rows. buffer_bytes is the size of the file buffer. The
+    file is gzip compressed if compress is True, or if it is None and
+    ofile ends in .gz.
+
+    The defaults suit writing a whole table at once; with chunk_rows=1
+    each row is in the file as soon as it is written.
+
+    Example
+    -------
+    >>> import os, tempfile
+    >>> handle, ofile = tempfile.mkstemp(suffix='.csv.gz')
+    >>> os.close(handle)
+    >>> output = CsvOutput(ofile, ['a', 'b'])
+    >>> output.write({'b': 2, 'c': 3})
+    >>> output.close()
+    >>> gzip.open(ofile).read()
+    'a,b\\r\\n,2\\r\\n'
+    >>> os.remove(ofile)
+    """
+
+    def __init__(self, ofile, fieldnames, compress=None, chunk_rows=2048,
+                 buffer_bytes=1024 * 1024):
+        if compress is None:
+            compress = ofile.endswith('.gz')
+        if compress:
+            self._file = gzip.open(ofile, 'wb')
+        else:
+            self._file = open(ofile, 'wb', buffer_bytes)
+        self.fieldnames = tuple(fieldnames)
+        self.chunk_rows = chunk_rows
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(self.fieldnames)
+        self._chunk = []
+
+    def write(self, attdict):
+        """Add the row of attdict to the file."""
+        get = attdict.get
+        self._chunk.append([get(name, '') for name in self.fieldnames])
+        if len(self._chunk) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the rows added since the last flush, and flush the file."""
+        self._writer.writerows(self._chunk)
+        self._chunk = []
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+def has_known_mapping(rec):
+    """Return True if a CMIP6 record has a variable mapping."""
+    return bool(rec.attdict.get('Variable_mapping'))
+
+def has_no_known_mapping(rec):
+    """Return True if a CMIP6 record has no variable mapping."""
+    return not has_known_mapping(rec)
+
+def write_csv_variants(recs1, variants, fieldnames=_CSV_FIELDS,
+                       compress=None, chunk_rows=2048):
     """
-    with open(ofile, 'wb') as mi:
-        fieldnames = "cmor_label,title,miptable,cf_std_name,description,cell_methods,dimension,units,positive,realm,priority,requesting_mips,UKESM_component,Owner,Variable_mapping,PP_constraint,Model_units,Model_positive,Stream,Plan,Ticket,Comment,Notes,Min_handling".split(',')
+    Write the records to several csv files in one pass over recs1.
 
-        writer = csv.DictWriter(mi, fieldnames=fieldnames)
-        writer.writeheader()
+    The variants are (ofile, select) pairs: the records for which
+    select(rec) is true are written to ofile, all of them if select is
+    None. See CsvOutput for the compress and chunk_rows arguments.
+    """
+    outputs = []
+    try:
+        for ofile, select in variants:
+            outputs.append((CsvOutput(ofile, fieldnames, compress,
+                                      chunk_rows), select))
         for rec in recs1:
-            writer.writerow(rec.attdict)
+            for output, select in outputs:
+                if select is None or select(rec):
+                    output.write(rec.attdict)
+    finally:
+        for output, _ in outputs:
+            output.close()
+
+def write_csv(ofile, recs1, fieldnames=_CSV_FIELDS, compress=None,
+              chunk_rows=2048):
+    """
+    Write the records to a csv file, each as it is taken from recs1.
+
+    With chunk_rows=1 each row is in ofile before the next record is
+    taken from recs1.
+
+    Example
+    -------
+    >>> import os, tempfile
+    >>> handle, ofile = tempfile.mkstemp(suffix='.csv')
+    >>> os.close(handle)
+    >>> Record = collections.namedtuple('Record', 'attdict')
+    >>> def records():
+    ...     yield Record({'cmor_label': 'tas'})
+    ...     print repr(open(ofile).read())
+    ...     yield Record({'cmor_label': 'pr'})
+    >>> write_csv(ofile, records(), ['cmor_label'], chunk_rows=1)
+    'cmor_label\\r\\ntas\\r\\n'
+    >>> open(ofile).read()
+    'cmor_label\\r\\ntas\\r\\npr\\r\\n'
+    >>> os.remove(ofile)
+    """
+    write_csv_variants(recs1, [(ofile, None)], fieldnames, compress,
+                       chunk_rows)
 
-def fill_cmip6(mip_csv, mfile, vdir, tdir, ofile):
+def fill_cmip6(mip_csv, mfile, vdir, tdir, ofile, workers=1, cache=None,
+               candidates=0, variants=()):
     """
     Coordinate the reading the known mappings from CMIP5
     comparison with CMIP6 requests and output to file.
+
+    The CMIP6 requests are streamed from mip_csv to ofile a row at
+    a time, each row written to the file before the next is read;
+    only the known CMIP5 mappings are held in memory.
+    If candidates is given, requests without a known mapping are given
+    up to that many ranked candidate mappings, in extra columns (see
+    enrich_with_known).
+
+    Extra (ofile, select) variants of the output, for example of the
+    requests with no known mapping (see has_no_known_mapping), are
+    written in the same pass (see write_csv_variants).
     """
-    requests = known_mappings(vdir, tdir, mfile, 6.6)  #TODO better version handling
-    cmip6 = read_cmip6_csv(mip_csv)
+    requests = known_mappings(vdir, tdir, mfile, 6.6, workers=workers,
+                              cache=cache)  #TODO better version handling
+    cmip6 = iter_cmip6_csv(mip_csv)
 
-    known_for_required(cmip6, requests)    
-    write_csv(ofile, cmip6)
+    write_csv_variants(enrich_with_known(cmip6, requests, candidates),
+                       [(ofile, None)] + list(variants),
+                       _CSV_FIELDS + candidate_fields(candidates),
+                       chunk_rows=1)
 
-if __name__ == '__main__':
+def fill_cmip6_models(mip_csv, mfile, models, tdir, ofile_template,
+                      combined_file, workers=1, cache=None, candidates=0):
+    """
+    Coordinate the known mappings of several models, given as
+    (vdir, version) pairs, with the CMIP6 requests.
+
+    Each model is written to ofile_template.format(model=label) as
+    fill_cmip6 would write it (see model_label). combined_file has the
+    CMIP6 request columns once, followed by the mapping columns of each
+    model, prefixed with its label. The CMIP6 requests are streamed to
+    all the files in a single pass. Any candidate mappings asked for
+    are only written to the per model files.
+    """
+    models = list(models)
+    labels = [model_label(vdir, version) for vdir, version in models]
+    known = models_known_mappings(models, tdir, mfile, workers, cache)
+    indexes = [hash_index(requests, 'short_mip_id') for requests in known]
+    candidate_indexes = [CandidateIndex(requests) if candidates else None
+                         for requests in known]
+    model_fields = _CSV_FIELDS + candidate_fields(candidates)
+    request_fields = [f for f in _CSV_FIELDS if f not in _MAPPING_FIELDS]
+    combined_fields = request_fields + [mip_id(label, f) for label in labels
+                                        for f in _MAPPING_FIELDS]
 
+    outputs = []
+    try:
+        for label in labels:
+            outputs.append(CsvOutput(ofile_template.format(model=label),
+                                     model_fields))
+        outputs.append(CsvOutput(combined_file, combined_fields))
+        writers = outputs[:-1]
+        combined_writer = outputs[-1]
+
+        for cmip6 in iter_cmip6_csv(mip_csv):
+            combined = dict((f, cmip6.attdict.get(f, ''))
+                            for f in request_fields)
+            for label, index, candidate_index, writer in zip(
+                    labels, indexes, candidate_indexes, writers):
+                attdict = dict(cmip6.attdict)
+                _add_known_or_candidates(attdict, cmip6, index,
+                                         candidate_index, candidates)
+                writer.write(attdict)
+                for f in _MAPPING_FIELDS:
+                    combined[mip_id(label, f)] = attdict.get(f, '')
+            combined_writer.write(combined)
+    finally:
+        for mo in outputs:
+            mo.close()
+
+def main(argv=None):
     bdir = '/project/ipcc/ar5/etc'
-    ofile = 'out2.csv'
-    tdir = os.path.join(bdir, 'mip_tables/CMIP5/20130717')
-    mfile = os.path.join(bdir, 'mapping_tables/stash_mappings.txt')
-    vdir = '/project/cfmip/ar5_proc_CMIP5_MOHC/trunk/HadGEM2-ES'
-    cmip6_requests = 'input/CMIP6_data_req_20151126.csv'
-    fill_cmip6(cmip6_requests, mfile, vdir, tdir, ofile)
+    parser = argparse.ArgumentParser(
+        description=('Put forward CMIP6 mappings from the CMIP5 mappings of '
+                     'one model, or of several models (see --model)'))
+    parser.add_argument('--requests', default='input/CMIP6_data_req_20151126.csv',
+                        help='CMIP6 data request csv')
+    parser.add_argument('--tables',
+                        default=os.path.join(bdir, 'mip_tables/CMIP5/20130717'),
+                        help='directory of the CMIP5 MIP tables')
+    parser.add_argument('--mappings',
+                        default=os.path.join(bdir,
+                                             'mapping_tables/stash_mappings.txt'),
+                        help='stash mapping file')
+    parser.add_argument('--variables',
+                        default='/project/cfmip/ar5_proc_CMIP5_MOHC/trunk/HadGEM2-ES',
+                        help='directory of the xxx_variables files of the model')
+    parser.add_argument('--output', '-o', default='out2.csv',
+                        help='csv file to write')
+    parser.add_argument('--model', '-m', nargs=2, action='append',
+                        dest='models', metavar=('VARIABLES', 'VERSION'),
+                        help=('directory of the xxx_variables files and UM '
+                              'version of a model to process in a batch, '
+                              'may be repeated'))
+    parser.add_argument('--output-template', default='out2_{model}.csv',
+                        help=('csv file to write for each model of a batch, '
+                              'with {model} for its label'))
+    parser.add_argument('--combined', default='combined.csv',
+                        help='csv file of all the models of a batch')
+    parser.add_argument('--candidates', type=int, default=0,
+                        help=('number of candidate mappings to give requests '
+                              'with no known mapping'))
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help='worker threads, and processes for a batch')
+    args = parser.parse_args(argv)
+
+    # the tables and variables files are on shared file systems, so read
+    # them with several threads and keep a local cache of them
+    cache = parse_cache.ParseCache()
+    if args.models:
+        models = [(vdir, float(version)) for vdir, version in args.models]
+        fill_cmip6_models(args.requests, args.mappings, models, args.tables,
+                          args.output_template, args.combined,
+                          workers=args.workers,
+                          cache=cache, candidates=args.candidates)
+    else:
+        fill_cmip6(args.requests, args.mappings, args.variables, args.tables,
+                   args.output, workers=args.workers, cache=cache,
+                   candidates=args.candidates)
+
+if __name__ == '__main__':
+    main()